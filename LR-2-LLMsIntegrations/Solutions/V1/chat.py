@@ -7,8 +7,35 @@ import json
 import os
 import time
 import statistics
+import importlib.util
+import itertools
 from collections import Counter
 
+# Comma-separated list of LM Studio servers, optional "=N" sets max concurrent requests per host
+LM_STUDIO_URLS = os.getenv("LM_STUDIO_URLS", "http://192.168.0.105:1234/v1")
+# endpoint_pool.py only needs httpx, so it is loaded by file path (nothing is added to sys.path)
+ENDPOINT_POOL_PATH = os.getenv("ENDPOINT_POOL_PATH", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "..", "..", "LR-7-FinalProject", "multimodal-ai-service", "backend", "endpoint_pool.py",
+))
+
+
+def load_endpoint_pool(path):
+    """Load endpoint_pool.py as a standalone module, None if it is not available"""
+    if not os.path.exists(path):
+        return None
+    try:
+        spec = importlib.util.spec_from_file_location("endpoint_pool", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        return None
+
+
+endpoint_pool_module = load_endpoint_pool(ENDPOINT_POOL_PATH)
+ENDPOINT_POOL_AVAILABLE = endpoint_pool_module is not None
+
 # Initialize the main Tkinter window
 root = tk.Tk()
 root.title("LM Studio Chat Interface")
@@ -26,8 +53,36 @@ style.configure("TNotebook", background="#ffffff", tabmargins=5)
 style.configure("TNotebook.Tab", font=("Arial", 13, "bold"), padding=[10, 5], foreground="#005a9e")
 style.configure("TFrame", background="#ffffff")
 
-# Initialize OpenAI client with the local server
-client = OpenAI(base_url="http://192.168.0.105:1234/v1", api_key="lm-studio")
+# Initialize OpenAI client(s) with the local server(s)
+if ENDPOINT_POOL_AVAILABLE:
+    import httpx
+
+    # Least busy healthy host gets each request, failing hosts are skipped until they recover
+    endpoint_pool = endpoint_pool_module.EndpointPool(endpoint_pool_module.parse_endpoints(LM_STUDIO_URLS))
+    endpoint_pool.start_health_checks()
+    clients = [OpenAI(
+        base_url=str(endpoint_pool.base_url),
+        api_key="lm-studio",
+        http_client=httpx.Client(
+            transport=endpoint_pool_module.PoolTransport(endpoint_pool),
+            timeout=httpx.Timeout(600.0, connect=5.0),
+        ),
+    )]
+else:
+    # Without the pool: plain round-robin over all hosts (no health checks or concurrency caps)
+    urls = [item.strip().split("=")[0] for item in LM_STUDIO_URLS.split(",") if item.strip()]
+    clients = [OpenAI(base_url=url, api_key="lm-studio") for url in urls]
+    if len(clients) > 1:
+        print(f"endpoint_pool.py not found at {ENDPOINT_POOL_PATH}: round-robin over {len(clients)} hosts without health checks")
+
+client_cycle = itertools.cycle(clients)
+client_cycle_lock = threading.Lock()
+
+
+def next_client():
+    """Client for the next request (the pool client routes by itself)"""
+    with client_cycle_lock:
+        return next(client_cycle)
 
 # Function to handle the API request in a separate thread
 def send_request():
@@ -61,7 +116,7 @@ def send_request():
     def perform_request():
         try:
             # Create chat completion using OpenAI client
-            completion = client.chat.completions.create(
+            completion = next_client().chat.completions.create(
                 model="mistralai/mistral-7b-instruct-v0.3",
                 messages=[
                     {"role": "user", "content": f"{system_prompt} {prompt}"}
@@ -0,0 +1,187 @@
+"""
+Контроль допуску (admission control): ліміт одночасних запитів на endpoint і обмежена черга
+
+Без ліміту сплеск запитів сповільнює всі запити разом, доки вони не почнуть падати за таймаутом.
+Кожен захищений endpoint має AdmissionGate: не більше concurrency запитів виконуються, ще до
+queue чекають у черзі (FIFO) не довше max_wait секунд. Решта одразу отримує 503 з Retry-After -
+клієнт повторить пізніше, а p99 допущених запитів лишається стабільним.
+
+ADMISSION_LIMITS (див. main.py): "/chat=32:64:10,/generate_image=4:16:30"
+- шлях=concurrency:queue:max_wait (секунд).
+
+AdmissionMiddleware - чистий ASGI: слот звільняється після останнього http.response.body
+(або коли застосунок завершився - відключення клієнта, помилка), а не щойно пішли заголовки.
+Тому стрім (/chat/stream) тримає слот усю свою тривалість.
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+from starlette.responses import JSONResponse
+
+
+class Overloaded(Exception):
+    """Запит відхилено: reason - queue_full | timeout, retry_after - секунд до повтору"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"{reason}, retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionGate:
+    """Семафор з обмеженою FIFO чергою та максимальним часом очікування"""
+
+    def __init__(self, name: str, concurrency: int, queue: int, max_wait: float,
+                 observer: Optional[Callable[[str, str, float], None]] = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.max_wait = max_wait
+        self.observer = observer
+        self.active = 0
+        self.shed = 0
+        self._waiters = deque()
+        # Середній час обробки (EWMA) - для оцінки Retry-After
+        self._service_time = 1.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _notify(self, event: str, value: float = 0.0):
+        if self.observer is not None:
+            self.observer(self.name, event, value)
+
+    def retry_after(self) -> int:
+        """Оцінка, коли звільниться місце: черга + зайняті слоти, поділені на concurrency"""
+        backlog = (self.queued + self.active) / max(self.concurrency, 1)
+        return max(1, math.ceil(backlog * self._service_time))
+
+    def _reject(self, reason: str):
+        self.shed += 1
+        self._notify("shed:" + reason)
+        raise Overloaded(reason, self.retry_after())
+
+    async def acquire(self) -> float:
+        """Зайняти слот (повертає час у черзі) або кинути Overloaded"""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self._notify("admitted", 0.0)
+            return 0.0
+        if len(self._waiters) >= self.queue:
+            self._reject("queue_full")
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                # Слот передали саме в момент таймауту - він наш
+                return self._admitted(started)
+            self._reject("timeout")
+        except asyncio.CancelledError:
+            # Клієнт відключився в черзі: якщо слот уже передали - віддати його далі
+            if not self._abandon(waiter):
+                self.release()
+            raise
+        return self._admitted(started)
+
+    def _admitted(self, started: float) -> float:
+        waited = time.monotonic() - started
+        self._notify("admitted", waited)
+        return waited
+
+    def _abandon(self, waiter: asyncio.Future) -> bool:
+        """Прибрати очікувача з черги; False - слот йому вже передано"""
+        if waiter.done():
+            return False
+        waiter.cancel()
+        self._waiters.remove(waiter)
+        return True
+
+    def release(self, service_time: Optional[float] = None):
+        """Звільнити слот: передати першому в черзі або зменшити active"""
+        if service_time is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # active не змінюється - слот переходить очікувачу
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queue": self.queue,
+            "max_wait": self.max_wait,
+            "active": self.active,
+            "queued": self.queued,
+            "shed": self.shed,
+            "retry_after": self.retry_after(),
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware: AdmissionGate для POST на шляхи з gates, надлишок - 503 з Retry-After"""
+
+    def __init__(self, app, gates: Dict[str, AdmissionGate],
+                 on_reject: Optional[Callable[[AdmissionGate, Overloaded], None]] = None):
+        self.app = app
+        self.gates = gates
+        self.on_reject = on_reject
+
+    async def __call__(self, scope, receive, send):
+        gate = self.gates.get(scope["path"]) if scope["type"] == "http" else None
+        if gate is None or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        try:
+            await gate.acquire()
+        except Overloaded as e:
+            if self.on_reject is not None:
+                self.on_reject(gate, e)
+            response = JSONResponse(
+                {"error": "Сервер перевантажено, спробуйте пізніше", "retry_after": e.retry_after},
+                status_code=503,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                gate.release(time.perf_counter() - started)
+
+        async def releasing_send(message):
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                release()
+
+        try:
+            await self.app(scope, receive, releasing_send)
+        finally:
+            release()
+
+
+def parse_limits(spec: str) -> dict:
+    """"/chat=32:64:10,/upload_documents=4:16:30" -> {шлях: (concurrency, queue, max_wait)}"""
+    limits = {}
+    for item in spec.split(","):
+        path, _, values = item.strip().partition("=")
+        if not path or not values:
+            continue
+        concurrency, queue, max_wait = (values.split(":") + ["0", "10"])[:3]
+        limits[path] = (int(concurrency), int(queue), float(max_wait))
+    return limits
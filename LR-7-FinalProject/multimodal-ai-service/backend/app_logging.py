@@ -0,0 +1,180 @@
+"""
+Структуроване логування, що не блокує event loop
+
+- Записи кладуться в обмежену чергу (QueueHandler), у stdout їх пише фоновий потік (QueueListener).
+  Якщо черга переповнена - запис відкидається і рахується, а не блокує запит.
+- Кожен запис має request_id з contextvar (встановлюється middleware для кожного HTTP запиту).
+- DEBUG записи семплюються по request_id: або всі записи запиту, або жодного.
+- Формат: LOG_FORMAT=text (за замовчуванням) або json.
+
+Вимкнений рівень коштує одну перевірку isEnabledFor (~0.1 мкс), тому параметри
+передаються через %-аргументи, а не f-рядки.
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+LOGGER_NAME = "multimodal"
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Атрибути LogRecord, які не є користувацькими полями з extra={...}
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "taskName"}
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def get_request_id() -> str:
+    """request_id поточного запиту (або новий, якщо викликано поза запитом)"""
+    request_id = request_id_var.get()
+    if request_id is None:
+        request_id = new_request_id()
+        request_id_var.set(request_id)
+    return request_id
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS and not key.startswith("_")}
+
+
+class RequestContextFilter(logging.Filter):
+    """Додає request_id до запису та семплює DEBUG записи по запиту"""
+
+    def __init__(self, debug_sample_rate: float = 1.0):
+        super().__init__()
+        self.debug_threshold = int(min(max(debug_sample_rate, 0.0), 1.0) * 0xFFFFFFFF)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = request_id_var.get() or "-"
+        record.request_id = request_id
+        if record.levelno <= logging.DEBUG and self.debug_threshold < 0xFFFFFFFF:
+            return zlib.crc32(request_id.encode()) <= self.debug_threshold
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, що не чекає на повну чергу, а відкидає запис"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматуємо повідомлення тут (аргументи можуть змінитися після повернення),
+        # а traceback - окремо, щоб JSON формат тримав його в полі exc
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    """2024-01-01 12:00:00.123 INFO  [request_id] повідомлення key=value"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        line = f"{timestamp} {record.levelname:<7} [{getattr(record, 'request_id', '-')}] {record.getMessage()}"
+        fields = _extra_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        elif record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Один JSON об'єкт на рядок (для journald / Loki / ELK)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        payload.update(_extra_fields(record))
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[DroppingQueueHandler] = None
+
+
+def configure_logging(
+    level: Optional[str] = None,
+    fmt: Optional[str] = None,
+    debug_sample_rate: Optional[float] = None,
+    queue_size: Optional[int] = None,
+) -> logging.Logger:
+    """Налаштувати логер сервісу (параметри за замовчуванням - зі змінних оточення)"""
+    global _listener, _queue_handler
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = (fmt or os.getenv("LOG_FORMAT", "text")).lower()
+    if debug_sample_rate is None:
+        debug_sample_rate = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+    if queue_size is None:
+        queue_size = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    if _listener is not None:
+        _listener.stop()
+        logger.removeHandler(_queue_handler)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    _queue_handler.addFilter(RequestContextFilter(debug_sample_rate))
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+    logger.addHandler(_queue_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+def dropped_records() -> int:
+    """Кількість записів, відкинутих через переповнену чергу"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def shutdown_logging():
+    """Дописати все з черги (викликається при зупинці)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
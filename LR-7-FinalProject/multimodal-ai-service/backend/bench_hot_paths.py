@@ -0,0 +1,370 @@
+"""
+Мікро-бенчмарки гарячих функцій backend з порівнянням з baseline
+
+    python bench_hot_paths.py                  # виміряти і порівняти з bench_baseline.json
+    python bench_hot_paths.py --save           # перезаписати baseline поточними результатами
+    python bench_hot_paths.py -k normalize     # тільки бенчмарки з "normalize" у назві
+
+Кожен бенчмарк - мінімум з кількох повторів timeit (мікросекунди на виклик).
+startup/import_main - холодний імпорт main.py в окремому процесі (час старту воркера).
+
+Абсолютні мікросекунди з однієї машини не порівнюються з іншою (і навіть на тій самій машині
+плавають під стороннім навантаженням). Тому кожен повтор бенчмарку обрамлюється замірами
+еталонного циклу на чистому Python (reference_workload), і порівнюється медіана відношень
+бенчмарк / еталон.
+Регресія - якщо це відношення перевищує baseline більше ніж у threshold разів і при повторному
+вимірюванні; тоді код виходу 1.
+Інша версія Python або пакетів (fastapi, pydantic, orjson, brotli ...) змінює самі функції, а не
+швидкість машини - тоді скрипт попереджає, не рахує регресій, і baseline треба перезаписати
+через --save у цьому середовищі.
+Зміни продуктивності в цих функціях комітяться разом з оновленим baseline.
+"""
+
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from typing import Optional
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BACKEND_DIR, "bench_baseline.json")
+DEFAULT_THRESHOLD = 1.30
+# Версії пакетів, через які проходять гарячі шляхи (серіалізація, валідація, стиснення)
+ENVIRONMENT_PACKAGES = ("fastapi", "starlette", "pydantic", "orjson", "brotli")
+
+# Ізольовані сховища: бенчмарк не чіпає робочі catalog.db / outbox.db
+_workdir = tempfile.mkdtemp(prefix="bench_")
+os.environ.update({
+    "CATALOG_DB_PATH": os.path.join(_workdir, "catalog.db"),
+    "OUTBOX_DB_PATH": os.path.join(_workdir, "outbox.db"),
+    "STATE_BACKEND": "memory",
+    "ROUTER_LOG_PATH": os.path.join(_workdir, "router_log.jsonl"),
+    "LOG_LEVEL": "WARNING",
+})
+sys.path.insert(0, BACKEND_DIR)
+
+import main  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import Response  # noqa: E402
+
+BENCHMARKS = []
+
+
+def benchmark(name: str, threshold: float = DEFAULT_THRESHOLD):
+    """Зареєструвати фабрику бенчмарку: повертає функцію без аргументів для вимірювання"""
+    def decorator(factory):
+        BENCHMARKS.append((name, factory, threshold))
+        return factory
+    return decorator
+
+
+# ==================== DATA ====================
+def make_history(size: int) -> list:
+    """Історія розмови зі звичайними, multimodal та tool повідомленнями"""
+    rng = random.Random(size)
+    history = [{"role": "system", "content": "You are a helpful assistant. " * 40}]
+    for i in range(size):
+        kind = i % 6
+        if kind == 0:
+            history.append({"role": "user", "content": f"Скільки коштує товар {i}? " * rng.randint(1, 20)})
+        elif kind == 1:
+            history.append({"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{i}", "type": "function",
+                "function": {"name": "get_item_price", "arguments": json.dumps({"item_name": f"item {i}"})},
+            }]})
+        elif kind == 2:
+            history.append({"role": "tool", "tool_call_id": f"call_{i - 1}", "name": "get_item_price",
+                            "content": json.dumps({"item": f"item {i}", "price": i})})
+        elif kind == 3:
+            history.append({"role": "assistant", "content": "Відповідь асистента. " * rng.randint(5, 60)})
+        elif kind == 4:
+            history.append({"role": "user", "content": [
+                {"type": "text", "text": "Що на зображенні?"},
+                {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64," + "A" * 2000}},
+            ]})
+        else:
+            history.append({"role": "assistant", "content": "x" * 9000})
+    return history
+
+
+def make_text(size_bytes: int) -> str:
+    words = ["каталог", "товар", "доставка", "ціна", "замовлення", "документ", "розділ", "склад"]
+    rng = random.Random(size_bytes)
+    parts, length = [], 0
+    while length < size_bytes:
+        word = rng.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)
+
+
+def make_catalog(size: int) -> dict:
+    brands = ["apple", "samsung", "lenovo", "asus", "sony", "xiaomi", "dell", "hp"]
+    kinds = ["phone", "laptop", "tablet", "monitor", "headphones", "watch", "camera"]
+    catalog = {f"{brands[i % len(brands)]} {kinds[i % len(kinds)]} {i}": 100 + i % 5000 for i in range(size)}
+    catalog.update(main.DEFAULT_CATALOG)
+    return catalog
+
+
+def make_gallery(size: int) -> list:
+    started = datetime(2024, 1, 1)
+    return [{
+        "id": 1_700_000_000_000 + i,
+        "prompt": f"Футуристичне місто на заході сонця, варіант {i}",
+        "image_url": f"https://oaidalleapiprodscus.blob.core.windows.net/private/img-{i:08d}.png?st=2024&sig=" + "x" * 200,
+        "timestamp": (started + timedelta(minutes=i)).isoformat(),
+        "model": "dall-e-3",
+        "size": "1024x1024",
+        "quality": "standard",
+        "style": "vivid",
+    } for i in range(size)]
+
+
+def call_endpoint(coroutine):
+    """Виконати async endpoint без event loop (endpoint нічого не чекає) - без накладних витрат asyncio.run"""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    raise RuntimeError("Endpoint чекає на IO - виміряти його тут не можна")
+
+
+def render(payload) -> bytes:
+    """Серіалізація відповіді так само, як FastAPI: готовий Response - як є, dict - через default_response_class"""
+    if isinstance(payload, Response):
+        return payload.body
+    return main.app.router.default_response_class(jsonable_encoder(payload)).body
+
+
+# ==================== BENCHMARKS ====================
+@benchmark("normalize_messages/200")
+def bench_normalize_200():
+    history = make_history(200)
+    return lambda: main.normalize_messages(history, "system")
+
+
+@benchmark("normalize_messages/2000")
+def bench_normalize_2000():
+    history = make_history(2000)
+    return lambda: main.normalize_messages(history, "system")
+
+
+@benchmark("chunk_text/1MB")
+def bench_chunk_1mb():
+    text = make_text(1 << 20)
+    return lambda: main.chunk_text(text)
+
+
+@benchmark("chunk_text/4MB")
+def bench_chunk_4mb():
+    text = make_text(4 << 20)
+    return lambda: main.chunk_text(text)
+
+
+@benchmark("get_enabled_tools")
+def bench_enabled_tools():
+    settings = {"enabledTools": {"send_email": False, "book_meeting": True}}
+    return lambda: main.get_enabled_tools(settings)
+
+
+def _activate_catalog(size: int):
+    version = f"bench-{size}"
+    if main.CATALOG_VERSION != version:
+        main.activate_catalog(version, make_catalog(size))
+
+
+@benchmark("get_item_price/exact/100k")
+def bench_price_exact():
+    _activate_catalog(100_000)
+    return lambda: main.get_item_price("apple phone 56")
+
+
+@benchmark("get_item_price/fuzzy/100k", threshold=1.5)
+def bench_price_fuzzy():
+    _activate_catalog(100_000)
+    return lambda: main.get_item_price("samsng laptp 1234")
+
+
+@benchmark("get_item_price/missing/100k", threshold=1.5)
+def bench_price_missing():
+    _activate_catalog(100_000)
+    return lambda: main.get_item_price("zzzz qqqq")
+
+
+@benchmark("history_page/50")
+def bench_history_50():
+    main.state.list_replace(main.history_key("bench"), make_history(1000))
+    return lambda: render(call_endpoint(main.get_history("bench", limit=50)))
+
+
+@benchmark("history_page/500")
+def bench_history_500():
+    main.state.list_replace(main.history_key("bench"), make_history(1000))
+    return lambda: render(call_endpoint(main.get_history("bench", limit=500, include_images=True)))
+
+
+@benchmark("gallery_response/50")
+def bench_gallery_50():
+    main.ensure_gallery()
+    main.state.list_replace(main.GALLERY_KEY, make_gallery(500))
+    return lambda: render(call_endpoint(main.get_gallery(limit=50)))
+
+
+@benchmark("gallery_response/500")
+def bench_gallery_500():
+    main.ensure_gallery()
+    main.state.list_replace(main.GALLERY_KEY, make_gallery(500))
+    return lambda: render(call_endpoint(main.get_gallery(limit=500)))
+
+
+# Модулі, які main.py імпортує ліниво (перший виклик або прогрів після старту)
+LAZY_MODULES = ("openai", "pandas", "chromadb", "googleapiclient", "google_auth_oauthlib", "redis", "PIL")
+
+
+@benchmark("startup/import_main", threshold=1.5)
+def bench_startup():
+    # Окремий процес = холодний старт; імпорт важкого модуля на старті - помилка, а не регресія часу
+    code = (
+        "import sys, main\n"
+        f"eager = sorted(set({LAZY_MODULES!r}) & set(sys.modules))\n"
+        "assert not eager, f'main.py імпортує на старті: {eager}'\n"
+    )
+    env = {**os.environ, "OPENAI_API_KEY": "bench", "PYTHONPATH": BACKEND_DIR}
+    command = [sys.executable, "-c", code]
+    return lambda: subprocess.run(command, cwd=_workdir, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+# ==================== RUNNER ====================
+_REFERENCE_WORDS = [f"item {i} {'x' * (i % 17)}" for i in range(2000)]
+
+
+def reference_workload():
+    """Еталон швидкості машини: словники, рядки, сортування - без коду backend"""
+    index = {}
+    for word in _REFERENCE_WORDS:
+        index.setdefault(word.split(" ", 2)[1], []).append(word.upper())
+    return sorted(index, key=len)
+
+
+def _timer(func, min_time: float):
+    """timeit.Timer і кількість викликів на один повтор (~min_time секунд)"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return timer, max(1, int(number * min_time / 0.2))
+
+
+def measure_calibrated(func, repeat: int, min_time: float):
+    """
+    (мкс на виклик, відношення до еталону)
+
+    Кожен повтор бенчмарку обрамлений короткими замірами еталону - пара бачить те саме
+    навантаження машини; відношення - медіана по парах, час - мінімум повторів.
+    """
+    timer, number = _timer(func, min_time)
+    reference, reference_number = _timer(reference_workload, min_time / 4)
+    values, ratios = [], []
+    for _ in range(repeat):
+        before = reference.timeit(reference_number) / reference_number
+        value = timer.timeit(number) / number
+        after = reference.timeit(reference_number) / reference_number
+        values.append(value)
+        ratios.append(value / min(before, after))
+    return min(values) * 1e6, statistics.median(ratios)
+
+
+def _package_version(name: str) -> Optional[str]:
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def environment() -> dict:
+    """Те, що змінює самі функції (а не швидкість машини) - при розбіжності baseline неспівставний"""
+    return {
+        "python": platform.python_version(),
+        **{package: _package_version(package) for package in ENVIRONMENT_PACKAGES},
+    }
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Мікро-бенчмарки гарячих функцій backend")
+    parser.add_argument("-k", "--filter", help="Запускати тільки бенчмарки з цим підрядком у назві")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="Записати результати як новий baseline")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Мінімальний час одного повтору, с")
+    parser.add_argument("--threshold", type=float, help="Перевизначити поріг регресії для всіх бенчмарків")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    baseline_results = baseline.get("results", {})
+    baseline_relative = baseline.get("relative", {})
+    results, relative, regressions = {}, {}, []
+    current_environment = environment()
+    comparable = baseline.get("environment", current_environment) == current_environment
+    if baseline and not comparable:
+        print(f"⚠️  Середовище відрізняється від baseline ({baseline.get('environment')} vs {current_environment}) - "
+              "регресії не рахуються, перезапишіть baseline через --save")
+
+    print(f"{'benchmark':<30} {'µs/call':>12} {'× ref':>10} {'baseline':>10} {'ratio':>7}")
+    for name, factory, threshold in BENCHMARKS:
+        if args.filter and args.filter not in name:
+            continue
+        func = factory()
+        value, ratio_to_reference = measure_calibrated(func, args.repeat, args.min_time)
+        reference = baseline_relative.get(name)
+        limit = args.threshold or threshold
+        if reference and not args.save and ratio_to_reference / reference > limit:
+            # Підозра на регресію - перевиміряти: рахується, тільки якщо повторилась
+            value_again, ratio_again = measure_calibrated(func, args.repeat, args.min_time)
+            value, ratio_to_reference = min(value, value_again), min(ratio_to_reference, ratio_again)
+        results[name] = round(value, 3)
+        relative[name] = round(ratio_to_reference, 6)
+        line = f"{name:<30} {value:>12.2f} {relative[name]:>10.4f}"
+        if reference:
+            ratio = relative[name] / reference
+            marker = "  ❌ регресія" if ratio > limit else ("  ✅" if ratio < 1 / limit else "")
+            line += f" {reference:>10.4f} {ratio:>7.2f}{marker}"
+            if ratio > limit and comparable:
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        merged = {**baseline_results, **results} if args.filter else results
+        merged_relative = {**baseline_relative, **relative} if args.filter else relative
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "environment": current_environment,
+                "machine": platform.machine(),
+                "processor": platform.processor() or platform.machine(),
+                "saved_at": datetime.now().isoformat(timespec="seconds"),
+                # results - мкс на машині, що зберегла baseline (довідково); порівнюється relative
+                "results": merged,
+                "relative": merged_relative,
+            }, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"💾 Baseline збережено: {args.baseline}")
+    elif regressions:
+        print(f"❌ Регресії ({len(regressions)}): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
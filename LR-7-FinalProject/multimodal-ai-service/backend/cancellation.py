@@ -0,0 +1,74 @@
+"""
+Скасування роботи запиту, коли клієнт відключився або вичерпано дедлайн
+
+FastAPI не зупиняє обробник, якщо клієнт закрив вкладку: модель, тули та запис історії
+відпрацьовують до кінця для відповіді, яку ніхто не прочитає. run_cancellable запускає
+роботу окремою задачею і паралельно слухає http.disconnect з ASGI receive; відключення
+або дедлайн скасовують задачу - CancelledError проходить через await виклики моделі
+(async клієнт закриває з'єднання), RAG і тули в черзі виконавця.
+
+Етап, на якому роботу перервано (mark_stage), потрапляє в RequestCancelled - для метрики.
+"""
+
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Optional
+
+# Прогрес запиту: dict, спільний для обробника і задачі роботи (задача копіює контекст)
+_progress = contextvars.ContextVar("request_progress", default=None)
+
+
+class RequestCancelled(Exception):
+    """Роботу запиту скасовано: reason - disconnect | deadline, stage - останній етап"""
+
+    def __init__(self, reason: str, stage: str):
+        super().__init__(f"{reason} ({stage})")
+        self.reason = reason
+        self.stage = stage
+
+
+def mark_stage(name: str):
+    """Запам'ятати поточний етап запиту (поза run_cancellable - нічого не робить)"""
+    progress = _progress.get()
+    if progress is not None:
+        progress["stage"] = name
+
+
+def current_stage() -> str:
+    progress = _progress.get()
+    return progress["stage"] if progress else "start"
+
+
+async def wait_for_disconnect(receive: Callable[[], Awaitable[dict]]):
+    """Повернутися, коли клієнт закрив з'єднання (тіло запиту вже прочитане)"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_cancellable(work: Callable[[], Awaitable], receive: Callable[[], Awaitable[dict]],
+                          deadline: Optional[float] = None):
+    """
+    Виконати work() і скасувати, якщо клієнт відключився або минуло deadline секунд
+
+    Скасована робота встигає виконати свої except / finally (запис історії) до RequestCancelled.
+    """
+    progress = {"stage": "start"}
+    _progress.set(progress)
+    task = asyncio.ensure_future(work())
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=deadline or None, return_when=asyncio.FIRST_COMPLETED)
+        if task in done:
+            return task.result()
+        reason = "disconnect" if watcher in done else "deadline"
+        task.cancel()
+        try:
+            # Робота могла завершитись між подіями - тоді віддати результат
+            return await task
+        except asyncio.CancelledError:
+            raise RequestCancelled(reason, progress["stage"]) from None
+    finally:
+        watcher.cancel()
+        task.cancel()
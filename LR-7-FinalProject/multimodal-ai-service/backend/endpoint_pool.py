@@ -0,0 +1,397 @@
+"""
+Пул OpenAI-сумісних локальних endpoint-ів (кілька LM Studio / llama.cpp серверів)
+
+Один LM Studio на CPU обслуговує кілька запитів одночасно - далі черга росте лінійно.
+PoolTransport (httpx транспорт) розподіляє запити між кількома серверами:
+- запит іде на endpoint з найменшою кількістю незавершених запитів (least outstanding);
+- endpoint приймає не більше max_concurrency запитів, решта чекає на вільний слот
+  (стрім займає слот до закриття відповіді);
+- max_failures помилок поспіль (з'єднання, 5xx) - endpoint виключається з пулу на eject_seconds,
+  кожне наступне виключення вдвічі довше; останній невиключений endpoint не виключається ніколи -
+  запити йдуть на нього і падають самі, а щойно сервер піднявся, знову проходять;
+- фонова перевірка GET {url}/models повертає виключений endpoint одразу, як він відповів,
+  і виключає той, що перестав відповідати, ще до запиту користувача;
+- запит, який не зміг з'єднатися, повторюється на іншому endpoint (тіло ще не надіслано).
+
+Специфікація: "http://10.0.0.5:1234/v1,http://10.0.0.6:1234/v1=2" - адреса[=max_concurrency].
+Використовується backend (LM_STUDIO_URLS) і LR-2 chat.py; залежить тільки від httpx.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import httpx
+
+# Запит не надіслано - безпечно повторити на іншому endpoint
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+FAILURE_STATUSES = {500, 502, 503, 504}
+
+
+class NoEndpointAvailable(httpx.TransportError):
+    """Усі endpoint-и виключені або зайняті довше acquire_timeout"""
+
+
+def parse_endpoints(spec: str, max_concurrency: int = 4) -> List[Tuple[str, int]]:
+    """"http://a:1234/v1,http://b:1234/v1=2" -> [(url, max_concurrency), ...]"""
+    endpoints = []
+    for item in (spec or "").split(","):
+        url, _, limit = item.strip().rpartition("=")
+        if not limit.isdigit():
+            url, limit = item.strip(), ""
+        if url:
+            endpoints.append((url, int(limit) if limit else max_concurrency))
+    return endpoints
+
+
+class Endpoint:
+    """Один сервер пулу та його стан"""
+
+    def __init__(self, url: str, max_concurrency: int):
+        self.url = httpx.URL(url.rstrip("/"))
+        self.max_concurrency = max(1, max_concurrency)
+        self.outstanding = 0
+        self.failures = 0  # помилки поспіль
+        self.ejections = 0  # виключення поспіль (для backoff)
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.latency = None  # EWMA часу до заголовків відповіді, с
+
+    def __str__(self) -> str:
+        return str(self.url)
+
+    def ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+
+class _Waiter:
+    """Очікувач вільного слота; wake() будить потік або задачу"""
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class EndpointPool:
+    """Вибір endpoint-а, ліміти одночасних запитів, виключення та повернення endpoint-ів"""
+
+    def __init__(
+        self,
+        endpoints: List[Tuple[str, int]],
+        max_failures: int = 3,
+        eject_seconds: float = 10.0,
+        max_eject_seconds: float = 300.0,
+        health_interval: float = 10.0,
+        acquire_timeout: float = 60.0,
+        observer: Optional[Callable[[str, str], None]] = None,
+    ):
+        if not endpoints:
+            raise ValueError("Пул endpoint-ів порожній")
+        self.endpoints = [Endpoint(url, limit) for url, limit in endpoints]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.health_interval = health_interval
+        self.acquire_timeout = acquire_timeout
+        self.observer = observer
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._health_thread = None
+        self._stop = threading.Event()
+
+    @property
+    def base_url(self) -> httpx.URL:
+        """base_url для OpenAI клієнта - транспорт замінює його на вибраний endpoint"""
+        return self.endpoints[0].url
+
+    def _notify(self, event: str, endpoint: Endpoint):
+        if self.observer is not None:
+            self.observer(event, str(endpoint))
+
+    # ----- вибір endpoint-а -----
+    def _try_acquire(self, exclude) -> Optional[Endpoint]:
+        """Зайняти слот на найменш завантаженому endpoint (під lock); None - вільних немає"""
+        now = time.monotonic()
+        if all(endpoint.ejected(now) or endpoint in exclude for endpoint in self.endpoints):
+            raise NoEndpointAvailable("Усі локальні endpoint-и недоступні")
+        candidates = [
+            endpoint for endpoint in self.endpoints
+            if not endpoint.ejected(now) and endpoint not in exclude and endpoint.outstanding < endpoint.max_concurrency
+        ]
+        if not candidates:
+            return None
+        least = min(endpoint.outstanding for endpoint in candidates)
+        endpoint = random.choice([endpoint for endpoint in candidates if endpoint.outstanding == least])
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def _enter(self, exclude, waiter: _Waiter) -> Optional[Endpoint]:
+        with self._lock:
+            endpoint = self._try_acquire(exclude)
+            if endpoint is None:
+                self._waiters.append(waiter)
+            return endpoint
+
+    def _leave(self, waiter: _Waiter):
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def acquire(self, exclude=()) -> Endpoint:
+        """Зайняти слот (чекає не довше acquire_timeout)"""
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            waiter = _Waiter()
+            endpoint = self._enter(exclude, waiter)
+            if endpoint is not None:
+                return endpoint
+            remaining = deadline - time.monotonic()
+            # Таймаут очікування - ще й для повернення виключеного endpoint-а за часом
+            woken = remaining > 0 and waiter.event.wait(min(remaining, 1.0))
+            self._leave(waiter)
+            if not woken and time.monotonic() >= deadline:
+                raise NoEndpointAvailable(f"Немає вільного endpoint-а за {self.acquire_timeout:g} с")
+
+    async def acquire_async(self, exclude=()) -> Endpoint:
+        """Async варіант acquire (очікування не блокує event loop)"""
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            waiter = _Waiter(asyncio.get_running_loop())
+            endpoint = self._enter(exclude, waiter)
+            if endpoint is not None:
+                return endpoint
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    await asyncio.wait_for(waiter.event.wait(), min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._leave(waiter)
+            if time.monotonic() >= deadline:
+                raise NoEndpointAvailable(f"Немає вільного endpoint-а за {self.acquire_timeout:g} с")
+
+    def release(self, endpoint: Endpoint, failed: bool, latency: Optional[float] = None):
+        """Звільнити слот; failed - помилка з'єднання або 5xx"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures:
+                    self._eject(endpoint)
+            else:
+                endpoint.failures = 0
+                endpoint.ejections = 0
+                if latency is not None:
+                    endpoint.latency = latency if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * latency
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.wake()
+        self._notify("error" if failed else "ok", endpoint)
+
+    def _eject(self, endpoint: Endpoint):
+        """Виключити endpoint (під lock): 10 с, 20 с, 40 с ... до max_eject_seconds"""
+        endpoint.failures = 0
+        now = time.monotonic()
+        if not any(other is not endpoint and not other.ejected(now) for other in self.endpoints):
+            # Останній робочий endpoint: без нього всі запити падали б одразу, навіть після відновлення
+            return
+        endpoint.ejections += 1
+        duration = min(self.eject_seconds * 2 ** (endpoint.ejections - 1), self.max_eject_seconds)
+        endpoint.ejected_until = now + duration
+        self._notify("ejected", endpoint)
+
+    def has_alternative(self, exclude) -> bool:
+        """Чи є невиключений endpoint поза exclude (куди варто повторити запит)"""
+        now = time.monotonic()
+        with self._lock:
+            return any(not endpoint.ejected(now) and endpoint not in exclude for endpoint in self.endpoints)
+
+    def route(self, request: httpx.Request, endpoint: Endpoint) -> httpx.Request:
+        """Запит з base_url пулу, переписаний на endpoint (шлях після base_url зберігається)"""
+        path = request.url.raw_path.decode("ascii")
+        base_path = self.base_url.raw_path.decode("ascii")
+        if path.startswith(base_path):
+            path = path[len(base_path):]
+        url = endpoint.url.copy_with(raw_path=(endpoint.url.raw_path.decode("ascii") + path).encode("ascii"))
+        headers = [(name, value) for name, value in request.headers.raw if name.lower() != b"host"]
+        headers.insert(0, (b"Host", url.netloc))
+        return httpx.Request(request.method, url, headers=headers, stream=request.stream,
+                             extensions=request.extensions)
+
+    # ----- перевірка стану -----
+    def check_health(self, client: httpx.Client):
+        """GET {url}/models для кожного endpoint-а: повернути відповідальні, виключити мовчазні"""
+        for endpoint in self.endpoints:
+            try:
+                healthy = client.get(f"{endpoint.url}/models").status_code < 500
+            except httpx.HTTPError:
+                healthy = False
+            with self._lock:
+                now = time.monotonic()
+                if healthy and endpoint.ejected(now):
+                    endpoint.ejected_until = 0.0
+                    endpoint.failures = 0
+                    restored = True
+                else:
+                    restored = False
+                    if not healthy and not endpoint.ejected(now):
+                        self._eject(endpoint)
+                waiters, self._waiters = (self._waiters, []) if restored else ([], self._waiters)
+            for waiter in waiters:
+                waiter.wake()
+            if restored:
+                self._notify("restored", endpoint)
+
+    def start_health_checks(self):
+        """Фонова перевірка кожні health_interval секунд (повторний виклик нічого не робить)"""
+        if not self.health_interval or self._health_thread is not None:
+            return
+
+        def loop():
+            with httpx.Client(timeout=httpx.Timeout(3.0, connect=1.0)) as client:
+                while not self._stop.is_set():
+                    self.check_health(client)
+                    self._stop.wait(self.health_interval)
+
+        self._health_thread = threading.Thread(target=loop, name="endpoint-health", daemon=True)
+        self._health_thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def snapshot(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                "url": str(endpoint),
+                "max_concurrency": endpoint.max_concurrency,
+                "outstanding": endpoint.outstanding,
+                "ejected_for": round(max(0.0, endpoint.ejected_until - now), 1),
+                "requests": endpoint.requests,
+                "errors": endpoint.errors,
+                "latency": round(endpoint.latency, 3) if endpoint.latency is not None else None,
+            } for endpoint in self.endpoints]
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """Тіло відповіді, що звільняє слот endpoint-а при закритті (стрім займає слот до кінця)"""
+
+    def __init__(self, response: httpx.Response, release: Callable[[], None]):
+        self.response = response
+        self.release = release
+
+    def __iter__(self):
+        yield from self.response.stream
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            release, self.release = self.release, None
+            if release is not None:
+                release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, response: httpx.Response, release: Callable[[], None]):
+        self.response = response
+        self.release = release
+
+    async def __aiter__(self):
+        async for chunk in self.response.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.response.aclose()
+        finally:
+            release, self.release = self.release, None
+            if release is not None:
+                release()
+
+
+class PoolTransport(httpx.BaseTransport):
+    """httpx транспорт: кожен запит - на найменш завантажений endpoint пулу"""
+
+    def __init__(self, pool: EndpointPool, inner: Optional[httpx.BaseTransport] = None):
+        self.pool = pool
+        self.inner = inner or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        tried = set()
+        while True:
+            endpoint = self.pool.acquire(exclude=tried)
+            started = time.monotonic()
+            try:
+                response = self.inner.handle_request(self.pool.route(request, endpoint))
+            except CONNECT_ERRORS:
+                self.pool.release(endpoint, failed=True)
+                tried.add(endpoint)
+                if not self.pool.has_alternative(tried):
+                    raise
+                continue
+            except BaseException as e:
+                self.pool.release(endpoint, failed=isinstance(e, httpx.TransportError))
+                raise
+            failed = response.status_code in FAILURE_STATUSES
+            latency = time.monotonic() - started
+            return httpx.Response(
+                response.status_code, headers=response.headers,
+                stream=_ReleasingStream(response, lambda: self.pool.release(endpoint, failed, latency)),
+                extensions=response.extensions, request=request,
+            )
+
+    def close(self):
+        self.pool.close()
+        self.inner.close()
+
+
+class AsyncPoolTransport(httpx.AsyncBaseTransport):
+    """Async варіант PoolTransport (для AsyncOpenAI)"""
+
+    def __init__(self, pool: EndpointPool, inner: Optional[httpx.AsyncBaseTransport] = None):
+        self.pool = pool
+        self.inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        tried = set()
+        while True:
+            endpoint = await self.pool.acquire_async(exclude=tried)
+            started = time.monotonic()
+            try:
+                response = await self.inner.handle_async_request(self.pool.route(request, endpoint))
+            except CONNECT_ERRORS:
+                self.pool.release(endpoint, failed=True)
+                tried.add(endpoint)
+                if not self.pool.has_alternative(tried):
+                    raise
+                continue
+            except BaseException as e:
+                # Скасування (клієнт відключився) звільняє слот, але не є помилкою endpoint-а
+                self.pool.release(endpoint, failed=isinstance(e, httpx.TransportError))
+                raise
+            failed = response.status_code in FAILURE_STATUSES
+            latency = time.monotonic() - started
+            return httpx.Response(
+                response.status_code, headers=response.headers,
+                stream=_AsyncReleasingStream(response, lambda: self.pool.release(endpoint, failed, latency)),
+                extensions=response.extensions, request=request,
+            )
+
+    async def aclose(self):
+        self.pool.close()
+        await self.inner.aclose()
@@ -0,0 +1,109 @@
+"""
+Зважена справедлива черга (WFQ) викликів моделей між tenant-ами
+
+Коли квота моделі вичерпана (відро RateLimitScheduler у мінусі), запити не йдуть у порядку
+надходження: кожен отримує віртуальний час завершення
+    finish = max(V, finish_tenant) + tokens / weight
+і відправляється той, у кого він найменший. Tenant, що надіслав сотню великих запитів, не ставить
+інших за собою в чергу: інтерактивний запит іншого tenant-а обганяє його хвіст. Поки квоти вистачає,
+черги немає і запит іде одразу.
+
+Tenant - tenant_var (main.py: ключ API з X-API-Key / Authorization, інакше thread_id розмови
+або IP клієнта). Додатково кожен tenant може мати власний бюджет токенів за хвилину (TENANT_TPM):
+перевищення сповільнює тільки його.
+
+TENANT_WEIGHTS / TENANT_TPM: "default=1,key:3f2a9c1b0d4e=0.25" - tenant=значення, default - для решти.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import threading
+from typing import Optional
+
+tenant_var = contextvars.ContextVar("tenant", default=None)
+
+DEFAULT_TENANT = "default"
+MAX_TRACKED_TENANTS = 10000  # стан неактивних tenant-ів прибирається понад цю кількість
+
+
+def parse_tenant_values(spec: str) -> dict:
+    """"default=1,key:abc=0.25" -> {"default": 1.0, "key:abc": 0.25}"""
+    values = {}
+    for item in (spec or "").split(","):
+        tenant, _, value = item.strip().rpartition("=")
+        if tenant and value:
+            values[tenant] = float(value)
+    return values
+
+
+def current_tenant() -> str:
+    return tenant_var.get() or DEFAULT_TENANT
+
+
+class Ticket:
+    """Запит у черзі моделі; wake() будить його потік або задачу"""
+
+    def __init__(self, tenant: str, cost: float, finish: float, start: float, loop=None):
+        self.tenant = tenant
+        self.cost = cost
+        self.finish = finish
+        self.start = start
+        self.cancelled = False
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class FairQueue:
+    """Черга однієї моделі, впорядкована за віртуальним часом завершення (викликається під lock)"""
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        self._heap = []
+        self._finish = {}  # tenant -> finish останнього запиту
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, tenant: str, cost: float, weight: float, loop=None) -> Ticket:
+        start = max(self.virtual_time, self._finish.get(tenant, 0.0))
+        finish = start + max(cost, 1.0) / max(weight, 1e-6)
+        self._finish[tenant] = finish
+        ticket = Ticket(tenant, cost, finish, start, loop)
+        heapq.heappush(self._heap, (finish, next(self._order), ticket))
+        return ticket
+
+    def head(self) -> Optional[Ticket]:
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0][2] if self._heap else None
+
+    def pop(self) -> Ticket:
+        ticket = heapq.heappop(self._heap)[2]
+        self.virtual_time = max(self.virtual_time, ticket.start)
+        if len(self._finish) > MAX_TRACKED_TENANTS:
+            # Tenant без запитів попереду віртуального часу нічим не відрізняється від нового
+            self._finish = {t: f for t, f in self._finish.items() if f > self.virtual_time}
+        return ticket
+
+
+class TenantPolicy:
+    """Ваги tenant-ів і їх бюджети токенів за хвилину"""
+
+    def __init__(self, weights: Optional[dict] = None, tpm: Optional[dict] = None):
+        self.weights = dict(weights or {})
+        self.tpm = dict(tpm or {})
+
+    def weight(self, tenant: str) -> float:
+        return self.weights.get(tenant, self.weights.get(DEFAULT_TENANT, 1.0))
+
+    def budget(self, tenant: str) -> Optional[float]:
+        return self.tpm.get(tenant, self.tpm.get(DEFAULT_TENANT)) or None
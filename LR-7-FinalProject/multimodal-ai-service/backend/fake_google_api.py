@@ -0,0 +1,190 @@
+"""
+Локальний fake Google Calendar + Gmail API для офлайн тестування
+Запуск:  python fake_google_api.py --port 8765
+Backend: GOOGLE_API_ENDPOINT=http://127.0.0.1:8765/ python main.py
+
+Сервер приймає ті самі REST запити, що й справжні API (через googleapiclient
+з перевизначеним api_endpoint), зберігає події та листи в пам'яті і рахує
+TCP з'єднання - так можна перевірити, що клієнти перевикористовують з'єднання.
+"""
+
+import argparse
+import base64
+import json
+import re
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# googleapiclient з api_endpoint відкидає rootUrl/servicePath, тому маршрутизуємо за хвостом шляху
+CALENDAR_EVENTS_RE = re.compile(r"calendars/(?P<calendar_id>[^/]+)/events/?$")
+CALENDAR_EVENT_RE = re.compile(r"calendars/(?P<calendar_id>[^/]+)/events/(?P<event_id>[^/]+)/?$")
+GMAIL_SEND_RE = re.compile(r"users/(?P<user_id>[^/]+)/messages/send/?$")
+
+state_lock = threading.Lock()
+state = {
+    "events": {},  # calendar_id -> [event]
+    "messages": [],
+    "requests": 0,
+    "connections": 0,
+}
+
+
+def reset_state():
+    """Очистити всі збережені події, листи та лічильники"""
+    with state_lock:
+        state["events"] = {}
+        state["messages"] = []
+        state["requests"] = 0
+        state["connections"] = 0
+
+
+def find_event(calendar_id: str, event_id: str) -> Optional[dict]:
+    """Знайти подію за id"""
+    with state_lock:
+        for event in state["events"].get(calendar_id, []):
+            if event["id"] == event_id:
+                return event
+    return None
+
+
+def insert_event(calendar_id: str, body: dict) -> Optional[dict]:
+    """Створити подію як Calendar API events.insert (None - подія з таким id вже існує)"""
+    event_id = body.get("id") or uuid.uuid4().hex[:26]
+    if find_event(calendar_id, event_id):
+        return None
+    event = {
+        "kind": "calendar#event",
+        "id": event_id,
+        "status": "confirmed",
+        "htmlLink": f"https://calendar.google.com/calendar/event?eid={event_id}",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        **body,
+    }
+    with state_lock:
+        state["events"].setdefault(calendar_id, []).append(event)
+    return event
+
+
+def send_message(user_id: str, body: dict) -> dict:
+    """Відправити лист як Gmail API users.messages.send (raw MIME у base64url)"""
+    raw = body.get("raw", "")
+    parsed = message_from_bytes(base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4)))
+    payload = parsed.get_payload(decode=True) or b""
+    message = {
+        "id": uuid.uuid4().hex[:16],
+        "threadId": uuid.uuid4().hex[:16],
+        "labelIds": ["SENT"],
+        "to": parsed.get("to"),
+        "subject": parsed.get("subject"),
+        "body": payload.decode("utf-8", errors="replace"),
+        "userId": user_id,
+    }
+    with state_lock:
+        state["messages"].append(message)
+    return {key: message[key] for key in ("id", "threadId", "labelIds")}
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 - щоб клієнти могли тримати keep-alive з'єднання
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def setup(self):
+        super().setup()
+        # Заголовки і тіло пишуться окремо - без TCP_NODELAY кожна відповідь чекає delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with state_lock:
+            state["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _reply(self, status: int, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method: str):
+        with state_lock:
+            state["requests"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = self.path.split("?", 1)[0]
+        if path == "/_fake/state" and method == "GET":
+            with state_lock:
+                return self._reply(200, state)
+        if path == "/_fake/reset" and method == "POST":
+            reset_state()
+            return self._reply(200, {"status": "reset"})
+
+        match = CALENDAR_EVENT_RE.search(path)
+        if match and method == "GET":
+            event = find_event(match.group("calendar_id"), match.group("event_id"))
+            if event is None:
+                return self._reply(404, {"error": {"code": 404, "message": "Not Found"}})
+            return self._reply(200, event)
+
+        match = CALENDAR_EVENTS_RE.search(path)
+        if match:
+            calendar_id = match.group("calendar_id")
+            if method == "POST":
+                event = insert_event(calendar_id, self._read_json())
+                if event is None:
+                    return self._reply(409, {"error": {"code": 409, "message": "The requested identifier already exists."}})
+                return self._reply(200, event)
+            with state_lock:
+                items = list(state["events"].get(calendar_id, []))
+            return self._reply(200, {"kind": "calendar#events", "items": items})
+
+        match = GMAIL_SEND_RE.search(path)
+        if match and method == "POST":
+            return self._reply(200, send_message(match.group("user_id"), self._read_json()))
+
+        self._reply(404, {"error": {"code": 404, "message": f"Not found: {method} {path}"}})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+
+def run_server(host: str = "127.0.0.1", port: int = 8765, latency_ms: float = 0.0) -> ThreadingHTTPServer:
+    """Запустити fake сервер у фоновому потоці (зручно для скриптів і тестів)"""
+    FakeGoogleHandler.latency = latency_ms / 1000.0
+    server = ThreadingHTTPServer((host, port), FakeGoogleHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Google Calendar + Gmail API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Штучна затримка на кожен запит")
+    args = parser.parse_args()
+
+    FakeGoogleHandler.latency = args.latency_ms / 1000.0
+    server = ThreadingHTTPServer((args.host, args.port), FakeGoogleHandler)
+    print(f"🧪 Fake Google API: http://{args.host}:{args.port}/")
+    print(f"   Backend: GOOGLE_API_ENDPOINT=http://{args.host}:{args.port}/ python main.py")
+    print(f"   Стан: GET http://{args.host}:{args.port}/_fake/state")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,265 @@
+"""
+Локальний Redis-сумісний сервер (підмножина команд) для тестування STATE_BACKEND=redis
+Запуск:  python fake_redis_server.py --port 6390
+Backend: STATE_BACKEND=redis STATE_REDIS_URL=redis://127.0.0.1:6390/0 python main.py
+
+Підтримує команди, які використовує state_store.RedisStateStore (hash, list, MULTI/EXEC),
+плюс PING / HELLO / CLIENT / SELECT для рукостискання redis-py. Дані - в пам'яті процесу,
+кожна команда (і кожен MULTI/EXEC блок) виконується під одним lock, тобто атомарно.
+"""
+
+import argparse
+import socketserver
+import threading
+
+state_lock = threading.Lock()
+data = {}  # key -> dict (hash) | list | str
+stats = {"commands": 0, "connections": 0}
+
+
+class CommandError(Exception):
+    """Помилка команди (відповідь -ERR ...)"""
+
+
+def reset_state():
+    """Очистити всі дані та лічильники"""
+    with state_lock:
+        data.clear()
+        stats.update({"commands": 0, "connections": 0})
+
+
+# ==================== RESP ====================
+def encode(value, resp3: bool = False) -> bytes:
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(value, CommandError):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, bool):
+        return b":1\r\n" if value else b":0\r\n"
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, str):
+        raw = value.encode("utf-8")
+        return b"$" + str(len(raw)).encode() + b"\r\n" + raw + b"\r\n"
+    if isinstance(value, (list, tuple)):
+        return b"*" + str(len(value)).encode() + b"\r\n" + b"".join(encode(item, resp3) for item in value)
+    raise TypeError(f"Не вмію кодувати {type(value)}")
+
+
+OK = b"+OK\r\n"
+QUEUED = b"+QUEUED\r\n"
+
+
+def read_command(rfile):
+    """Прочитати масив RESP (або inline команду); None - з'єднання закрито"""
+    line = rfile.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.decode("utf-8").split()
+    args = []
+    for _ in range(int(line[1:])):
+        header = rfile.readline()
+        length = int(header[1:])
+        args.append(rfile.read(length + 2)[:-2].decode("utf-8"))
+    return args
+
+
+# ==================== COMMANDS ====================
+def _typed(key: str, kind: type, create: bool = False):
+    value = data.get(key)
+    if value is None:
+        if not create:
+            return None
+        value = data[key] = kind()
+    if not isinstance(value, kind):
+        raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+    return value
+
+
+def _range(length: int, start: int, stop: int) -> tuple:
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop = length + stop
+    return start, min(stop + 1, length)
+
+
+def execute(args: list):
+    """Виконати одну команду (викликається під state_lock)"""
+    command, args = args[0].upper(), args[1:]
+    stats["commands"] += 1
+
+    if command == "PING":
+        return args[0] if args else b"+PONG\r\n"
+    if command in ("CLIENT", "SELECT", "AUTH"):
+        return OK
+    if command == "FLUSHDB" or command == "FLUSHALL":
+        data.clear()
+        return OK
+    if command == "DBSIZE":
+        return len(data)
+    if command == "EXISTS":
+        return sum(1 for key in args if key in data)
+    if command == "DEL":
+        return sum(1 for key in args if data.pop(key, None) is not None)
+    if command == "GET":
+        return _typed(args[0], str)
+    if command == "SET":
+        data[args[0]] = args[1]
+        return OK
+
+    if command == "HGET":
+        return (_typed(args[0], dict) or {}).get(args[1])
+    if command == "HSET":
+        target = _typed(args[0], dict, create=True)
+        added = 0
+        for field, value in zip(args[1::2], args[2::2]):
+            added += field not in target
+            target[field] = value
+        return added
+    if command == "HSETNX":
+        target = _typed(args[0], dict, create=True)
+        if args[1] in target:
+            return 0
+        target[args[1]] = args[2]
+        return 1
+    if command == "HDEL":
+        target = _typed(args[0], dict) or {}
+        removed = sum(1 for field in args[1:] if target.pop(field, None) is not None)
+        if not target:
+            data.pop(args[0], None)
+        return removed
+    if command == "HGETALL":
+        target = _typed(args[0], dict) or {}
+        return [item for pair in target.items() for item in pair]
+    if command == "HLEN":
+        return len(_typed(args[0], dict) or {})
+
+    if command == "RPUSH":
+        target = _typed(args[0], list, create=True)
+        target.extend(args[1:])
+        return len(target)
+    if command == "LRANGE":
+        target = _typed(args[0], list) or []
+        begin, end = _range(len(target), int(args[1]), int(args[2]))
+        return target[begin:end]
+    if command == "LLEN":
+        return len(_typed(args[0], list) or [])
+    if command == "LINDEX":
+        target = _typed(args[0], list) or []
+        index = int(args[1])
+        return target[index] if -len(target) <= index < len(target) else None
+    if command == "LSET":
+        target = _typed(args[0], list)
+        if target is None:
+            raise CommandError("ERR no such key")
+        index = int(args[1])
+        if not -len(target) <= index < len(target):
+            raise CommandError("ERR index out of range")
+        target[index] = args[2]
+        return OK
+    if command == "LREM":
+        target = _typed(args[0], list) or []
+        count, value = int(args[1]), args[2]
+        positions = [i for i, item in enumerate(target) if item == value]
+        if count > 0:
+            positions = positions[:count]
+        elif count < 0:
+            positions = positions[count:]
+        for i in reversed(positions):
+            del target[i]
+        if not target:
+            data.pop(args[0], None)
+        return len(positions)
+
+    raise CommandError(f"ERR unknown command '{command.lower()}'")
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Одне з'єднання клієнта; MULTI ставить команди в чергу до EXEC"""
+
+    def handle(self):
+        with state_lock:
+            stats["connections"] += 1
+        self.resp3 = False
+        queued = None
+        while True:
+            args = read_command(self.rfile)
+            if args is None:
+                return
+            if not args:
+                continue
+            command = args[0].upper()
+            if command == "QUIT":
+                self.wfile.write(OK)
+                return
+            if command == "HELLO":
+                self.wfile.write(self._hello(args))
+                continue
+            if command == "MULTI":
+                queued = []
+                self.wfile.write(OK)
+                continue
+            if command == "DISCARD":
+                queued = None
+                self.wfile.write(OK)
+                continue
+            if command == "EXEC":
+                with state_lock:
+                    results = [self._safe_execute(queued_args, self.resp3) for queued_args in queued or []]
+                queued = None
+                self.wfile.write(b"*" + str(len(results)).encode() + b"\r\n" + b"".join(results))
+                continue
+            if queued is not None:
+                queued.append(args)
+                self.wfile.write(QUEUED)
+                continue
+            with state_lock:
+                self.wfile.write(self._safe_execute(args, self.resp3))
+
+    @staticmethod
+    def _safe_execute(args: list, resp3: bool) -> bytes:
+        try:
+            result = execute(args)
+        except CommandError as error:
+            return encode(error)
+        except (IndexError, ValueError):
+            return encode(CommandError(f"ERR wrong arguments for '{args[0].lower()}' command"))
+        return result if isinstance(result, bytes) else encode(result, resp3)
+
+    def _hello(self, args: list) -> bytes:
+        # redis-py 8 починає з HELLO 3 (RESP3): відповідь - map, null - "_", решта типів як у RESP2
+        protocol = int(args[1]) if len(args) > 1 else 2
+        self.resp3 = protocol == 3
+        info = ["server", "redis", "version", "7.2.0", "proto", protocol, "mode", "standalone", "role", "master"]
+        if protocol == 3:
+            return b"%" + str(len(info) // 2).encode() + b"\r\n" + b"".join(encode(item) for item in info)
+        return encode(info)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def run_server(host: str = "127.0.0.1", port: int = 6390) -> FakeRedisServer:
+    """Запустити сервер у фоновому потоці (зручно для скриптів)"""
+    server = FakeRedisServer((host, port), FakeRedisHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Redis-сумісний fake сервер для STATE_BACKEND=redis")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    server = FakeRedisServer((args.host, args.port), FakeRedisHandler)
+    print(f"🧪 Fake Redis: redis://{args.host}:{args.port}/0")
+    print(f"   Backend: STATE_BACKEND=redis STATE_REDIS_URL=redis://{args.host}:{args.port}/0 python main.py")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
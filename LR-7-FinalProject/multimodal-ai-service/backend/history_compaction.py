@@ -0,0 +1,140 @@
+"""
+Стиснення старих ходів розмови у зведення (rolling summary)
+
+Замість обрізання історії до останніх N повідомлень (контекст губиться різко, а N повних
+повідомлень все одно йдуть у кожен запит) модель бачить:
+    system prompt + зведення старих ходів + дослівний хвіст розмови.
+
+Коли хвіст перевищує бюджет токенів, фонова задача (main.py) віддає дешевій моделі старе
+зведення і ходи, що виходять з хвоста, - і отримує оновлене зведення. Кожен хід стискається
+один раз: зведення оновлюється інкрементально, а не перераховується з усієї історії.
+Поки зведення не готове, хвіст обрізається за жорстким лімітом (trim_tail).
+
+Межі хвоста - тільки на повідомленнях user: хід (user -> assistant з tool_calls -> tool)
+не розривається, тож модель не отримує tool повідомлень без виклику.
+Токени оцінюються приблизно (символи / 4), як у rate_limiter.py.
+"""
+
+import json
+from typing import List, Optional
+
+# Оцінка одного зображення (detail=auto, 1024x1024) і накладні витрати повідомлення
+IMAGE_TOKENS = 765
+MESSAGE_OVERHEAD_TOKENS = 4
+# Скільки символів одного повідомлення потрапляє у запит на стиснення
+TRANSCRIPT_MESSAGE_CHARS = 2000
+
+SUMMARY_HEADER = "Summary of the earlier conversation (older messages are not shown):"
+
+SUMMARY_INSTRUCTIONS = """You maintain a running summary of a conversation between a user and an AI assistant.
+Update the existing summary with the new messages and return only the updated summary.
+
+Keep every concrete fact the assistant may need later: names, email addresses, phone numbers,
+dates and times, prices, item names and quantities, documents discussed, decisions, actions
+performed by tools (emails sent, meetings booked) and requests that are still open.
+Drop greetings and small talk. Never drop a fact from the existing summary unless the new
+messages correct it. Write in the language of the conversation, as short bullet points,
+at most 250 words."""
+
+
+def _text(content) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(
+            part.get("text", "") if isinstance(part, dict) else str(part)
+            for part in content
+            if not (isinstance(part, dict) and part.get("type") == "image_url")
+        )
+    return "" if content is None else str(content)
+
+
+def _images(content) -> int:
+    if not isinstance(content, list):
+        return 0
+    return sum(1 for part in content if isinstance(part, dict) and part.get("type") == "image_url")
+
+
+def message_tokens(message: dict) -> int:
+    """Оцінка токенів повідомлення (текст / 4, зображення - IMAGE_TOKENS)"""
+    content = message.get("content")
+    tokens = MESSAGE_OVERHEAD_TOKENS + len(_text(content)) // 4 + IMAGE_TOKENS * _images(content)
+    if message.get("tool_calls"):
+        tokens += len(json.dumps(message["tool_calls"], ensure_ascii=False)) // 4
+    return tokens
+
+
+def history_tokens(messages: List[dict]) -> int:
+    return sum(message_tokens(message) for message in messages)
+
+
+def _turn_starts(messages: List[dict], start: int) -> List[int]:
+    return [i for i in range(start, len(messages)) if messages[i].get("role") == "user"]
+
+
+def choose_cut(messages: List[dict], covered: int, keep_tokens: int) -> int:
+    """
+    Позиція, з якої повідомлення лишаються дослівно після стиснення
+
+    Найраніший початок ходу, після якого хвіст вміщується в keep_tokens (останній хід
+    лишається завжди); covered - якщо стискати нічого.
+    """
+    cut = covered
+    tail = 0
+    end = len(messages)
+    for position in reversed(_turn_starts(messages, covered + 1)):
+        tail += history_tokens(messages[position:end])
+        end = position
+        if tail > keep_tokens and cut != covered:
+            break
+        cut = position
+    return cut
+
+
+def trim_tail(messages: List[dict], max_tokens: int) -> List[dict]:
+    """Відкинути найстаріші ходи, поки хвіст більший за max_tokens (останній хід лишається)"""
+    if not max_tokens or history_tokens(messages) <= max_tokens:
+        return messages
+    for position in _turn_starts(messages, 1):
+        if history_tokens(messages[position:]) <= max_tokens:
+            return messages[position:]
+    starts = _turn_starts(messages, 0)
+    return messages[starts[-1]:] if starts else messages
+
+
+def render_transcript(messages: List[dict]) -> str:
+    """Ходи для запиту на стиснення: "role: текст" (довгі повідомлення обрізаються)"""
+    lines = []
+    for message in messages:
+        role = message.get("role", "unknown")
+        text = _text(message.get("content"))
+        if _images(message.get("content")):
+            text += " [image]"
+        for call in message.get("tool_calls") or []:
+            function = call.get("function", {})
+            text += f" [calls {function.get('name')}({function.get('arguments', '')})]"
+        if role == "tool":
+            role = f"tool {message.get('name') or message.get('tool_call_id', '')}".strip()
+        if len(text) > TRANSCRIPT_MESSAGE_CHARS:
+            text = text[:TRANSCRIPT_MESSAGE_CHARS] + "..."
+        if text.strip():
+            lines.append(f"{role}: {text.strip()}")
+    return "\n".join(lines)
+
+
+def summary_request(previous_summary: Optional[str], messages: List[dict]) -> List[dict]:
+    """messages для дешевої моделі: старе зведення + нові ходи -> оновлене зведення"""
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": (
+            f"Existing summary:\n{previous_summary or '(empty)'}\n\n"
+            f"New messages:\n{render_transcript(messages)}"
+        )},
+    ]
+
+
+def summary_message(summary: Optional[str]) -> Optional[dict]:
+    """System повідомлення зі зведенням (після system prompt, перед хвостом)"""
+    if not summary:
+        return None
+    return {"role": "system", "content": f"{SUMMARY_HEADER}\n{summary}"}
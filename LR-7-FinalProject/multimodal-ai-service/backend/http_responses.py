@@ -0,0 +1,123 @@
+"""
+Швидкі JSON відповіді та стиснення великих відповідей
+
+FastJSONResponse серіалізує через orjson (у кілька разів швидше за json.dumps і одразу в bytes),
+без orjson - json.dumps з тими ж параметрами, що й стандартний JSONResponse. Endpoint, що
+повертає FastJSONResponse з уже JSON-сумісними даними (історія, галерея), пропускає ще й
+jsonable_encoder FastAPI - рекурсивний обхід кожного поля відповіді.
+
+CompressionMiddleware стискає відповіді, більші за minimum_size: brotli (якщо встановлено пакет
+brotli і клієнт надсилає Accept-Encoding: br), інакше gzip. Стискаються тільки відповіді з
+Content-Length - стріми (SSE /chat/stream) проходять без змін і без буферизації.
+"""
+
+import asyncio
+import gzip
+import json
+from typing import Any
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+# Стиснення більших тіл - у потоці, щоб не тримати event loop
+THREAD_MINIMUM_SIZE = 256 * 1024
+# Уже стиснені або потокові типи
+SKIP_CONTENT_TYPES = ("image/", "audio/", "video/", "text/event-stream", "application/zip", "application/gzip")
+
+
+def dumps(content: Any) -> bytes:
+    """JSON у bytes (UTF-8, без пробілів)"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse з серіалізацією через orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        # quality 5 - майже розмір максимального стиснення за малу частку часу
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+class CompressionMiddleware:
+    """ASGI middleware: brotli / gzip для відповідей від minimum_size байт"""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    def _encoding(self, scope) -> str:
+        accepted = Headers(scope=scope).get("accept-encoding", "")
+        tokens = {token.split(";")[0].strip().lower() for token in accepted.split(",")}
+        if BROTLI_AVAILABLE and "br" in tokens:
+            return "br"
+        if "gzip" in tokens:
+            return "gzip"
+        return ""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.minimum_size:
+            await self.app(scope, receive, send)
+            return
+        encoding = self._encoding(scope)
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        chunks = []
+
+        async def compressing_send(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                size = headers.get("content-length", "")
+                # Стискаються тільки відповіді з відомою довжиною - стріми не буферизуються
+                if (
+                    size.isdigit() and int(size) >= self.minimum_size
+                    and "content-encoding" not in headers
+                    and not headers.get("content-type", "").startswith(SKIP_CONTENT_TYPES)
+                ):
+                    start_message = message
+                    return
+            if start_message is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+            # BaseHTTPMiddleware віддає тіло шматками - зібрати до кінця
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            if len(body) >= THREAD_MINIMUM_SIZE:
+                body = await asyncio.to_thread(_compress, body, encoding)
+            else:
+                body = _compress(body, encoding)
+            headers = MutableHeaders(raw=list(start_message["headers"]))
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send({**start_message, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, compressing_send)
@@ -0,0 +1,488 @@
+"""
+Запис і відтворення (record/replay) трафіку OpenAI та Google API
+
+Режими (LLM_CASSETTE_MODE):
+- off     - звичайна робота (за замовчуванням)
+- record  - кожна пара запит/відповідь з таймінгами дописується в касету (JSONL)
+- replay  - відповіді беруться з касети, мережа не використовується
+
+Касета - JSONL, один рядок на взаємодію. Stream відповіді (SSE) зберігаються
+по chunks з часом кожного chunk, тому при відтворенні можна зберегти реальний
+time-to-first-token. Затримка при відтворенні (LLM_CASSETTE_LATENCY):
+  none - миттєво, recorded - як при записі, scaled:0.5 - записана затримка * коефіцієнт
+
+Підбір запису при відтворенні: спочатку точний збіг (метод, шлях, тіло), інакше
+наступний запис з тим самим методом, шляхом і формою запиту - stream, роль останнього
+повідомлення, наявність tools (тіла /chat рідко збігаються точно: відрізняються текст
+повідомлення, історія та контекст RAG). Коли записи вичерпано, вони використовуються
+по колу - так одна касета може навантажувати backend скільки завгодно довго.
+
+OpenAI: httpx транспорт (CassetteTransport / AsyncCassetteTransport) для http_client клієнта.
+Google: обгортка над httplib2 (CassetteHttp), яку приймає googleapiclient.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+# Префікс версії Google API (/calendar/v3, /gmail/v1) - fake_google_api його не має
+_GOOGLE_PREFIX = re.compile(r"^/[a-z]+/v\d+(?=/)")
+
+# Заголовки, які не потрапляють у касету
+REDACTED_HEADERS = {"authorization", "api-key", "openai-api-key", "cookie", "set-cookie", "x-goog-api-key"}
+
+
+class CassetteMiss(httpx.TransportError):
+    """У касеті немає запису для запиту"""
+
+
+def _encode_body(data: bytes) -> dict:
+    if not data:
+        return {"text": ""}
+    try:
+        return {"text": data.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(data).decode("ascii")}
+
+
+def _decode_body(body: Optional[dict]) -> bytes:
+    if not body:
+        return b""
+    if "base64" in body:
+        return base64.b64decode(body["base64"])
+    return body.get("text", "").encode("utf-8")
+
+
+def _clean_headers(headers) -> dict:
+    return {key.lower(): value for key, value in headers.items() if key.lower() not in REDACTED_HEADERS}
+
+
+def _route_path(service: str, url) -> str:
+    path = urlsplit(str(url)).path
+    return _GOOGLE_PREFIX.sub("", path) if service == "google" else path
+
+
+def _body_hash(data: bytes) -> str:
+    return hashlib.sha256(data or b"").hexdigest()[:16]
+
+
+def _body_shape(data: bytes) -> str:
+    """Форма JSON запиту без змінного тексту: stream чи ні, роль останнього повідомлення, є tools"""
+    try:
+        payload = json.loads(data) if data else None
+    except ValueError:
+        return ""
+    if not isinstance(payload, dict):
+        return ""
+    messages = payload.get("messages") or [{}]
+    last_role = messages[-1].get("role", "") if isinstance(messages[-1], dict) else ""
+    return f"stream={bool(payload.get('stream'))};last={last_role};tools={bool(payload.get('tools'))}"
+
+
+class Cassette:
+    """Файл касети: запис взаємодій і підбір відповіді для відтворення"""
+
+    def __init__(self, path: str, mode: str = "record", latency: str = "none"):
+        self.path = path
+        self.mode = mode
+        self.latency_factor = self._parse_latency(latency)
+        self._lock = threading.Lock()
+        self._by_route = defaultdict(list)  # (service, method, path) -> [interaction]
+        self._cursor = defaultdict(int)
+        self._used = set()
+        if mode == "replay":
+            self._load()
+        elif mode == "record":
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _parse_latency(spec: str) -> float:
+        if spec == "recorded":
+            return 1.0
+        if spec.startswith("scaled:"):
+            return float(spec.split(":", 1)[1])
+        return 0.0
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"Касета не знайдена: {self.path}")
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    item = json.loads(line)
+                    request = item["request"]
+                    self._by_route[(item["service"], request["method"], request["path"])].append(item)
+
+    def __len__(self):
+        return sum(len(items) for items in self._by_route.values())
+
+    # ----- record -----
+    def record(self, service: str, method: str, url: str, request_headers, request_body: bytes,
+               status: int, response_headers, response_body: Optional[bytes] = None,
+               chunks: Optional[list] = None, ttfb_ms: float = 0.0, total_ms: float = 0.0):
+        response = {"status": status, "headers": _clean_headers(response_headers)}
+        if chunks is not None:
+            response["chunks"] = chunks
+        else:
+            response["body"] = _encode_body(response_body or b"")
+        item = {
+            "id": uuid.uuid4().hex[:12],
+            "ts": time.time(),
+            "service": service,
+            "request": {
+                "method": method,
+                "url": str(url),
+                "path": _route_path(service, url),
+                "headers": _clean_headers(request_headers),
+                "body": _encode_body(request_body),
+                "body_hash": _body_hash(request_body),
+                "shape": _body_shape(request_body),
+            },
+            "response": response,
+            "timing": {"ttfb_ms": round(ttfb_ms, 2), "total_ms": round(total_ms, 2)},
+        }
+        line = json.dumps(item, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    # ----- replay -----
+    def match(self, service: str, method: str, url: str, body: bytes) -> dict:
+        """Запис для запиту: точний збіг тіла, інакше наступний з тією ж формою запиту (по колу)"""
+        route = (service, method, _route_path(service, url))
+        with self._lock:
+            items = self._by_route.get(route)
+            if not items:
+                raise CassetteMiss(f"Касета {self.path}: немає запису для {method} {route[2]}")
+            body_hash = _body_hash(body)
+            for item in items:
+                if item["id"] not in self._used and item["request"]["body_hash"] == body_hash:
+                    self._used.add(item["id"])
+                    return item
+            shape = _body_shape(body)
+            candidates = [item for item in items if item["request"].get("shape", "") == shape] or items
+            key = route + (shape,)
+            item = candidates[self._cursor[key] % len(candidates)]
+            self._cursor[key] += 1
+            self._used.add(item["id"])
+            if len(self._used) >= len(self):
+                self._used.clear()
+            return item
+
+    def delay(self, milliseconds: float) -> float:
+        """Затримка відтворення в секундах"""
+        return max(milliseconds, 0.0) / 1000.0 * self.latency_factor
+
+    def replay_chunks(self, item: dict):
+        """(затримка перед chunk, байти) для stream відповіді"""
+        previous = 0.0
+        for chunk in item["response"].get("chunks", []):
+            yield self.delay(chunk["t"] - previous), _decode_body(chunk)
+            previous = chunk["t"]
+
+
+# ==================== OPENAI (httpx) ====================
+def _is_stream(response_headers) -> bool:
+    return "text/event-stream" in response_headers.get("content-type", "")
+
+
+def _replay_headers(item: dict) -> list:
+    # Тіло відтворюється розпакованим і без chunked-кодування
+    skip = {"content-length", "content-encoding", "transfer-encoding"}
+    return [(key, value) for key, value in item["response"]["headers"].items() if key not in skip]
+
+
+class _RecordingStream(httpx.SyncByteStream):
+    """Записує chunks stream відповіді; час chunk - сумарне очікування upstream, без пауз споживача"""
+
+    def __init__(self, cassette, request, response, body, headers_ms):
+        self.cassette, self.request, self.response, self.body = cassette, request, response, body
+        self.elapsed = headers_ms
+        self.chunks = []
+
+    def __iter__(self):
+        iterator = iter(self.response.stream)
+        while True:
+            started = time.perf_counter()
+            try:
+                data = next(iterator)
+            except StopIteration:
+                break
+            self.elapsed += (time.perf_counter() - started) * 1000
+            self.chunks.append({"t": round(self.elapsed, 2), **_encode_body(data)})
+            yield data
+
+    def close(self):
+        self.response.close()
+        _record_stream(self)
+
+
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+    def __init__(self, cassette, request, response, body, headers_ms):
+        self.cassette, self.request, self.response, self.body = cassette, request, response, body
+        self.elapsed = headers_ms
+        self.chunks = []
+
+    async def __aiter__(self):
+        iterator = self.response.stream.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                data = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            self.elapsed += (time.perf_counter() - started) * 1000
+            self.chunks.append({"t": round(self.elapsed, 2), **_encode_body(data)})
+            yield data
+
+    async def aclose(self):
+        await self.response.aclose()
+        _record_stream(self)
+
+
+def _record_stream(stream):
+    ttfb = stream.chunks[0]["t"] if stream.chunks else stream.elapsed
+    stream.cassette.record(
+        "openai", stream.request.method, stream.request.url, stream.request.headers, stream.body,
+        stream.response.status_code, stream.response.headers, chunks=stream.chunks,
+        ttfb_ms=ttfb, total_ms=stream.elapsed,
+    )
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    def __init__(self, cassette, item):
+        self.cassette, self.item = cassette, item
+
+    def __iter__(self):
+        for delay, data in self.cassette.replay_chunks(self.item):
+            if delay:
+                time.sleep(delay)
+            yield data
+
+
+class _AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, cassette, item):
+        self.cassette, self.item = cassette, item
+
+    async def __aiter__(self):
+        import asyncio
+        for delay, data in self.cassette.replay_chunks(self.item):
+            if delay:
+                await asyncio.sleep(delay)
+            yield data
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """httpx транспорт для OpenAI клієнта: запис через inner транспорт або відтворення з касети"""
+
+    def __init__(self, cassette: Cassette, inner: Optional[httpx.BaseTransport] = None):
+        self.cassette = cassette
+        self.inner = inner or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = request.read()
+        if self.cassette.mode == "replay":
+            item = self.cassette.match("openai", request.method, request.url, body)
+            if "chunks" in item["response"]:
+                return httpx.Response(item["response"]["status"], headers=_replay_headers(item),
+                                      stream=_ReplayStream(self.cassette, item), request=request)
+            time.sleep(self.cassette.delay(item["timing"]["total_ms"]))
+            return httpx.Response(item["response"]["status"], headers=_replay_headers(item),
+                                  content=_decode_body(item["response"]["body"]), request=request)
+
+        # Без стиснення - касету можна читати і редагувати
+        request.headers["accept-encoding"] = "identity"
+        started = time.perf_counter()
+        response = self.inner.handle_request(request)
+        if _is_stream(response.headers):
+            return httpx.Response(response.status_code, headers=response.headers,
+                                  stream=_RecordingStream(self.cassette, request, response, body,
+                                                         (time.perf_counter() - started) * 1000),
+                                  extensions=response.extensions, request=request)
+        content = response.read()
+        response.close()
+        total = (time.perf_counter() - started) * 1000
+        self.cassette.record("openai", request.method, request.url, request.headers, body,
+                             response.status_code, response.headers, response_body=content,
+                             ttfb_ms=total, total_ms=total)
+        return httpx.Response(response.status_code, headers=response.headers, content=content,
+                              extensions=response.extensions, request=request)
+
+    def close(self):
+        self.inner.close()
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """Async варіант CassetteTransport (для AsyncOpenAI)"""
+
+    def __init__(self, cassette: Cassette, inner: Optional[httpx.AsyncBaseTransport] = None):
+        self.cassette = cassette
+        self.inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        import asyncio
+        body = await request.aread()
+        if self.cassette.mode == "replay":
+            item = self.cassette.match("openai", request.method, request.url, body)
+            if "chunks" in item["response"]:
+                return httpx.Response(item["response"]["status"], headers=_replay_headers(item),
+                                      stream=_AsyncReplayStream(self.cassette, item), request=request)
+            await asyncio.sleep(self.cassette.delay(item["timing"]["total_ms"]))
+            return httpx.Response(item["response"]["status"], headers=_replay_headers(item),
+                                  content=_decode_body(item["response"]["body"]), request=request)
+
+        request.headers["accept-encoding"] = "identity"
+        started = time.perf_counter()
+        response = await self.inner.handle_async_request(request)
+        if _is_stream(response.headers):
+            return httpx.Response(response.status_code, headers=response.headers,
+                                  stream=_AsyncRecordingStream(self.cassette, request, response, body,
+                                                              (time.perf_counter() - started) * 1000),
+                                  extensions=response.extensions, request=request)
+        content = await response.aread()
+        await response.aclose()
+        total = (time.perf_counter() - started) * 1000
+        self.cassette.record("openai", request.method, request.url, request.headers, body,
+                             response.status_code, response.headers, response_body=content,
+                             ttfb_ms=total, total_ms=total)
+        return httpx.Response(response.status_code, headers=response.headers, content=content,
+                              extensions=response.extensions, request=request)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+# ==================== GOOGLE (httplib2) ====================
+class _ReplayResponse(dict):
+    """Мінімальний замінник httplib2.Response (dict заголовків + status/reason)"""
+
+    def __init__(self, status: int, headers: dict):
+        super().__init__(headers)
+        self["status"] = str(status)
+        self.status = status
+        self.reason = "OK" if status < 400 else "Error"
+
+
+class CassetteHttp:
+    """Обгортка над httplib2.Http / AuthorizedHttp для googleapiclient"""
+
+    def __init__(self, cassette: Cassette, inner=None):
+        self.cassette = cassette
+        self.inner = inner
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None, **kwargs):
+        data = body.encode("utf-8") if isinstance(body, str) else (body or b"")
+        if self.cassette.mode == "replay":
+            item = self.cassette.match("google", method, uri, data)
+            time.sleep(self.cassette.delay(item["timing"]["total_ms"]))
+            response = item["response"]
+            return _ReplayResponse(response["status"], response["headers"]), _decode_body(response["body"])
+
+        started = time.perf_counter()
+        response, content = self.inner.request(uri, method=method, body=body, headers=headers,
+                                               redirections=redirections, connection_type=connection_type, **kwargs)
+        total = (time.perf_counter() - started) * 1000
+        response_headers = {key: value for key, value in dict(response).items() if key != "status"}
+        self.cassette.record("google", method, uri, headers or {}, data, int(response.status),
+                             response_headers, response_body=content, ttfb_ms=total, total_ms=total)
+        return response, content
+
+    def __getattr__(self, name):
+        # credentials, timeout, close() тощо - від внутрішнього http
+        if self.inner is None:
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+
+# ==================== CONFIGURATION ====================
+_cassette: Optional[Cassette] = None
+
+
+def get_cassette() -> Optional[Cassette]:
+    """Касета з LLM_CASSETTE_MODE / LLM_CASSETTE_PATH / LLM_CASSETTE_LATENCY (None якщо вимкнено)"""
+    global _cassette
+    mode = os.getenv("LLM_CASSETTE_MODE", "off").lower()
+    if mode not in ("record", "replay"):
+        return None
+    if _cassette is None:
+        _cassette = Cassette(
+            os.getenv("LLM_CASSETTE_PATH", "./cassettes/session.jsonl"),
+            mode=mode,
+            latency=os.getenv("LLM_CASSETTE_LATENCY", "none"),
+        )
+    return _cassette
+
+
+def wrap_openai_transport(transport: httpx.BaseTransport) -> httpx.BaseTransport:
+    """Обгорнути httpx транспорт OpenAI касетою (без касети - повертає як є)"""
+    cassette = get_cassette()
+    if cassette is None:
+        return transport
+    return CassetteTransport(cassette, transport)
+
+
+def wrap_async_openai_transport(transport: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+    """Async варіант wrap_openai_transport"""
+    cassette = get_cassette()
+    if cassette is None:
+        return transport
+    return AsyncCassetteTransport(cassette, transport)
+
+
+def wrap_google_http(http):
+    """Обгорнути httplib2 http для googleapiclient (без касети - повертає як є)"""
+    cassette = get_cassette()
+    if cassette is None:
+        return http
+    return CassetteHttp(cassette, http)
+
+
+def summarize(path: str) -> dict:
+    """Статистика касети: кількість взаємодій і таймінги по маршрутах"""
+    routes = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "ttfb_ms": 0.0, "bytes": 0, "streams": 0})
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            route = routes[f"{item['service']} {item['request']['method']} {item['request']['path']}"]
+            route["count"] += 1
+            route["total_ms"] += item["timing"]["total_ms"]
+            route["ttfb_ms"] += item["timing"]["ttfb_ms"]
+            response = item["response"]
+            if "chunks" in response:
+                route["streams"] += 1
+                route["bytes"] += sum(len(_decode_body(chunk)) for chunk in response["chunks"])
+            else:
+                route["bytes"] += len(_decode_body(response.get("body")))
+    return {
+        name: {
+            "count": route["count"],
+            "streams": route["streams"],
+            "avg_total_ms": round(route["total_ms"] / route["count"], 1),
+            "avg_ttfb_ms": round(route["ttfb_ms"] / route["count"], 1),
+            "avg_bytes": route["bytes"] // route["count"],
+        }
+        for name, route in routes.items()
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Статистика касети LLM/Google трафіку")
+    parser.add_argument("path", nargs="?", default=os.getenv("LLM_CASSETTE_PATH", "./cassettes/session.jsonl"))
+    args = parser.parse_args()
+    print(json.dumps(summarize(args.path), ensure_ascii=False, indent=2))
@@ -0,0 +1,353 @@
+"""
+Навантажувальний тест backend: /chat, /chat/stream, /upload_documents
+Без витрат на API - з --spawn запускає mock_openai_server.py і backend (uvicorn) на вільних портах.
+
+    python load_test.py --spawn --scenario chat --scenario stream --concurrency 32 --requests 500
+    python load_test.py --spawn --latency lognormal:300,0.4 --token-ms 10 --duration 30
+    python load_test.py --url http://127.0.0.1:8000 --pid 12345 --scenario upload
+    python load_test.py --spawn --cassette cassettes/chat.jsonl --cassette-mode record
+    python load_test.py --spawn --cassette cassettes/chat.jsonl --cassette-latency recorded
+
+Звіт: RPS, p50/p90/p99 латентність, time-to-first-byte для SSE, помилки,
+а також RSS backend процесу до/після та приріст пам'яті на один thread_id розмови.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from typing import Optional
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ("chat", "stream", "upload")
+
+CHAT_MESSAGES = [
+    "Скільки коштує iphone 15?",
+    "Порахуй доставку macbook pro до Києва",
+    "Привіт! Що ти вмієш?",
+    "Надішли лист з підсумком на test@example.com",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_rss(pid: Optional[int]) -> Optional[int]:
+    """RSS процесу в байтах (Linux /proc, інакше psutil якщо встановлено)"""
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil  # type: ignore
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+def percentile(values: list, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Results:
+    """Латентності та помилки по сценарію"""
+
+    def __init__(self):
+        self.latencies = {name: [] for name in SCENARIOS}
+        self.ttfb = []
+        self.frames = []  # data: кадрів на один SSE стрім
+        self.errors = {name: 0 for name in SCENARIOS}
+        self.shed = {name: 0 for name in SCENARIOS}  # 503 від контролю допуску - не помилка
+        self.error_samples = []
+
+    def error(self, scenario: str, message: str):
+        self.errors[scenario] += 1
+        if len(self.error_samples) < 5:
+            self.error_samples.append(f"{scenario}: {message}")
+
+
+def chat_payload(thread_id: str, index: int, rag: bool, assistants: bool = False) -> dict:
+    return {
+        "thread_id": thread_id,
+        "message": CHAT_MESSAGES[index % len(CHAT_MESSAGES)],
+        "mode": "chat",
+        "settings": {"model": "gpt-4o-mini", "enableAgent": True, "enableRAG": rag, "useAssistants": assistants},
+    }
+
+
+async def run_chat(client: httpx.AsyncClient, results: Results, thread_id: str, index: int, rag: bool,
+                   assistants: bool = False):
+    started = time.perf_counter()
+    response = await client.post("/chat", json=chat_payload(thread_id, index, rag, assistants))
+    elapsed = time.perf_counter() - started
+    if response.status_code == 503:
+        results.shed["chat"] += 1
+        return
+    if response.status_code != 200:
+        return results.error("chat", f"HTTP {response.status_code}")
+    content = response.json().get("content", "")
+    if content.startswith("Помилка"):
+        return results.error("chat", content[:120])
+    results.latencies["chat"].append(elapsed)
+
+
+async def run_stream(client: httpx.AsyncClient, results: Results, thread_id: str, index: int, rag: bool):
+    started = time.perf_counter()
+    first_byte = None
+    frames = 0
+    async with client.stream("POST", "/chat/stream", json=chat_payload(thread_id, index, rag)) as response:
+        if response.status_code == 503:
+            results.shed["stream"] += 1
+            return
+        if response.status_code != 200:
+            return results.error("stream", f"HTTP {response.status_code}")
+        if "text/event-stream" not in response.headers.get("content-type", ""):
+            body = await response.aread()
+            return results.error("stream", body.decode("utf-8", errors="replace")[:120])
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            frames += 1
+            frame = json.loads(line[5:])
+            if frame.get("error"):
+                return results.error("stream", frame["error"][:120])
+    results.latencies["stream"].append(time.perf_counter() - started)
+    results.frames.append(frames)
+    if first_byte is not None:
+        results.ttfb.append(first_byte)
+
+
+async def run_upload(client: httpx.AsyncClient, results: Results, thread_id: str, index: int, size_kb: int):
+    text = (f"Документ {index} для навантажувального тесту. " * 64)[: size_kb * 1024]
+    files = {"files": (f"load_test_{index}.txt", text.encode("utf-8"), "text/plain")}
+    started = time.perf_counter()
+    response = await client.post("/upload_documents", files=files, data={"thread_id": thread_id})
+    elapsed = time.perf_counter() - started
+    if response.status_code == 503:
+        results.shed["upload"] += 1
+        return
+    if response.status_code != 200 or response.json().get("status") == "error" or response.json().get("error"):
+        return results.error("upload", f"HTTP {response.status_code}: {response.text[:120]}")
+    results.latencies["upload"].append(elapsed)
+
+
+async def worker(client, results, scenarios, counter, args, deadline):
+    while True:
+        index = counter["next"]
+        if (args.requests and index >= args.requests) or (deadline and time.perf_counter() >= deadline):
+            return
+        counter["next"] += 1
+        scenario = scenarios[index % len(scenarios)]
+        thread_id = f"load-{counter['run']}-{index % args.threads}"
+        try:
+            if scenario == "chat":
+                await run_chat(client, results, thread_id, index, args.rag, args.api == "assistants")
+            elif scenario == "stream":
+                await run_stream(client, results, thread_id, index, args.rag)
+            else:
+                await run_upload(client, results, thread_id, index, args.upload_kb)
+        except Exception as e:
+            results.error(scenario, f"{type(e).__name__}: {e}")
+
+
+async def run_load(args, base_url: str) -> dict:
+    scenarios = args.scenario or ["chat"]
+    results = Results()
+    counter = {"next": 0, "run": uuid.uuid4().hex[:6]}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        # Прогрів: одне з'єднання і перший запит не потрапляють у статистику
+        await client.get("/catalog")
+        rss_before = read_rss(args.pid)
+        deadline = time.perf_counter() + args.duration if args.duration else None
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            worker(client, results, scenarios, counter, args, deadline) for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+        rss_after = read_rss(args.pid)
+
+    report = {
+        "base_url": base_url,
+        "concurrency": args.concurrency,
+        "api": args.api,
+        "elapsed_s": round(elapsed, 3),
+        "scenarios": {},
+    }
+    total_ok = 0
+    for name in scenarios:
+        values = results.latencies[name]
+        total_ok += len(values)
+        report["scenarios"][name] = {
+            "ok": len(values),
+            "errors": results.errors[name],
+            "shed": results.shed[name],
+            "rps": round(len(values) / elapsed, 2) if elapsed else None,
+            "p50_ms": _ms(percentile(values, 50)),
+            "p90_ms": _ms(percentile(values, 90)),
+            "p99_ms": _ms(percentile(values, 99)),
+            "max_ms": _ms(max(values) if values else None),
+        }
+    if "stream" in scenarios:
+        report["scenarios"]["stream"]["ttfb_p50_ms"] = _ms(percentile(results.ttfb, 50))
+        report["scenarios"]["stream"]["ttfb_p99_ms"] = _ms(percentile(results.ttfb, 99))
+        report["scenarios"]["stream"]["frames_avg"] = (
+            round(sum(results.frames) / len(results.frames), 1) if results.frames else None
+        )
+    report["rps"] = round(total_ok / elapsed, 2) if elapsed else None
+    if rss_before is not None and rss_after is not None:
+        threads = min(args.threads, counter["next"])
+        report["memory"] = {
+            "rss_before_mb": round(rss_before / 2**20, 1),
+            "rss_after_mb": round(rss_after / 2**20, 1),
+            "threads": threads,
+            "per_thread_kb": round((rss_after - rss_before) / max(threads, 1) / 1024, 1),
+        }
+    if results.error_samples:
+        report["error_samples"] = results.error_samples
+    return report
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return round(value * 1000, 1) if value is not None else None
+
+
+def spawn_backend(args) -> tuple:
+    """Запустити mock OpenAI (у цьому процесі) та backend (uvicorn) з тимчасовими сховищами"""
+    sys.path.insert(0, BACKEND_DIR)
+    from mock_openai_server import run_server
+
+    mock_port, backend_port = free_port(), free_port()
+    replay = args.cassette and args.cassette_mode == "replay"
+    # Відтворення з касети не ходить у мережу - mock сервер не потрібен
+    mock = None if replay else run_server(
+        port=mock_port, latency=args.latency, token_ms=args.token_ms, reply_tokens=args.reply_tokens,
+        tool_rate=args.tool_rate, rpm=args.mock_rpm,
+    )
+    workdir = os.path.join(BACKEND_DIR, ".load_test")
+    os.makedirs(workdir, exist_ok=True)
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "mock",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "USE_LM_STUDIO": "false",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        "CATALOG_DB_PATH": os.path.join(workdir, "catalog.db"),
+        "OUTBOX_DB_PATH": os.path.join(workdir, "outbox.db"),
+        "ROUTER_LOG_PATH": os.path.join(workdir, "router_log.jsonl"),
+    }
+    if args.cassette:
+        env.update({
+            "LLM_CASSETTE_MODE": args.cassette_mode,
+            "LLM_CASSETTE_PATH": os.path.abspath(args.cassette),
+            "LLM_CASSETTE_LATENCY": args.cassette_latency,
+        })
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(backend_port),
+         "--no-access-log", "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    base_url = f"http://127.0.0.1:{backend_port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Backend завершився під час запуску")
+        try:
+            # /readyz - 200 після прогріву підсистем, щоб холодний старт не потрапив у вимірювання
+            if httpx.get(f"{base_url}/readyz", timeout=1).status_code == 200:
+                return process, mock, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Backend не запустився за 60 секунд")
+
+
+def print_report(report: dict):
+    print(f"\n📈 {report['base_url']}  api={report['api']}  concurrency={report['concurrency']}  {report['elapsed_s']} с, {report['rps']} RPS")
+    for name, item in report["scenarios"].items():
+        line = (f"   {name:<7} ok={item['ok']:<6} err={item['errors']:<4} shed={item['shed']:<5} rps={item['rps']:<8} "
+                f"p50={item['p50_ms']} p90={item['p90_ms']} p99={item['p99_ms']} max={item['max_ms']} мс")
+        if "ttfb_p50_ms" in item:
+            line += f"  ttfb p50={item['ttfb_p50_ms']} p99={item['ttfb_p99_ms']} мс  frames={item['frames_avg']}"
+        print(line)
+    if "memory" in report:
+        memory = report["memory"]
+        print(f"   RSS {memory['rss_before_mb']} -> {memory['rss_after_mb']} MB, "
+              f"{memory['per_thread_kb']} KB на thread ({memory['threads']} threads)")
+    for sample in report.get("error_samples", []):
+        print(f"   ⚠️  {sample}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Навантажувальний тест backend")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Адреса запущеного backend")
+    parser.add_argument("--spawn", action="store_true", help="Запустити mock OpenAI та backend автоматично")
+    parser.add_argument("--pid", type=int, help="PID backend для вимірювання пам'яті (з --spawn - автоматично)")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Сценарій (можна кілька, чергуються)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Загальна кількість запитів (0 - без ліміту)")
+    parser.add_argument("--duration", type=float, default=0, help="Тривалість тесту в секундах (замість --requests)")
+    parser.add_argument("--threads", type=int, default=50, help="Кількість різних thread_id розмов")
+    parser.add_argument("--rag", action="store_true", help="Увімкнути RAG у запитах чату")
+    parser.add_argument("--api", choices=["chat", "assistants"], default="chat",
+                        help="Шлях сценарію chat: Chat Completions або Assistants run (settings.useAssistants)")
+    parser.add_argument("--upload-kb", type=int, default=16, help="Розмір документа для upload сценарію")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--latency", default="fixed:50", help="Розподіл затримки mock сервера (з --spawn)")
+    parser.add_argument("--token-ms", type=float, default=5.0, help="Затримка між stream chunks mock сервера")
+    parser.add_argument("--reply-tokens", type=int, default=24, help="Кількість слів у відповіді mock сервера")
+    parser.add_argument("--tool-rate", type=float, default=0.5, help="Частка відповідей mock сервера з tool call")
+    parser.add_argument("--mock-rpm", type=int, default=0, help="Ліміт запитів mock сервера на модель (429 понад нього)")
+    parser.add_argument("--cassette", help="Касета OpenAI/Google трафіку для backend (з --spawn)")
+    parser.add_argument("--cassette-mode", choices=["record", "replay"], default="replay")
+    parser.add_argument("--cassette-latency", default="none", help="none | recorded | scaled:<коефіцієнт>")
+    parser.add_argument("--json", help="Зберегти звіт у JSON файл")
+    args = parser.parse_args()
+    if args.duration:
+        args.requests = 0
+
+    process = mock = None
+    base_url = args.url
+    if args.spawn:
+        process, mock, base_url = spawn_backend(args)
+        args.pid = process.pid
+        if args.cassette and args.cassette_mode == "replay":
+            print(f"🧪 Backend {base_url} (pid {process.pid}), касета {args.cassette} ({args.cassette_latency})")
+        else:
+            print(f"🧪 Backend {base_url} (pid {process.pid}), mock OpenAI latency {args.latency}")
+    try:
+        report = asyncio.run(run_load(args, base_url))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if mock is not None:
+            mock.shutdown()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
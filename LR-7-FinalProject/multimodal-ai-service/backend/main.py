@@ -4,42 +4,74 @@ BACKEND ДЛЯ МУЛЬТИМОДАЛЬНОГО AI СЕРВІСУ
 """
 
 import os
+import re
+import logging
 import json
 import base64
+import sqlite3
+import threading
+import uuid
+import time
+import random
+import hashlib
+import importlib.util
+from contextlib import asynccontextmanager, contextmanager
 from io import BytesIO
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
 from typing import List, Optional
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import asyncio
-from pydantic import BaseModel
-from openai import OpenAI
-from PIL import Image
+from pydantic import BaseModel, Field
+import httpx
 from dotenv import load_dotenv
 from email.mime.text import MIMEText
-import pandas as pd
+import numpy as np
+from admission import AdmissionGate, AdmissionMiddleware, parse_limits
+from app_logging import configure_logging, dropped_records, get_request_id, new_request_id, request_id_var
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
+from llm_cassette import get_cassette, wrap_async_openai_transport, wrap_google_http, wrap_openai_transport
+from cancellation import RequestCancelled, mark_stage, run_cancellable
+from endpoint_pool import AsyncPoolTransport, EndpointPool, PoolTransport, parse_endpoints
+from fair_queue import TenantPolicy, parse_tenant_values, tenant_var
+from history_compaction import choose_cut, history_tokens, summary_message, summary_request, trim_tail
+from http_responses import CompressionMiddleware, FastJSONResponse
+from rate_limiter import AsyncRateLimitTransport, RateLimitScheduler, RateLimitTransport
+from single_flight import SingleFlight, content_key
+from sse_stream import FrameBuffer, sse_frame
+from state_store import create_state_store
+from warmup import Lazy, LazyProxy, Readiness, warm_up
+from model_router import (
+    SMALL_MODEL, HeuristicRouter, LearnedRouter, RouterLog,
+    create_router, message_fields, read_log, shadow_report,
+)
+
+# Важкі залежності (openai, pandas, chromadb, Google API) імпортуються при першому використанні
+# або у фоновому прогріві (warmup.py) - тут тільки перевірка, що пакети встановлені
+def _installed(*modules) -> bool:
+    try:
+        return all(importlib.util.find_spec(module) is not None for module in modules)
+    except ImportError:
+        return False
+
 
 # Google API imports
-try:
-    from google.oauth2.credentials import Credentials
-    from google_auth_oauthlib.flow import InstalledAppFlow
-    from googleapiclient.discovery import build
-    GOOGLE_AVAILABLE = True
-except ImportError:
-    GOOGLE_AVAILABLE = False
+GOOGLE_AVAILABLE = _installed("google.oauth2", "google_auth_oauthlib", "googleapiclient", "google_auth_httplib2", "httplib2")
+if not GOOGLE_AVAILABLE:
     print("⚠️  Google API бібліотеки не встановлено. Google тули будуть недоступні.")
     print("   Встановіть: pip install google-auth google-auth-oauthlib google-auth-httplib2 google-api-python-client")
 
 # Завантажити змінні оточення
 load_dotenv()
 
-# Спробувати імпортувати chromadb (опціонально)
-try:
-    import chromadb  # type: ignore
-    CHROMADB_AVAILABLE = True
-except ImportError:
-    CHROMADB_AVAILABLE = False
+# Логер сервісу: рівень, формат і семплювання DEBUG - через LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE_RATE
+logger = configure_logging()
+
+# Перевірити, чи встановлено chromadb (опціонально)
+CHROMADB_AVAILABLE = _installed("chromadb")
+if not CHROMADB_AVAILABLE:
     print("⚠️  ChromaDB не встановлено. RAG функціональність буде недоступна.")
     print("   Встановіть: pip install chromadb")
     print("   Або встановіть Visual C++ Build Tools для Windows")
@@ -49,6 +81,60 @@ except ImportError:
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 LM_STUDIO_URL = os.getenv("LM_STUDIO_URL", "http://localhost:1234/v1")
 USE_LM_STUDIO = os.getenv("USE_LM_STUDIO", "false").lower() == "true"
+# Кілька LM Studio серверів (endpoint_pool.py): "http://10.0.0.5:1234/v1,http://10.0.0.6:1234/v1=2" -
+# адреса[=макс. одночасних запитів]; порожньо - тільки LM_STUDIO_URL
+LM_STUDIO_URLS = os.getenv("LM_STUDIO_URLS", "")
+LM_STUDIO_MAX_CONCURRENCY = int(os.getenv("LM_STUDIO_MAX_CONCURRENCY", "4"))
+LM_STUDIO_HEALTH_INTERVAL = float(os.getenv("LM_STUDIO_HEALTH_INTERVAL", "10"))
+# Альтернативний OpenAI-сумісний endpoint (напр. mock_openai_server.py для навантажувальних тестів)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Планувальник викликів моделей: ліміти вчаться з x-ratelimit-* заголовків,
+# RATE_LIMIT_RPM / RATE_LIMIT_TPM - стартові значення до першої відповіді
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", "0")) or None
+RATE_LIMIT_TPM = float(os.getenv("RATE_LIMIT_TPM", "0")) or None
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "4"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+# Справедлива черга між tenant-ами (fair_queue.py): "default=1,key:3f2a9c1b0d4e=4" -
+# ваги та бюджети токенів за хвилину; tenant - ключ API, інакше thread_id або IP
+TENANT_WEIGHTS = parse_tenant_values(os.getenv("TENANT_WEIGHTS", ""))
+TENANT_TPM = parse_tenant_values(os.getenv("TENANT_TPM", ""))
+# Сховище стану (історія, галерея, кеші Assistants): memory | sqlite (воркери одного хоста) | redis (кілька хостів)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "./state.db")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_PREFIX = os.getenv("STATE_PREFIX", "multimodal:")
+# Таймаут з'єднання і операцій Redis (секунд): завислий сервер дає помилку, а не блокує воркер
+STATE_REDIS_TIMEOUT = float(os.getenv("STATE_REDIS_TIMEOUT", "2"))
+# Assistants API (run зі стрімом подій) замість Chat Completions за замовчуванням;
+# для окремого запиту - settings.useAssistants (true/false)
+USE_ASSISTANTS_API = os.getenv("USE_ASSISTANTS_API", "false").lower() == "true"
+# Assistant, яким не користувались ASSISTANT_TTL секунд, видаляється в OpenAI (0 - ніколи)
+ASSISTANT_TTL = float(os.getenv("ASSISTANT_TTL", str(7 * 24 * 3600)))
+# /chat/stream: дельти моделі об'єднуються в кадри не частіше ніж раз на SSE_COALESCE_MS (0 - кадр на дельту);
+# читання моделі призупиняється, коли клієнт не забрав SSE_MAX_PENDING символів
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "40"))
+SSE_MAX_PENDING = int(os.getenv("SSE_MAX_PENDING", str(256 * 1024)))
+# Контроль допуску: "шлях=concurrency:queue:max_wait" через кому (admission.py); порожньо - без лімітів
+ADMISSION_LIMITS = os.getenv(
+    "ADMISSION_LIMITS", "/chat=32:64:10,/chat/stream=32:64:10,/generate_image=4:16:30,/upload_documents=4:16:30"
+)
+# Дедлайн обробки /chat та /chat/stream у секундах (0 - без дедлайну); відключення клієнта скасовує роботу одразу
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "120"))
+# Історія в запиті до моделі: system prompt + зведення старих ходів + дослівний хвіст (history_compaction.py).
+# Хвіст понад HISTORY_TOKEN_BUDGET токенів стискається у фоні до HISTORY_KEEP_TOKENS моделлю SUMMARY_MODEL;
+# поки зведення не готове, хвіст обрізається до HISTORY_MAX_TOKENS
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+HISTORY_KEEP_TOKENS = int(os.getenv("HISTORY_KEEP_TOKENS", "1500"))
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "8000"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "500"))
+# Відповіді від COMPRESS_MIN_SIZE байт стискаються brotli / gzip (0 - без стиснення)
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# Операції, для яких однакові одночасні виклики НЕ об'єднуються (generate_image не об'єднується ніколи -
+# кожен виклик має отримати своє зображення і свій запис у галереї)
+SINGLE_FLIGHT_DISABLE = [op.strip() for op in os.getenv("SINGLE_FLIGHT_DISABLE", "").split(",") if op.strip()]
 
 # Якщо API ключ не знайдено в змінних оточення, можна встановити тут
 # (для швидкого тестування - не рекомендується для production)
@@ -58,8 +144,159 @@ if not OPENAI_API_KEY:
     # OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
     pass
 
+# ==================== METRICS ====================
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "Час обробки HTTP запиту (для SSE - до початку стріму)",
+    ("method", "route", "status"),
+)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP запити в обробці")
+STAGE_LATENCY = Histogram(
+    "chat_stage_duration_seconds",
+    "Час етапів чату: rag_retrieval, completion, tools, final_completion, stream_first_token, stream_total, image_*",
+    ("stage",),
+)
+TOOL_LATENCY = Histogram("tool_duration_seconds", "Час виконання агентського тулу", ("tool", "status"))
+LLM_TOKENS = Counter("llm_tokens_total", "Токени з response.usage: prompt, completion, cached (з кешу префікса)", ("model", "kind"))
+HISTORY_PROMPT_TOKENS = Histogram(
+    "chat_history_prompt_tokens", "Оцінка токенів історії (з system prompt і зведенням) у запиті до моделі",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+HISTORY_COMPACTIONS = Counter(
+    "chat_history_compactions_total", "Фонові стиснення старих ходів у зведення (ok / skipped / error)", ("result",),
+)
+CACHE_REQUESTS = Counter("cache_requests_total", "Звернення до кешів (hit / miss)", ("cache", "result"))
+EXECUTOR_QUEUED = Gauge("executor_queued_tasks", "Блокуючі задачі, що чекають на потік виконавця")
+EXECUTOR_ACTIVE = Gauge("executor_active_tasks", "Блокуючі задачі, що виконуються в потоках")
+EXECUTOR_WAIT = Histogram(
+    "executor_queue_wait_seconds", "Час очікування задачі в черзі виконавця",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+SSE_ACTIVE = Gauge("sse_active_streams", "Відкриті SSE стріми /chat/stream")
+SSE_STREAMS = Counter("sse_streams_total", "SSE стріми за результатом", ("result",))
+REQUESTS_CANCELLED = Counter(
+    "requests_cancelled_total",
+    "Запити, роботу яких скасовано (disconnect / deadline), за етапом - наступні етапи не виконувались",
+    ("endpoint", "reason", "stage"),
+)
+LOG_DROPPED = Gauge("log_records_dropped", "Записи логу, відкинуті через переповнену чергу")
+LOG_DROPPED.set_function(dropped_records)
+ADMISSION_SHED = Counter(
+    "admission_shed_total", "Запити, відхилені контролем допуску з 503 (queue_full / timeout)", ("endpoint", "reason"),
+)
+ADMISSION_WAIT = Histogram(
+    "admission_queue_wait_seconds", "Час у черзі контролю допуску для допущених запитів", ("endpoint",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+ADMISSION_QUEUE = Gauge("admission_queue_depth", "Запити в черзі контролю допуску", ("endpoint",))
+ADMISSION_ACTIVE = Gauge("admission_active_requests", "Допущені запити, що виконуються", ("endpoint",))
+RATE_LIMIT_WAIT = Histogram(
+    "llm_rate_limit_wait_seconds", "Очікування в планувальнику перед викликом моделі", ("model",),
+)
+RATE_LIMIT_RETRIES = Counter("llm_rate_limit_retries_total", "Повтори після 429 / 503", ("model",))
+RATE_LIMIT_REJECTED = Counter(
+    "llm_rate_limit_rejected_total", "Запити, яким черга до квоти довша за RATE_LIMIT_MAX_WAIT", ("model",),
+)
+# Без мітки tenant - кількість tenant-ів не обмежена
+TENANT_BUDGET_WAIT = Histogram(
+    "llm_tenant_budget_wait_seconds", "Затримка запитів tenant-ів, що перевищили TENANT_TPM",
+)
+LOCAL_ENDPOINT_REQUESTS = Counter(
+    "local_endpoint_requests_total", "Запити до LM Studio endpoint-ів пулу (ok / error)", ("endpoint", "result"),
+)
+LOCAL_ENDPOINT_EJECTIONS = Counter(
+    "local_endpoint_ejections_total", "Виключення endpoint-а з пулу (помилки поспіль або перевірка стану)", ("endpoint",),
+)
+LOCAL_ENDPOINT_OUTSTANDING = Gauge("local_endpoint_outstanding_requests", "Незавершені запити на endpoint", ("endpoint",))
+FAIR_QUEUE_DEPTH = Gauge("llm_fair_queue_depth", "Виклики моделей у справедливій черзі (квота вичерпана)")
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls_total", "Виклики операцій: leader / coalesced (приєднався до такого ж) / bypass",
+    ("operation", "result"),
+)
+
+
+def on_rate_limit_event(event: str, model: str, value: float):
+    """Події планувальника -> метрики"""
+    if event == "wait":
+        RATE_LIMIT_WAIT.labels(model).observe(value)
+        logger.debug("⏳ Rate limit: %s чекає %.2f с", model, value)
+    elif event == "retry":
+        RATE_LIMIT_RETRIES.labels(model).inc()
+        logger.info("🔁 Rate limit: повтор запиту до %s", model)
+    elif event == "rejected":
+        RATE_LIMIT_REJECTED.labels(model).inc()
+        logger.warning("⛔ Rate limit: черга до %s довша за %.0f с, запит відхилено", model, RATE_LIMIT_MAX_WAIT)
+    elif event == "budget":
+        # model тут - tenant, що перевищив свій бюджет
+        TENANT_BUDGET_WAIT.observe(value)
+        logger.debug("🪣 Бюджет tenant %s: затримка %.2f с", model, value)
+
+
+def record_usage(model: str, usage):
+    """Додати токени з response.usage до лічильників (cached - prompt токени з кешу префікса)"""
+    if usage is None:
+        return
+    LLM_TOKENS.labels(model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    LLM_TOKENS.labels(model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    LLM_TOKENS.labels(model, "cached").inc(getattr(details, "cached_tokens", 0) or 0)
+
+
+@contextmanager
+def chat_stage(name: str):
+    """Етап чату: час у chat_stage_duration_seconds, назва - для метрики скасованих запитів"""
+    mark_stage(name)
+    with STAGE_LATENCY.labels(name).time():
+        yield
+
+
+async def run_blocking(func, *args):
+    """asyncio.to_thread з метриками черги виконавця (очікування, глибина, активні задачі)"""
+    submitted = time.perf_counter()
+    started = False
+    EXECUTOR_QUEUED.inc()
+
+    def job():
+        nonlocal started
+        started = True
+        EXECUTOR_QUEUED.dec()
+        EXECUTOR_WAIT.observe(time.perf_counter() - submitted)
+        EXECUTOR_ACTIVE.inc()
+        try:
+            return func(*args)
+        finally:
+            EXECUTOR_ACTIVE.dec()
+
+    try:
+        return await asyncio.to_thread(job)
+    finally:
+        # Скасована до старту задача не виконається - прибрати її з черги
+        if not started:
+            EXECUTOR_QUEUED.dec()
+
+
+single_flight = SingleFlight(
+    disabled=SINGLE_FLIGHT_DISABLE,
+    observer=lambda operation, result: SINGLE_FLIGHT_CALLS.labels(operation, result).inc(),
+)
+
+
+async def run_shared(operation: str, func, *args, coalesce: bool = True):
+    """run_blocking через single-flight: однакові одночасні func(*args) виконуються один раз"""
+    return await single_flight.run(operation, content_key(*args), lambda: run_blocking(func, *args), coalesce)
+
+
 # ==================== INIT ====================
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Старт: фонові воркери і прогрів підсистем; зупинка: воркери (on_startup / on_shutdown нижче)"""
+    await on_startup()
+    try:
+        yield
+    finally:
+        await on_shutdown()
+
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # Middleware для вимкнення буферизації для streaming
 @app.middleware("http")
@@ -71,6 +308,82 @@ async def no_cache_middleware(request, call_next):
         response.headers["X-Accel-Buffering"] = "no"
     return response
 
+
+def on_admission_event(endpoint: str, event: str, value: float):
+    """Події контролю допуску -> метрики"""
+    if event == "admitted":
+        ADMISSION_WAIT.labels(endpoint).observe(value)
+    else:
+        ADMISSION_SHED.labels(endpoint, event.partition(":")[2]).inc()
+
+
+admission_gates = {
+    path: AdmissionGate(path, concurrency, queue, max_wait, observer=on_admission_event)
+    for path, (concurrency, queue, max_wait) in parse_limits(ADMISSION_LIMITS).items()
+}
+for _path, _gate in admission_gates.items():
+    ADMISSION_QUEUE.labels(_path).set_function(lambda gate=_gate: gate.queued)
+    ADMISSION_ACTIVE.labels(_path).set_function(lambda gate=_gate: gate.active)
+
+
+def on_admission_reject(gate: AdmissionGate, error):
+    logger.info("🚦 %s перевантажено (%s), Retry-After %d с", gate.name, error.reason, error.retry_after)
+
+
+# Ліміт одночасних запитів на endpoint з обмеженою чергою: надлишок - швидкий 503 з Retry-After
+app.add_middleware(AdmissionMiddleware, gates=admission_gates, on_reject=on_admission_reject)
+
+
+def request_tenant(request) -> str:
+    """Tenant для справедливої черги: хеш ключа API (X-API-Key / Bearer), інакше IP клієнта"""
+    api_key = request.headers.get("x-api-key")
+    authorization = request.headers.get("authorization") or ""
+    if not api_key and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+def use_thread_tenant(thread_id: Optional[str]):
+    """Без ключа API розмова - окремий tenant (кілька вкладок за одним NAT не ділять чергу)"""
+    tenant = tenant_var.get()
+    if thread_id and (tenant is None or tenant.startswith("ip:")):
+        tenant_var.set(f"thread:{thread_id}")
+
+
+@app.middleware("http")
+async def request_context_middleware(request, call_next):
+    """request_id для кореляції логів (береться з X-Request-ID або генерується) і tenant запиту"""
+    request_id = request.headers.get("x-request-id") or new_request_id()
+    token = request_id_var.set(request_id)
+    tenant_token = tenant_var.set(request_tenant(request))
+    try:
+        response = await call_next(request)
+    finally:
+        tenant_var.reset(tenant_token)
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+@app.middleware("http")
+async def metrics_middleware(request, call_next):
+    started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        # Шаблон маршруту, а не сирий шлях - щоб /outbox/{id} не створював серію на кожен id
+        route = request.scope.get("route")
+        HTTP_LATENCY.labels(
+            request.method, route.path if route is not None else "unmatched", status
+        ).observe(time.perf_counter() - started)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -78,22 +391,106 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESS_MIN_SIZE)
+
+# Касета OpenAI/Google трафіку: LLM_CASSETTE_MODE=record|replay (див. llm_cassette.py)
+cassette = get_cassette()
+if cassette is not None:
+    print(f"📼 Касета ({cassette.mode}): {cassette.path}")
+    if cassette.mode == "replay" and not OPENAI_API_KEY and not USE_LM_STUDIO:
+        # Відтворення не ходить у мережу - справжній ключ не потрібен
+        OPENAI_API_KEY = "cassette-replay"
+
+rate_limiter = RateLimitScheduler(
+    rpm=RATE_LIMIT_RPM,
+    tpm=RATE_LIMIT_TPM,
+    max_retries=RATE_LIMIT_MAX_RETRIES,
+    max_wait=RATE_LIMIT_MAX_WAIT,
+    observer=on_rate_limit_event,
+    policy=TenantPolicy(TENANT_WEIGHTS, TENANT_TPM),
+)
+FAIR_QUEUE_DEPTH.set_function(rate_limiter.queued)
+
+
+def on_endpoint_event(event: str, endpoint: str):
+    """Події пулу LM Studio endpoint-ів -> метрики"""
+    if event in ("ok", "error"):
+        LOCAL_ENDPOINT_REQUESTS.labels(endpoint, event).inc()
+    elif event == "ejected":
+        LOCAL_ENDPOINT_EJECTIONS.labels(endpoint).inc()
+        logger.warning("🚫 LM Studio %s виключено з пулу", endpoint)
+    elif event == "restored":
+        logger.info("✅ LM Studio %s повернуто в пул", endpoint)
+
+
+# Пул LM Studio серверів: запит - на найменш завантажений, збійні виключаються
+lm_studio_pool = None
+if USE_LM_STUDIO:
+    lm_studio_pool = EndpointPool(
+        parse_endpoints(LM_STUDIO_URLS or LM_STUDIO_URL, LM_STUDIO_MAX_CONCURRENCY),
+        health_interval=LM_STUDIO_HEALTH_INTERVAL,
+        observer=on_endpoint_event,
+    )
+    for _endpoint in lm_studio_pool.endpoints:
+        LOCAL_ENDPOINT_OUTSTANDING.labels(str(_endpoint)).set_function(lambda endpoint=_endpoint: endpoint.outstanding)
+
+
+def build_openai_http_client() -> httpx.Client:
+    """httpx клієнт OpenAI: планувальник лімітів -> касета (якщо увімкнена) -> пул LM Studio -> мережа"""
+    transport = httpx.HTTPTransport(limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100))
+    if lm_studio_pool is not None:
+        lm_studio_pool.start_health_checks()
+        transport = PoolTransport(lm_studio_pool, transport)
+    transport = wrap_openai_transport(transport)
+    if RATE_LIMIT_ENABLED:
+        transport = RateLimitTransport(rate_limiter, transport)
+    # Таймаути як у клієнта SDK за замовчуванням
+    return httpx.Client(transport=transport, timeout=httpx.Timeout(600.0, connect=5.0), follow_redirects=True)
+
+
+def build_async_openai_http_client() -> httpx.AsyncClient:
+    """Async варіант build_openai_http_client (для стріму подій Assistants run)"""
+    transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100))
+    if lm_studio_pool is not None:
+        lm_studio_pool.start_health_checks()
+        transport = AsyncPoolTransport(lm_studio_pool, transport)
+    transport = wrap_async_openai_transport(transport)
+    if RATE_LIMIT_ENABLED:
+        transport = AsyncRateLimitTransport(rate_limiter, transport)
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(600.0, connect=5.0), follow_redirects=True)
+
 
-# Ініціалізувати OpenAI клієнт
+def create_openai_client(**kwargs):
+    """Створити OpenAI клієнт (імпорт SDK - ~0.5 с, тому при першому зверненні або в прогріві)"""
+    from openai import OpenAI
+    return OpenAI(http_client=build_openai_http_client(), **kwargs)
+
+
+def create_async_openai_client(**kwargs):
+    """Створити AsyncOpenAI клієнт (не блокує event loop на час відповіді)"""
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(http_client=build_async_openai_http_client(), **kwargs)
+
+
+# Ініціалізувати OpenAI клієнт (LazyProxy: справжній клієнт створюється при першому client.xxx)
 client = None
+async_client = None
 if USE_LM_STUDIO:
     # Використовувати LM Studio (локальна модель)
     try:
-        client = OpenAI(base_url=LM_STUDIO_URL, api_key="lm-studio")
-        print(f"✅ Підключено до LM Studio: {LM_STUDIO_URL}")
+        # base_url - перший endpoint пулу, транспорт переадресовує запит на найменш завантажений
+        client = LazyProxy(lambda: create_openai_client(base_url=str(lm_studio_pool.base_url), api_key="lm-studio"))
+        async_client = LazyProxy(lambda: create_async_openai_client(base_url=str(lm_studio_pool.base_url), api_key="lm-studio"))
+        print(f"✅ Підключено до LM Studio: {', '.join(str(endpoint) for endpoint in lm_studio_pool.endpoints)}")
     except Exception as e:
         print(f"⚠️  Помилка підключення до LM Studio: {e}")
         print("   Переконайтеся, що LM Studio запущено")
 elif OPENAI_API_KEY:
     # Використовувати реальний OpenAI API
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        print("✅ Підключено до OpenAI API")
+        client = LazyProxy(lambda: create_openai_client(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL))
+        async_client = LazyProxy(lambda: create_async_openai_client(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL))
+        print(f"✅ Підключено до OpenAI API{f' ({OPENAI_BASE_URL})' if OPENAI_BASE_URL else ''}")
         print(f"   Використовується API ключ: {OPENAI_API_KEY[:20]}...")
     except Exception as e:
         print(f"⚠️  Помилка ініціалізації OpenAI клієнта: {e}")
@@ -105,22 +502,168 @@ else:
     print("   3. Встановіть USE_LM_STUDIO=true для використання LM Studio")
     print("   4. Розкоментуйте рядок в main.py для швидкого тестування")
 
-# Ініціалізувати ChromaDB тільки якщо доступний
-if CHROMADB_AVAILABLE:
+def _open_rag_collection():
+    """Відкрити колекцію ChromaDB (імпорт chromadb і відкриття бази - секунди)"""
+    import chromadb  # type: ignore
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
-    collection = chroma_client.get_or_create_collection("documents")
-else:
-    chroma_client = None
-    collection = None
+    return chroma_client.get_or_create_collection("documents")
+
+
+rag_collection = Lazy(_open_rag_collection)
+
+
+def get_rag_collection():
+    """Колекція ChromaDB (відкривається при першому виклику; None - недоступна)"""
+    if not CHROMADB_AVAILABLE:
+        return None
+    try:
+        return rag_collection.get()
+    except Exception as e:
+        logger.warning("⚠️  Помилка ініціалізації ChromaDB: %s", e)
+        return None
+
+# ==================== SHARED STATE ====================
+# Історія, галерея та кеші Assistants живуть у сховищі стану (state_store.py), а не в
+# глобальних змінних процесу - так їх бачать усі воркери (sqlite) і всі хости (redis)
+state = create_state_store(STATE_BACKEND, STATE_DB_PATH, STATE_REDIS_URL, STATE_PREFIX, STATE_REDIS_TIMEOUT)
+print(f"✅ Сховище стану: {state.name}")
+
+
+async def state_io(func, *args):
+    """Виклик сховища стану з async коду: sqlite / redis - у пулі потоків, щоб не блокувати event loop"""
+    if not state.shared:
+        return func(*args)
+    return await run_blocking(func, *args)
 
 # ==================== CONVERSATION HISTORY STORAGE ====================
-# Зберігати історію розмов для кожного thread
-conversation_history = {}  # {thread_id: [messages]}
+def history_key(thread_id: str) -> str:
+    return f"history:{thread_id}"
+
+
+def load_history(thread_id: str) -> list:
+    """Історія розмови thread (порожній список, якщо розмови ще немає)"""
+    return state.list_range(history_key(thread_id))
+
+
+def append_history(thread_id: str, *messages):
+    """Дописати повідомлення в історію (атомарно - безпечно з кількох воркерів)"""
+    state.list_append(history_key(thread_id), *messages)
+
+
+# ==================== HISTORY COMPACTION ====================
+# Простір імен "summaries": {thread_id: {"summary": str, "covered": int, "updated_at": float}} -
+# covered - позиція в історії, до якої (не включно) ходи вже у зведенні
+_compaction_tasks = {}  # thread_id -> фонова задача стиснення
+
+
+async def build_context(thread_id: str, history: list) -> list:
+    """messages для моделі: system prompt, зведення, хвіст (стиснення запускається у фоні)"""
+    head = history[:1] if history and history[0].get("role") == "system" else []
+    record = await state_io(state.get, "summaries", thread_id) or {}
+    covered = min(max(record.get("covered", 0), len(head)), len(history))
+    tail = history[covered:]
+    if history_tokens(tail) > HISTORY_TOKEN_BUDGET:
+        schedule_compaction(thread_id)
+    trimmed = trim_tail(tail, HISTORY_MAX_TOKENS)
+    if len(trimmed) < len(tail):
+        logger.info("⚠️  Історія %s: зведення ще не готове, хвіст обрізано %d -> %d повідомлень",
+                    thread_id, len(tail), len(trimmed))
+    # Зведення - окремим повідомленням: оновлення зведення не змінює кешований system prompt
+    summary = summary_message(record.get("summary"))
+    messages = [dict(message) for message in head]
+    if summary and USE_LM_STUDIO and messages and isinstance(messages[0].get("content"), str):
+        # Шаблони LM Studio (Mistral, Gemma) не приймають system повідомлення не на початку
+        messages[0]["content"] += "\n\n" + summary["content"]
+    elif summary:
+        messages.append(summary)
+    messages += trimmed
+    HISTORY_PROMPT_TOKENS.observe(history_tokens(messages))
+    return messages
+
+
+def add_request_context(messages: list, text: str):
+    """
+    Контекст запиту (RAG) в кінці messages - після історії, щоб не ламати кешований префікс
+
+    OpenAI - окреме system повідомлення. LM Studio - дописується в останнє user повідомлення:
+    шаблони Mistral/Gemma відхиляють system не на початку і порушення чергування user/assistant.
+    """
+    if not USE_LM_STUDIO:
+        messages.append({"role": "system", "content": text})
+        return
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, list):
+            content = content + [{"type": "text", "text": text}]
+        else:
+            content = f"{content or ''}\n\n{text}"
+        # Новий dict: повідомлення з історії (і сховища) не змінюється
+        messages[index] = {**message, "content": content}
+        return
+    messages.append({"role": "user", "content": text})
+
+
+def schedule_compaction(thread_id: str):
+    """Запустити стиснення історії thread у фоні (одне на thread у процесі)"""
+    if not async_client:
+        return
+    task = _compaction_tasks.get(thread_id)
+    if task is not None and not task.done():
+        return
+    # Окрема задача: скасування запиту (відключення клієнта) не перериває стиснення
+    task = _compaction_tasks[thread_id] = asyncio.create_task(compact_history(thread_id))
+
+    def forget(done):
+        if _compaction_tasks.get(thread_id) is done:
+            del _compaction_tasks[thread_id]
+
+    task.add_done_callback(forget)
+
+
+async def compact_history(thread_id: str):
+    """Додати до зведення ходи, що виходять з хвоста (інкрементально - кожен хід стискається раз)"""
+    try:
+        history = await state_io(load_history, thread_id)
+        record = await state_io(state.get, "summaries", thread_id) or {}
+        first = 1 if history and history[0].get("role") == "system" else 0
+        covered = min(max(record.get("covered", 0), first), len(history))
+        cut = choose_cut(history, covered, HISTORY_KEEP_TOKENS)
+        if cut <= covered:
+            HISTORY_COMPACTIONS.labels("skipped").inc()
+            return
+        started = time.perf_counter()
+        model = "local-model" if USE_LM_STUDIO else SUMMARY_MODEL
+        response = await async_client.chat.completions.create(
+            model=model,
+            messages=summary_request(record.get("summary"), history[covered:cut]),
+            temperature=0,
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+        record_usage(model, response.usage)
+        summary = (response.choices[0].message.content or "").strip()
+        current = await state_io(state.get, "summaries", thread_id) or {}
+        # Історію очистили або інший воркер уже стиснув ці ходи - результат застарів
+        if (not summary or current.get("covered") != record.get("covered")
+                or await state_io(state.list_length, history_key(thread_id)) < cut):
+            HISTORY_COMPACTIONS.labels("skipped").inc()
+            return
+        await state_io(state.set, "summaries", thread_id, {"summary": summary, "covered": cut, "updated_at": time.time()})
+        HISTORY_COMPACTIONS.labels("ok").inc()
+        logger.info("🗜️  Історія %s: %d повідомлень додано до зведення (%d символів, %.1f с)",
+                    thread_id, cut - covered, len(summary), time.perf_counter() - started)
+    except Exception as e:
+        HISTORY_COMPACTIONS.labels("error").inc()
+        logger.warning("⚠️  Помилка стиснення історії %s: %s", thread_id, e)
+
 
 # ==================== ASSISTANTS API STORAGE ====================
-# Зберігати OpenAI Assistant IDs та Thread IDs
-assistants_cache = {}  # {thread_id: {"assistant_id": str, "openai_thread_id": str}}
-vector_stores = {}  # {thread_id: vector_store_id}
+# Простори імен сховища стану:
+# "assistants" - {thread_id: {"openai_thread_id": str, "vector_store_id": str}}
+# "assistant_configs" - {fingerprint: {"assistant_id": str, "model": str, "created_at": float, "last_used": float}}
+# "vector_stores" - {thread_id: vector_store_id}
 
 # ==================== MODELS ====================
 class ChatRequest(BaseModel):
@@ -136,6 +679,23 @@ class ChatResponse(BaseModel):
     content: str
     tools: list = []
     image_url: Optional[str] = None
+    request_id: Optional[str] = None  # для POST /router/feedback
+
+
+class QuoteItem(BaseModel):
+    item_name: str
+    quantity: int = Field(1, ge=1)
+    destination: Optional[str] = None
+
+
+class QuoteRequest(BaseModel):
+    items: List[QuoteItem]
+    destination: Optional[str] = None
+
+
+class RouterFeedback(BaseModel):
+    request_id: str
+    quality: float  # 0.0 - погана відповідь, 1.0 - добра
 
 
 # ==================== RAG FUNCTIONS (OpenAI File Search API) ====================
@@ -144,70 +704,65 @@ async def upload_file_to_openai(file_content: bytes, filename: str) -> Optional[
     if not client or USE_LM_STUDIO:
         return None
     
+    def upload():
+        # SDK приймає (ім'я, байти) - без тимчасового файлу на диску
+        return client.files.create(file=(filename, file_content), purpose="assistants").id
+
     try:
-        # Створити тимчасовий файл
-        import tempfile
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{filename}") as tmp:
-            tmp.write(file_content)
-            tmp_path = tmp.name
-        
-        # Завантажити в OpenAI
-        with open(tmp_path, "rb") as f:
-            file = client.files.create(
-                file=f,
-                purpose="assistants"
-            )
-        
-        os.unlink(tmp_path)
-        return file.id
+        # Той самий файл, що завантажується одночасно з іншого запиту, вивантажується один раз
+        return await single_flight.run("file_upload", content_key(filename, file_content), lambda: run_blocking(upload))
     except Exception as e:
-        print(f"⚠️  Помилка завантаження файлу в OpenAI: {e}")
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
+        logger.warning("⚠️  Помилка завантаження файлу в OpenAI: %s", e)
         return None
 
 
+def vector_stores_api():
+    """Vector Stores API async клієнта (у нових SDK - client.vector_stores, у старих - client.beta.vector_stores)"""
+    return getattr(async_client, "vector_stores", None) or getattr(async_client.beta, "vector_stores", None)
+
+
 async def create_or_get_vector_store(thread_id: str) -> Optional[str]:
     """Створити або отримати Vector Store для thread"""
-    if not client or USE_LM_STUDIO:
+    if not async_client or USE_LM_STUDIO:
         return None
     
-    if thread_id in vector_stores:
-        return vector_stores[thread_id]
+    existing = await state_io(state.get, "vector_stores", thread_id)
+    if existing:
+        return existing
     
     try:
         # Перевірити чи підтримується vector_stores API
-        if not hasattr(client.beta, 'vector_stores'):
-            print(f"⚠️  Vector Stores API не доступний в цій версії OpenAI SDK")
+        vector_stores = vector_stores_api()
+        if vector_stores is None:
+            logger.warning("⚠️  Vector Stores API не доступний в цій версії OpenAI SDK")
             return None
         
-        vector_store = client.beta.vector_stores.create(
+        vector_store = await vector_stores.create(
             name=f"Documents_{thread_id}",
         )
-        vector_stores[thread_id] = vector_store.id
-        return vector_store.id
+        # Якщо інший воркер встиг першим - використати його Vector Store
+        return await state_io(state.setdefault, "vector_stores", thread_id, vector_store.id)
     except AttributeError as e:
-        print(f"⚠️  Vector Stores API не підтримується: {e}")
-        print(f"   Використовується fallback до ChromaDB")
+        logger.warning("⚠️  Vector Stores API не підтримується: %s. Використовується fallback до ChromaDB", e)
         return None
     except Exception as e:
-        print(f"⚠️  Помилка створення Vector Store: {e}")
+        logger.warning("⚠️  Помилка створення Vector Store: %s", e)
         return None
 
 
 async def add_file_to_vector_store(file_id: str, vector_store_id: str):
     """Додати файл до Vector Store"""
-    if not client or USE_LM_STUDIO:
+    if not async_client or USE_LM_STUDIO:
         return False
     
     try:
-        client.beta.vector_stores.files.create(
+        await vector_stores_api().files.create(
             vector_store_id=vector_store_id,
             file_id=file_id
         )
         return True
     except Exception as e:
-        print(f"⚠️  Помилка додавання файлу до Vector Store: {e}")
+        logger.warning("⚠️  Помилка додавання файлу до Vector Store: %s", e)
         return False
 
 
@@ -215,16 +770,42 @@ async def add_file_to_vector_store(file_id: str, vector_store_id: str):
 # ChromaDB - це векторна база даних для зберігання документів та пошуку за схожістю.
 # Вона конвертує текст у вектори (embeddings) та дозволяє швидко знаходити релевантні документи.
 # Документи розбиваються на chunks (шматки) для кращого пошуку та індексації.
+RAG_CHUNK_SIZE = 1000  # Символів на chunk
+RAG_CHUNK_OVERLAP = 200  # Перекриття між chunks
+
+
+def chunk_text(text: str, chunk_size: int = RAG_CHUNK_SIZE, overlap: int = RAG_CHUNK_OVERLAP) -> List[str]:
+    """Розбити текст на chunks з перекриттям, по можливості на межі слова"""
+    # Якщо документ короткий, повернути як є
+    if len(text) <= chunk_size:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        chunk = text[start:end]
+        
+        # Знайти найближчий пробіл для кращого розбиття
+        if end < len(text):
+            last_space = chunk.rfind(' ')
+            if last_space > chunk_size * 0.5:  # Якщо пробіл не дуже далеко
+                chunk = chunk[:last_space]
+                end = start + last_space
+        
+        chunks.append(chunk)
+        # Переміститися з перекриттям
+        start = end - overlap
+    return chunks
+
+
 def add_documents_to_rag(docs: list):
     """Додати документи у векторну базу (ChromaDB) з chunking"""
-    if not CHROMADB_AVAILABLE or not collection:
+    collection = get_rag_collection()
+    if collection is None:
         return {"error": "ChromaDB не доступний. Встановіть: pip install chromadb"}
     
     try:
         # Chunking: розбити великі документи на менші частини
-        CHUNK_SIZE = 1000  # Символів на chunk
-        CHUNK_OVERLAP = 200  # Перекриття між chunks
-        
         all_chunks = []
         for doc in docs:
             text = doc.get("text", "")
@@ -233,37 +814,12 @@ def add_documents_to_rag(docs: list):
             if not text or not text.strip():
                 continue
             
-            # Якщо документ короткий, додати як є
-            if len(text) <= CHUNK_SIZE:
+            for chunk_index, chunk in enumerate(chunk_text(text)):
                 all_chunks.append({
-                    "text": text,
+                    "text": chunk,
                     "source": source,
-                    "chunk_index": 0
+                    "chunk_index": chunk_index
                 })
-            else:
-                # Розбити на chunks з перекриттям
-                start = 0
-                chunk_index = 0
-                while start < len(text):
-                    end = start + CHUNK_SIZE
-                    chunk_text = text[start:end]
-                    
-                    # Знайти найближчий пробіл для кращого розбиття
-                    if end < len(text):
-                        last_space = chunk_text.rfind(' ')
-                        if last_space > CHUNK_SIZE * 0.5:  # Якщо пробіл не дуже далеко
-                            chunk_text = chunk_text[:last_space]
-                            end = start + last_space
-                    
-                    all_chunks.append({
-                        "text": chunk_text,
-                        "source": source,
-                        "chunk_index": chunk_index
-                    })
-                    
-                    # Переміститися з перекриттям
-                    start = end - CHUNK_OVERLAP
-                    chunk_index += 1
         
         # Додати всі chunks до ChromaDB
         if all_chunks:
@@ -277,14 +833,14 @@ def add_documents_to_rag(docs: list):
                 ids=ids,
             )
             
-            print(f"✅ Додано {len(all_chunks)} chunks з {len(docs)} документів до ChromaDB")
+            logger.info("✅ Додано %d chunks з %d документів до ChromaDB", len(all_chunks), len(docs))
             return {"success": True, "chunks": len(all_chunks), "documents": len(docs)}
         else:
-            print("⚠️  Немає тексту для додавання до ChromaDB")
+            logger.warning("⚠️  Немає тексту для додавання до ChromaDB")
             return {"error": "Немає тексту для додавання"}
             
     except Exception as e:
-        print(f"❌ Помилка додавання документів до ChromaDB: {e}")
+        logger.error("❌ Помилка додавання документів до ChromaDB: %s", e)
         import traceback
         traceback.print_exc()
         return {"error": str(e)}
@@ -292,7 +848,8 @@ def add_documents_to_rag(docs: list):
 
 def retrieve_relevant_docs(query: str, n_results: int = 3):
     """Витягнути релевантні документи з метаданими (ChromaDB)"""
-    if not CHROMADB_AVAILABLE or not collection:
+    collection = get_rag_collection()
+    if collection is None:
         return []
     
     try:
@@ -314,7 +871,7 @@ def retrieve_relevant_docs(query: str, n_results: int = 3):
         
         return docs_with_metadata
     except Exception as e:
-        print(f"⚠️  Помилка пошуку в ChromaDB: {e}")
+        logger.warning("⚠️  Помилка пошуку в ChromaDB: %s", e)
         return []
 
 
@@ -325,48 +882,713 @@ SCOPES = [
     'https://www.googleapis.com/auth/calendar',
     'https://www.googleapis.com/auth/gmail.send'
 ]
+# Адреса локального fake API (fake_google_api.py) для офлайн тестування, напр. http://127.0.0.1:8765/
+GOOGLE_API_ENDPOINT = os.getenv("GOOGLE_API_ENDPOINT")
+GOOGLE_HTTP_TIMEOUT = 30
+GOOGLE_REFRESH_MARGIN = timedelta(minutes=5)  # Оновлювати токен заздалегідь до закінчення
+
+# Credentials спільні для процесу; сервіси кешуються на потік, бо httplib2.Http
+# не потокобезпечний - так кожен потік тримає своє keep-alive з'єднання.
+# Credentials перечитуються, коли змінюється mtime token.json (новий auth_google.py) або
+# оновлення токена падає; generation змінюється разом з ними і скидає кеші сервісів у потоках.
+_google_creds = None
+_google_creds_mtime = None
+_google_creds_generation = 0
+_google_creds_lock = threading.Lock()
+_google_services = threading.local()
+_google_refresh_timer = None
+
+
+def _import_google_libraries():
+    from google.oauth2.credentials import Credentials
+    from google.auth.credentials import AnonymousCredentials
+    from google.auth.exceptions import RefreshError
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from googleapiclient.discovery import build
+    import google_auth_httplib2
+    import httplib2
+    return SimpleNamespace(
+        Credentials=Credentials,
+        AnonymousCredentials=AnonymousCredentials,
+        RefreshError=RefreshError,
+        InstalledAppFlow=InstalledAppFlow,
+        build=build,
+        google_auth_httplib2=google_auth_httplib2,
+        httplib2=httplib2,
+    )
+
+
+# Модулі Google API: імпортуються один раз при першому використанні тулів (або в прогріві)
+google_lib = Lazy(_import_google_libraries)
+
+
+def _google_token_expires_in(creds) -> Optional[timedelta]:
+    """Скільки часу лишилося до закінчення access token (None - невідомо)"""
+    expiry = getattr(creds, "expiry", None)
+    if not expiry:
+        return None
+    now = datetime.now(timezone.utc)
+    if expiry.tzinfo is None:
+        now = now.replace(tzinfo=None)
+    return expiry - now
+
+
+def _token_mtime() -> Optional[float]:
+    try:
+        return os.path.getmtime(TOKEN_PATH)
+    except OSError:
+        return None
+
+
+def _reset_google_credentials_locked():
+    """Забути credentials і сервіси всіх потоків - наступний виклик перечитає token.json"""
+    global _google_creds, _google_creds_mtime, _google_creds_generation
+    _google_creds = None
+    _google_creds_mtime = None
+    _google_creds_generation += 1
+    if _google_refresh_timer is not None:
+        _google_refresh_timer.cancel()
+
+
+def _refresh_google_credentials_locked():
+    """Оновити access token і зберегти його в token.json (викликати під _google_creds_lock)"""
+    global _google_creds_mtime
+    creds = _google_creds
+    if not getattr(creds, "refresh_token", None):
+        return
+    lib = google_lib.get()
+    try:
+        creds.refresh(lib.google_auth_httplib2.Request(lib.httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)))
+    except Exception:
+        # Відкликаний refresh token або збій мережі - не тримати мертві credentials
+        _reset_google_credentials_locked()
+        raise
+    try:
+        with open(TOKEN_PATH, "w") as token:
+            token.write(creds.to_json())
+        # Власний запис не є новим токеном - не перечитувати файл
+        _google_creds_mtime = _token_mtime()
+    except Exception as e:
+        logger.warning("⚠️  Не вдалося зберегти оновлений token.json: %s", e)
+    logger.info("🔑 Google токен оновлено")
+
+
+def _schedule_google_refresh():
+    """Запланувати фонове оновлення токена трохи раніше за його закінчення"""
+    global _google_refresh_timer
+    expires_in = _google_token_expires_in(_google_creds)
+    if expires_in is None:
+        return
+    delay = max((expires_in - GOOGLE_REFRESH_MARGIN).total_seconds(), 30)
+    if _google_refresh_timer is not None:
+        _google_refresh_timer.cancel()
+    _google_refresh_timer = threading.Timer(delay, _background_google_refresh)
+    _google_refresh_timer.daemon = True
+    _google_refresh_timer.start()
+
+
+def _background_google_refresh():
+    """Фонове оновлення токена, щоб тули не чекали на refresh"""
+    try:
+        with _google_creds_lock:
+            _refresh_google_credentials_locked()
+            _schedule_google_refresh()
+    except Exception as e:
+        logger.warning("⚠️  Помилка фонового оновлення Google токена: %s", e)
+
+
+def get_google_credentials():
+    """Завантажити credentials (знову - якщо змінився token.json) і оновити їх, якщо вони (майже) прострочені"""
+    global _google_creds, _google_creds_mtime
+    with _google_creds_lock:
+        if GOOGLE_API_ENDPOINT or (cassette is not None and cassette.mode == "replay"):
+            # Fake API і відтворення з касети не перевіряють токени
+            if _google_creds is None:
+                _google_creds = google_lib.get().AnonymousCredentials()
+            return _google_creds
+
+        mtime = _token_mtime()
+        if _google_creds is not None and mtime != _google_creds_mtime:
+            logger.info("🔑 token.json змінився - перечитую Google credentials")
+            _reset_google_credentials_locked()
+        if _google_creds is None:
+            if mtime is None:
+                return None
+            _google_creds = google_lib.get().Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+            _google_creds_mtime = mtime
+            if _google_creds.valid:
+                _schedule_google_refresh()
+
+        expires_in = _google_token_expires_in(_google_creds)
+        if not _google_creds.valid or (expires_in is not None and expires_in < GOOGLE_REFRESH_MARGIN):
+            _refresh_google_credentials_locked()
+            _schedule_google_refresh()
+        return _google_creds
 
-# Глобальний каталог товарів
-PRODUCT_CATALOG = {"iphone 15": 900, "macbook pro": 2500}
 
 def get_google_service(service_name, version):
-    """Отримати Google API сервіс"""
+    """Отримати Google API сервіс (побудований один раз на потік, зі статичним discovery документом)"""
     if not GOOGLE_AVAILABLE:
         return None
-    if os.path.exists(TOKEN_PATH):
-        try:
-            creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
-            return build(service_name, version, credentials=creds)
-        except Exception as e:
-            print(f"⚠️  Помилка завантаження токену: {e}")
+    try:
+        creds = get_google_credentials()
+        if creds is None:
             return None
-    return None
+        services = getattr(_google_services, "cache", None)
+        if services is None or _google_services.generation != _google_creds_generation:
+            services = _google_services.cache = {}
+            _google_services.generation = _google_creds_generation
+        service = services.get((service_name, version))
+        CACHE_REQUESTS.labels("google_service", "hit" if service is not None else "miss").inc()
+        if service is None:
+            lib = google_lib.get()
+            http = lib.google_auth_httplib2.AuthorizedHttp(creds, http=lib.httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+            http = wrap_google_http(http)
+            service = lib.build(
+                service_name,
+                version,
+                http=http,
+                static_discovery=True,  # discovery документ з пакету, без мережевого запиту
+                cache_discovery=False,
+                client_options={"api_endpoint": GOOGLE_API_ENDPOINT} if GOOGLE_API_ENDPOINT else None,
+            )
+            services[(service_name, version)] = service
+        return service
+    except Exception as e:
+        logger.warning("⚠️  Помилка завантаження токену: %s", e)
+        return None
+
+
+# ==================== PRODUCT CATALOG STORAGE ====================
+# Каталог зберігається в SQLite (індексована таблиця), тому переживає рестарт
+# і спільний для всіх воркерів. Кожне завантаження CSV створює нову версію,
+# а вказівник на активну версію перемикається в тій самій транзакції -
+# читачі бачать або старий каталог повністю, або новий.
+CATALOG_DB_PATH = os.getenv("CATALOG_DB_PATH", "./catalog.db")
+CATALOG_REQUIRED_COLUMNS = ("item_name", "price")
+DEFAULT_CATALOG = {"iphone 15": 900, "macbook pro": 2500}
+
+# Глобальний каталог товарів (in-memory знімок активної версії)
+PRODUCT_CATALOG = dict(DEFAULT_CATALOG)
+CATALOG_VERSION = "default"
+
+_catalog_db = None
+_catalog_db_lock = threading.Lock()
+_catalog_data_version = None
+
+
+def get_catalog_db():
+    """Отримати з'єднання з SQLite сховищем каталогу (створює схему при першому виклику)"""
+    global _catalog_db
+    if _catalog_db is None:
+        conn = sqlite3.connect(CATALOG_DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS catalog_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS catalog_versions (
+                version TEXT PRIMARY KEY,
+                created_at TEXT NOT NULL,
+                item_count INTEGER NOT NULL,
+                source TEXT
+            );
+            CREATE TABLE IF NOT EXISTS catalog_items (
+                version TEXT NOT NULL,
+                item_name TEXT NOT NULL,
+                price INTEGER NOT NULL,
+                PRIMARY KEY (version, item_name)
+            ) WITHOUT ROWID;
+        """)
+        _catalog_db = conn
+    return _catalog_db
+
+
+def parse_catalog_csv(source) -> tuple:
+    """
+    Векторизований розбір CSV каталогу (без iterrows)
+
+    Повертає (catalog, skipped_rows). Кидає ValueError якщо немає потрібних колонок.
+    """
+    import pandas as pd  # ~0.4 с імпорту - тільки при першому завантаженні CSV (або в прогріві)
+
+    try:
+        df = pd.read_csv(
+            source,
+            usecols=lambda column: column.strip().lower() in CATALOG_REQUIRED_COLUMNS,
+            dtype=str,
+            skipinitialspace=True,
+        )
+    except pd.errors.EmptyDataError:
+        raise ValueError("CSV файл порожній")
+
+    df.columns = [column.strip().lower() for column in df.columns]
+    missing = [column for column in CATALOG_REQUIRED_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"CSV не містить обов'язкових колонок: {', '.join(missing)}")
+
+    names = df["item_name"].str.strip().str.lower()
+    prices = pd.to_numeric(df["price"].str.strip(), errors="coerce")
+    valid = names.notna() & (names != "") & prices.notna()
+    # int() відкидає дробову частину - так само як і раніше при ручному розборі
+    prices = prices[valid].astype("int64")
+    names = names[valid]
+    nonzero = prices != 0
+
+    # dict(zip(...)) залишає останню ціну для дублікатів, як і попередній цикл
+    catalog = dict(zip(names[nonzero].tolist(), prices[nonzero].tolist()))
+    skipped = int(len(df) - nonzero.sum())
+    return catalog, skipped
+
+
+def save_catalog_version(catalog: dict, source: str = "") -> str:
+    """Записати нову версію каталогу і атомарно зробити її активною"""
+    version = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    conn = get_catalog_db()
+    with _catalog_db_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO catalog_versions (version, created_at, item_count, source) VALUES (?, ?, ?, ?)",
+                (version, datetime.now().isoformat(), len(catalog), source),
+            )
+            conn.executemany(
+                "INSERT INTO catalog_items (version, item_name, price) VALUES (?, ?, ?)",
+                ((version, name, price) for name, price in catalog.items()),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('active_version', ?)",
+                (version,),
+            )
+            # Старі версії більше не потрібні: читачі в WAL режимі дочитають свій знімок
+            conn.execute("DELETE FROM catalog_items WHERE version != ?", (version,))
+            conn.execute("DELETE FROM catalog_versions WHERE version != ?", (version,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return version
+
+
+def load_active_catalog() -> tuple:
+    """Прочитати активну версію каталогу з SQLite. Повертає (version, catalog) або (None, None)"""
+    conn = get_catalog_db()
+    with _catalog_db_lock:
+        # Одна read-транзакція, щоб вказівник і товари були з одного знімку
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'active_version'").fetchone()
+            if not row:
+                return None, None
+            items = conn.execute(
+                "SELECT item_name, price FROM catalog_items WHERE version = ?", (row[0],)
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+    return row[0], dict(items)
+
+
+# ==================== FUZZY CATALOG INDEX ====================
+# Нечіткий пошук товарів за символьними триграмами: для кожної триграми
+# зберігається posting list з id товарів. Кандидати рахуються через numpy
+# тільки по рідкісних триграмах (обмежений обсяг роботи), а часті триграми
+# перевіряються підрядком лише для кількох найкращих кандидатів.
+FUZZY_MATCH_LIMIT = 5
+FUZZY_MATCH_MIN_SCORE = 0.35
+_NON_ALNUM_RE = re.compile(r"[\W_]+")
+
+
+def normalize_catalog_key(name: str) -> str:
+    """Нормалізувати назву для нечіткого пошуку ("Mac Book-Pro" -> "macbookpro")"""
+    return _NON_ALNUM_RE.sub("", name.lower())
+
+
+def catalog_trigrams(normalized: str) -> set:
+    """Множина триграм з маркерами початку/кінця рядка"""
+    padded = f"${normalized}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CatalogIndex:
+    """Триграмний індекс назв товарів з інкрементальним оновленням"""
+
+    MAX_CANDIDATE_POSTINGS = 20000  # Скільки id максимум рахуємо через numpy за запит
+    RERANK_CANDIDATES = 64  # Скільки кандидатів доуточнюємо частими триграмами
+    REBUILD_TOMBSTONE_RATIO = 0.25
+
+    def __init__(self, names=()):
+        self._lock = threading.Lock()  # структури індексу (пошук і підміна)
+        self._sync_lock = threading.Lock()  # одна синхронізація за раз
+        self._reset()
+        self.sync(names)
+
+    def _reset(self):
+        self.names = []  # id -> назва (None для видалених)
+        self.padded = []  # id -> "$нормалізована$" для перевірки підрядком
+        self.sizes = []  # id -> кількість триграм назви
+        self.ids = {}  # назва -> id
+        self.by_normalized = {}  # нормалізована назва -> id (точний збіг без пробілів/регістру)
+        self.postings = {}  # триграма -> [id, ...]
+        self._arrays = {}  # триграма -> np.ndarray (кеш, інвалідовується при додаванні)
+        self.tombstones = 0
+
+    def _add(self, name: str):
+        item_id = len(self.names)
+        normalized = normalize_catalog_key(name)
+        grams = catalog_trigrams(normalized)
+        self.names.append(name)
+        self.padded.append(f"${normalized}$")
+        self.sizes.append(len(grams))
+        self.ids[name] = item_id
+        self.by_normalized.setdefault(normalized, item_id)
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                self.postings[gram] = [item_id]
+            else:
+                posting.append(item_id)
+                self._arrays.pop(gram, None)
+
+    def _build(self, names):
+        """Швидка побудова з нуля (без інвалідації кешів по кожній триграмі)"""
+        postings = {}
+        padded_list, sizes = self.padded, self.sizes
+        by_normalized = self.by_normalized
+        for item_id, name in enumerate(names):
+            normalized = normalize_catalog_key(name)
+            padded = f"${normalized}$"
+            grams = {padded[i:i + 3] for i in range(len(padded) - 2)}
+            padded_list.append(padded)
+            sizes.append(len(grams))
+            by_normalized.setdefault(normalized, item_id)
+            for gram in grams:
+                posting = postings.get(gram)
+                if posting is None:
+                    postings[gram] = [item_id]
+                else:
+                    posting.append(item_id)
+        self.names = list(names)
+        self.ids = {name: item_id for item_id, name in enumerate(self.names)}
+        self.postings = postings
+
+    def _remove(self, name: str):
+        item_id = self.ids.pop(name)
+        normalized = self.padded[item_id][1:-1]
+        self.names[item_id] = None
+        if self.by_normalized.get(normalized) == item_id:
+            del self.by_normalized[normalized]
+        self.tombstones += 1
+
+    def sync(self, names):
+        """
+        Привести індекс у відповідність до нового набору назв (інкрементально, якщо змін небагато)
+
+        Синхронізації виконуються по черзі (_sync_lock): інакше повільна перебудова старого
+        набору могла б завершитись після новішої і підмінити її результат.
+        """
+        new_names = set(names)
+        with self._sync_lock:
+            self._sync(new_names)
+
+    def _sync(self, new_names: set):
+        with self._lock:
+            current = set(self.ids)
+            removed = current - new_names
+            added = new_names - current
+            if not removed and not added:
+                return
+            changes = len(removed) + len(added)
+            tombstones_after = self.tombstones + len(removed)
+            incremental = (
+                changes <= max(len(new_names) // 2, 1000)
+                and tombstones_after <= self.REBUILD_TOMBSTONE_RATIO * max(len(new_names), 1)
+            )
+            if incremental:
+                for name in removed:
+                    self._remove(name)
+                for name in sorted(added):
+                    self._add(name)
+                return
+
+        # Повна перебудова поза _lock, щоб пошук не чекав; потім підміна структур
+        rebuilt = CatalogIndex.__new__(CatalogIndex)
+        rebuilt._reset()
+        rebuilt._build(sorted(new_names))
+        with self._lock:
+            self.__dict__.update({key: value for key, value in rebuilt.__dict__.items() if key not in ("_lock", "_sync_lock")})
+
+    def _posting_array(self, gram: str):
+        array = self._arrays.get(gram)
+        if array is None:
+            array = np.fromiter(self.postings[gram], dtype=np.int32, count=len(self.postings[gram]))
+            self._arrays[gram] = array
+        return array
+
+    def search(self, query: str, limit: int = FUZZY_MATCH_LIMIT) -> list:
+        """Повернути до limit найкращих збігів як [(назва, score)], score - коефіцієнт Дайса по триграмах"""
+        normalized = normalize_catalog_key(query)
+        if not normalized:
+            return []
+        with self._lock:
+            exact_id = self.by_normalized.get(normalized)
+            query_grams = catalog_trigrams(normalized)
+            known = sorted((gram for gram in query_grams if gram in self.postings), key=lambda g: len(self.postings[g]))
+            if not known:
+                return [(self.names[exact_id], 1.0)] if exact_id is not None else []
+
+            # Рідкісні триграми рахуємо векторно, решту - перевіряємо підрядком у кандидатів
+            rare, budget = [], 0
+            for gram in known:
+                if rare and budget + len(self.postings[gram]) > self.MAX_CANDIDATE_POSTINGS:
+                    break
+                rare.append(gram)
+                budget += len(self.postings[gram])
+            common = known[len(rare):]
+
+            hits = np.concatenate([self._posting_array(gram)[:self.MAX_CANDIDATE_POSTINGS] for gram in rare])
+            candidates, counts = np.unique(hits, return_counts=True)
+            if len(candidates) > self.RERANK_CANDIDATES:
+                top = np.argpartition(-counts, self.RERANK_CANDIDATES)[:self.RERANK_CANDIDATES]
+                candidates, counts = candidates[top], counts[top]
+
+            scored = []
+            query_size = len(query_grams)
+            for item_id, count in zip(candidates.tolist(), counts.tolist()):
+                name = self.names[item_id]
+                if name is None:
+                    continue
+                padded = self.padded[item_id]
+                shared = count + sum(1 for gram in common if gram in padded)
+                scored.append((2.0 * shared / (query_size + self.sizes[item_id]), name))
+
+            if exact_id is not None:
+                scored.append((1.0, self.names[exact_id]))
+
+        best = {}
+        for score, name in scored:
+            if score > best.get(name, -1.0):
+                best[name] = score
+        ranked = sorted(best.items(), key=lambda pair: (-pair[1], pair[0]))
+        return ranked[:limit]
+
+
+CATALOG_INDEX = CatalogIndex(PRODUCT_CATALOG)
+
+
+# Активації каталогу (завантаження, оновлення з SQLite / сховища стану) йдуть по черзі -
+# індекс і PRODUCT_CATALOG завжди з однієї версії
+_catalog_activate_lock = threading.RLock()
+
+
+def activate_catalog(version: str, catalog: dict):
+    """Оновити нечіткий індекс і підмінити in-memory каталог однією операцією присвоєння"""
+    global PRODUCT_CATALOG, CATALOG_VERSION
+    with _catalog_activate_lock:
+        CATALOG_INDEX.sync(catalog)
+        CATALOG_VERSION, PRODUCT_CATALOG = version, catalog
+
+
+def refresh_catalog_if_changed():
+    """Підхопити каталог, завантажений іншим воркером (дешева перевірка PRAGMA data_version)"""
+    global _catalog_data_version
+    try:
+        conn = get_catalog_db()
+        with _catalog_db_lock:
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != _catalog_data_version:
+            _catalog_data_version = data_version
+            # Читання під локом активації: знімок не старіший за вже активовану версію
+            with _catalog_activate_lock:
+                version, catalog = load_active_catalog()
+                if version and version != CATALOG_VERSION:
+                    activate_catalog(version, catalog)
+                    logger.info("🔄 Каталог оновлено до версії %s (%d товарів)", version, len(catalog))
+    except Exception as e:
+        logger.warning("⚠️  Помилка оновлення каталогу з SQLite: %s", e)
+    sync_catalog_from_state()
+
+
+# Між хостами (STATE_BACKEND=redis) catalog.db не спільний - активна версія публікується в сховище стану
+CATALOG_SYNC_INTERVAL = 2.0  # секунд між перевірками сховища
+_catalog_synced_at = 0.0
+
+
+def publish_catalog(version: str, catalog: dict):
+    """Опублікувати версію каталогу для інших хостів (тільки мережеве сховище)"""
+    if not state.networked:
+        return
+    previous = state.get("catalog", "active")
+    state.set("catalog_versions", version, catalog)
+    state.set("catalog", "active", version)
+    if previous and previous != version:
+        state.delete("catalog_versions", previous)
+
+
+def sync_catalog_from_state():
+    """Підхопити каталог, опублікований іншим хостом (не частіше ніж раз на CATALOG_SYNC_INTERVAL)"""
+    global _catalog_synced_at
+    now = time.monotonic()
+    if not state.networked or now - _catalog_synced_at < CATALOG_SYNC_INTERVAL:
+        return
+    _catalog_synced_at = now
+    try:
+        version = state.get("catalog", "active")
+        if not version or version == CATALOG_VERSION:
+            return
+        catalog = state.get("catalog_versions", version)
+        if catalog is not None:
+            activate_catalog(version, catalog)
+            logger.info("🔄 Каталог оновлено зі сховища стану до версії %s (%d товарів)", version, len(catalog))
+    except Exception as e:
+        logger.warning("⚠️  Помилка оновлення каталогу зі сховища стану: %s", e)
+
+
 
 # ==================== AGENT TOOLS ====================
-def get_item_price(item_name: str):
-    """Отримати ціну товару з каталогу"""
-    global PRODUCT_CATALOG
+SHIPPING_BASE_COST = 50  # Фіксована вартість доставки
+SHIPPING_RATE = 0.05  # Відсоток від вартості товару
+
+
+def lookup_catalog_item(item_name: str, catalog: Optional[dict] = None) -> dict:
+    """Знайти товар у каталозі: точний збіг, інакше нечіткий пошук по триграмному індексу"""
+    if catalog is None:
+        catalog = PRODUCT_CATALOG
     key = item_name.lower().strip()
-    price = PRODUCT_CATALOG.get(key)
+    price = catalog.get(key)
     if price:
-        return json.dumps({"item": item_name, "price": price})
-    # Спробувати знайти частковий збіг
-    for k, v in PRODUCT_CATALOG.items():
-        if k in key or key in k:
-            return json.dumps({"item": k, "price": v})
-    return json.dumps({"error": "Not found"})
+        CACHE_REQUESTS.labels("catalog", "hit").inc()
+        return {"item": item_name, "price": price}
+    # Нечіткий пошук по триграмному індексу (опечатки, пробіли, часткові назви)
+    matches = [(name, score) for name, score in CATALOG_INDEX.search(key) if name in catalog]
+    fuzzy_hit = bool(matches) and matches[0][1] >= FUZZY_MATCH_MIN_SCORE
+    CACHE_REQUESTS.labels("catalog", "fuzzy" if fuzzy_hit else "miss").inc()
+    if fuzzy_hit:
+        name, score = matches[0]
+        result = {"item": name, "price": catalog[name], "score": round(score, 3)}
+        alternatives = [
+            {"item": alt_name, "price": catalog[alt_name], "score": round(alt_score, 3)}
+            for alt_name, alt_score in matches[1:]
+            if alt_score >= FUZZY_MATCH_MIN_SCORE
+        ]
+        if alternatives:
+            result["alternatives"] = alternatives
+        return result
+    if matches:
+        return {"error": "Not found", "suggestions": [name for name, _ in matches]}
+    return {"error": "Not found"}
+
+
+def get_item_price(item_name: str):
+    """Отримати ціну товару з каталогу"""
+    refresh_catalog_if_changed()
+    return json.dumps(lookup_catalog_item(item_name))
 
 
 def calculate_shipping(destination: str, price: int):
     """Розрахувати вартість доставки"""
-    base_shipping = 50
-    percentage = int(price) * 0.05
+    base_shipping = SHIPPING_BASE_COST
+    percentage = int(price) * SHIPPING_RATE
     total = base_shipping + percentage
     return json.dumps({"destination": destination, "base_price": price, "shipping": total, "total": int(price) + total})
 
 
-def book_meeting(topic: str, datetime_str: str, participants: str = ""):
-    """Забронювати зустріч через Google Calendar"""
+def build_quote(items: list, destination: str = "") -> dict:
+    """
+    Порахувати ціни та доставку для кошика товарів за один прохід
+
+    items - список {"item_name", "quantity", "destination"} (або просто назв).
+    Доставка для кожної позиції рахується як у calculate_shipping, але
+    векторно для всього кошика одразу. Позиції з кількістю, що не є цілим
+    числом >= 1, не рахуються, а повертаються в invalid.
+    """
+    refresh_catalog_if_changed()
+    catalog = PRODUCT_CATALOG
+
+    lines = []
+    not_found = []
+    invalid = []
+    for entry in items or []:
+        if isinstance(entry, str):
+            entry = {"item_name": entry}
+        if not isinstance(entry, dict):
+            continue
+        requested = str(entry.get("item_name", "")).strip()
+        if not requested:
+            continue
+        quantity = entry.get("quantity")
+        if quantity is None:
+            quantity = 1
+        elif isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+            invalid.append({"item": requested, "quantity": quantity, "error": "Кількість має бути цілим числом >= 1"})
+            continue
+        match = lookup_catalog_item(requested, catalog)
+        if "error" in match:
+            not_found.append({"item": requested, **match})
+            continue
+        line = {
+            "item": match["item"],
+            "requested": requested,
+            "price": match["price"],
+            "quantity": quantity,
+            "destination": str(entry.get("destination") or destination or ""),
+        }
+        if "score" in match:
+            line["score"] = match["score"]
+        lines.append(line)
+
+    if not lines:
+        message = "Жоден товар не знайдено в каталозі" if not_found or not invalid else "Жодної позиції з коректною кількістю"
+        error = {"error": message, "not_found": not_found}
+        if invalid:
+            error["invalid"] = invalid
+        return error
+
+    # Вся арифметика - масивами numpy за один прохід
+    prices = np.fromiter((line["price"] for line in lines), dtype=np.int64, count=len(lines))
+    quantities = np.fromiter((line["quantity"] for line in lines), dtype=np.int64, count=len(lines))
+    subtotals = prices * quantities
+    shipping = SHIPPING_BASE_COST + subtotals * SHIPPING_RATE
+    totals = subtotals + shipping
+
+    for line, subtotal, line_shipping, total in zip(lines, subtotals.tolist(), shipping.tolist(), totals.tolist()):
+        line["subtotal"] = subtotal
+        line["shipping"] = round(line_shipping, 2)
+        line["total"] = round(total, 2)
+
+    # Підсумки по кожному напрямку доставки
+    destination_names, destination_index = np.unique(
+        np.array([line["destination"] for line in lines]), return_inverse=True
+    )
+    by_destination = {}
+    for column, values in (("subtotal", subtotals), ("shipping", shipping), ("total", totals)):
+        sums = np.bincount(destination_index, weights=values, minlength=len(destination_names))
+        for name, value in zip(destination_names.tolist(), sums.tolist()):
+            by_destination.setdefault(name, {})[column] = round(value, 2)
+
+    quote = {
+        "lines": lines,
+        "destinations": by_destination,
+        "items_count": int(quantities.sum()),
+        "subtotal": int(subtotals.sum()),
+        "shipping": round(float(shipping.sum()), 2),
+        "total": round(float(totals.sum()), 2),
+    }
+    if not_found:
+        quote["not_found"] = not_found
+    if invalid:
+        quote["invalid"] = invalid
+    return quote
+
+
+def quote_basket(items: list, destination: str = ""):
+    """Порахувати ціни та доставку для кількох товарів одним викликом тулу"""
+    return json.dumps(build_quote(items, destination))
+
+
+def book_meeting(topic: str, datetime_str: str, participants: str = "", event_id: Optional[str] = None):
+    """Забронювати зустріч через Google Calendar (event_id робить повторну вставку ідемпотентною)"""
     if not GOOGLE_AVAILABLE:
         return json.dumps({"error": "Google API не доступний"})
     
@@ -393,7 +1615,15 @@ def book_meeting(topic: str, datetime_str: str, participants: str = ""):
                 'timeZone': 'Europe/Kiev',
             },
         }
-        res = service.events().insert(calendarId='primary', body=event).execute()
+        if event_id:
+            event['id'] = event_id
+        try:
+            res = service.events().insert(calendarId='primary', body=event).execute()
+        except Exception as e:
+            # 409 - подія з цим id вже існує (попередня спроба встигла її створити)
+            if not event_id or getattr(getattr(e, "resp", None), "status", None) != 409:
+                raise
+            res = service.events().get(calendarId='primary', eventId=event_id).execute()
         return json.dumps({
             "status": "success",
             "link": res.get('htmlLink'),
@@ -437,6 +1667,7 @@ def send_email(recipient: str, subject: str, body: str):
 available_functions = {
     "get_item_price": get_item_price,
     "calculate_shipping": calculate_shipping,
+    "quote_basket": quote_basket,
     "book_meeting": book_meeting,
     "send_email": send_email,
 }
@@ -470,6 +1701,32 @@ all_tools_schema = [
             },
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "quote_basket",
+            "description": "Price several products and calculate their shipping in ONE call. Use this instead of calling get_item_price and calculate_shipping repeatedly when the user asks about more than one item or a whole basket.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "items": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "item_name": {"type": "string"},
+                                "quantity": {"type": "integer", "minimum": 1},
+                                "destination": {"type": "string"},
+                            },
+                            "required": ["item_name"],
+                        },
+                    },
+                    "destination": {"type": "string"},
+                },
+                "required": ["items"],
+            },
+        },
+    },
     {
         "type": "function",
         "function": {
@@ -510,18 +1767,325 @@ def get_enabled_tools(settings: dict):
     tool_settings = settings.get("enabledTools", {})
     
     # За замовчуванням всі тули увімкнені
-    if tool_settings.get("get_item_price", True):
-        enabled_tools.append(all_tools_schema[0])
-    if tool_settings.get("calculate_shipping", True):
-        enabled_tools.append(all_tools_schema[1])
-    if tool_settings.get("book_meeting", True):
-        enabled_tools.append(all_tools_schema[2])
-    if tool_settings.get("send_email", True):
-        enabled_tools.append(all_tools_schema[3])
+    for tool_schema in all_tools_schema:
+        if tool_settings.get(tool_schema["function"]["name"], True):
+            enabled_tools.append(tool_schema)
     
     return enabled_tools if enabled_tools else all_tools_schema
 
 
+# ==================== OUTBOX (SIDE-EFFECT TOOLS) ====================
+# send_email та book_meeting не виконуються в циклі агента: тул записує задачу
+# в durable outbox (SQLite) і одразу повертає "accepted". Воркери в фонових
+# потоках доставляють задачі з повторними спробами. Ключ ідемпотентності
+# виводиться з thread_id + назви тулу + аргументів, тому повтор усього /chat
+# не відправить той самий лист двічі.
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").lower() == "true"
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", "./outbox.db")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE_SECONDS = 2.0
+OUTBOX_RETRY_MAX_SECONDS = 300.0
+OUTBOX_LEASE_SECONDS = 300  # Задача "in_progress" довше цього вважається покинутою (воркер впав)
+OUTBOX_IDEMPOTENCY_WINDOW = 3600  # Однаковий виклик тулу в межах години - той самий запис
+OUTBOX_TOOLS = {"send_email", "book_meeting"}
+
+_outbox_local = threading.local()
+_outbox_wakeup = threading.Event()
+_outbox_stop = threading.Event()
+_outbox_threads = []
+
+
+def _outbox_db():
+    """SQLite з'єднання з outbox (окреме на кожен потік)"""
+    conn = getattr(_outbox_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(OUTBOX_DB_PATH, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                idempotency_key TEXT NOT NULL,
+                tool TEXT NOT NULL,
+                args TEXT NOT NULL,
+                thread_id TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+            CREATE INDEX IF NOT EXISTS outbox_key ON outbox (idempotency_key, created_at);
+        """)
+        _outbox_local.conn = conn
+    return conn
+
+
+def outbox_idempotency_key(tool: str, args: dict, thread_id: Optional[str]) -> str:
+    """Ключ ідемпотентності з виклику тулу (нечутливий до порядку аргументів)"""
+    payload = json.dumps({"thread_id": thread_id or "", "tool": tool, "args": args}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def outbox_record(row) -> dict:
+    """Перетворити рядок outbox на відповідь для API / тулу"""
+    record = {
+        "outbox_id": row["id"],
+        "tool": row["tool"],
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "created_at": datetime.fromtimestamp(row["created_at"]).isoformat(),
+        "updated_at": datetime.fromtimestamp(row["updated_at"]).isoformat(),
+    }
+    if row["result"]:
+        record["result"] = json.loads(row["result"])
+    if row["last_error"]:
+        record["last_error"] = row["last_error"]
+    return record
+
+
+def enqueue_outbox(tool: str, args: dict, thread_id: Optional[str] = None) -> str:
+    """Поставити side-effect тул у чергу і одразу повернути "accepted" (JSON для LLM)"""
+    key = outbox_idempotency_key(tool, args, thread_id)
+    now = time.time()
+    conn = _outbox_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        existing = conn.execute(
+            # failed записи не рахуються - повтор після остаточної помилки ставить задачу заново
+            "SELECT * FROM outbox WHERE idempotency_key = ? AND created_at >= ? "
+            "AND status IN ('pending', 'in_progress', 'delivered') ORDER BY created_at DESC LIMIT 1",
+            (key, now - OUTBOX_IDEMPOTENCY_WINDOW),
+        ).fetchone()
+        if existing is None:
+            # id збігається з ключем для першого запису - його ж використовуємо як event id в Calendar
+            outbox_id = key if not conn.execute("SELECT 1 FROM outbox WHERE id = ?", (key,)).fetchone() else f"{key}{int(now)}"
+            conn.execute(
+                "INSERT INTO outbox (id, idempotency_key, tool, args, thread_id, status, created_at, updated_at, next_attempt_at) "
+                "VALUES (?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+                (outbox_id, key, tool, json.dumps(args, ensure_ascii=False), thread_id, now, now, now),
+            )
+            row = conn.execute("SELECT * FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+        else:
+            row = existing
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    _outbox_wakeup.set()
+    record = outbox_record(row)
+    if existing is None:
+        record["status"] = "accepted"
+    else:
+        record["duplicate"] = True
+    record["status_url"] = f"/outbox/{row['id']}"
+    if tool == "send_email":
+        record["message"] = f"Лист для {args.get('recipient', '')} прийнято до відправки"
+    elif tool == "book_meeting":
+        record["message"] = f"Зустріч '{args.get('topic', '')}' прийнято до бронювання"
+    return json.dumps(record)
+
+
+def _outbox_claim():
+    """Взяти одну задачу, готову до виконання (атомарно між воркерами і процесами)"""
+    now = time.time()
+    conn = _outbox_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT * FROM outbox WHERE (status = 'pending' AND next_attempt_at <= ?) "
+            "OR (status = 'in_progress' AND updated_at < ?) ORDER BY next_attempt_at LIMIT 1",
+            (now, now - OUTBOX_LEASE_SECONDS),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE outbox SET status = 'in_progress', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (now, row["id"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+
+class OutboxPermanentError(RuntimeError):
+    """Помилка, яку повтор не виправить (немає бібліотек, авторизації) - задача одразу failed"""
+
+
+def _outbox_check_google():
+    """Чи можуть Google тули виконатися взагалі (інакше OutboxPermanentError)"""
+    if not GOOGLE_AVAILABLE:
+        raise OutboxPermanentError("Google API бібліотеки не встановлено")
+    try:
+        creds = get_google_credentials()
+    except Exception as e:
+        # Відкликаний refresh token (invalid_grant) - тільки повторна авторизація
+        if isinstance(e, google_lib.get().RefreshError) and not getattr(e, "retryable", False):
+            raise OutboxPermanentError(f"Google авторизація недійсна, запустіть auth_google.py: {e}") from e
+        raise
+    if creds is None:
+        raise OutboxPermanentError(f"Google авторизація не налаштована: немає {TOKEN_PATH}")
+
+
+def _outbox_deliver(row) -> dict:
+    """Виконати side-effect тул. Кидає RuntimeError якщо тул повернув помилку"""
+    if row["tool"] not in OUTBOX_TOOLS:
+        raise OutboxPermanentError(f"Невідомий тул в outbox: {row['tool']}")
+    _outbox_check_google()
+    args = json.loads(row["args"])
+    if row["tool"] == "send_email":
+        result = send_email(args.get("recipient", ""), args.get("subject", ""), args.get("body", ""))
+    elif row["tool"] == "book_meeting":
+        result = book_meeting(
+            args.get("topic", ""),
+            args.get("datetime_str", ""),
+            args.get("participants", ""),
+            event_id=row["id"],
+        )
+    else:
+        raise RuntimeError(f"Невідомий тул в outbox: {row['tool']}")
+    parsed = json.loads(result)
+    if "error" in parsed:
+        raise RuntimeError(parsed["error"])
+    return parsed
+
+
+def _outbox_process(row):
+    """Виконати задачу і записати результат або запланувати повторну спробу"""
+    request_id_var.set(f"outbox-{row['id'][:8]}")
+    conn = _outbox_db()
+    attempts = row["attempts"] + 1
+    started = time.perf_counter()
+    try:
+        result = _outbox_deliver(row)
+        TOOL_LATENCY.labels(row["tool"], "delivered").observe(time.perf_counter() - started)
+        conn.execute(
+            "UPDATE outbox SET status = 'delivered', result = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+            (json.dumps(result, ensure_ascii=False), time.time(), row["id"]),
+        )
+        logger.info("📬 Outbox: %s %s доставлено (спроба %d)", row["tool"], row["id"][:8], attempts)
+    except Exception as e:
+        TOOL_LATENCY.labels(row["tool"], "delivery_error").observe(time.perf_counter() - started)
+        if attempts >= OUTBOX_MAX_ATTEMPTS or isinstance(e, OutboxPermanentError):
+            status, next_attempt = "failed", time.time()
+            logger.error("❌ Outbox: %s %s не доставлено (спроба %d): %s", row["tool"], row["id"][:8], attempts, e)
+        else:
+            # Експоненційний backoff з jitter
+            delay = min(OUTBOX_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), OUTBOX_RETRY_MAX_SECONDS)
+            status, next_attempt = "pending", time.time() + delay * random.uniform(0.5, 1.5)
+            logger.warning("⚠️  Outbox: %s %s помилка (спроба %d), повтор через %.0fс: %s", row["tool"], row["id"][:8], attempts, delay, e)
+        conn.execute(
+            "UPDATE outbox SET status = ?, last_error = ?, updated_at = ?, next_attempt_at = ? WHERE id = ?",
+            (status, str(e), time.time(), next_attempt, row["id"]),
+        )
+
+
+def _outbox_worker():
+    """Фоновий воркер: розбирає outbox, поки не зупинено"""
+    while not _outbox_stop.is_set():
+        try:
+            row = _outbox_claim()
+        except Exception as e:
+            logger.warning("⚠️  Outbox: помилка читання черги: %s", e)
+            row = None
+        if row is None:
+            # Чекати нову задачу або час наступної повторної спроби
+            _outbox_wakeup.wait(timeout=1.0)
+            _outbox_wakeup.clear()
+            continue
+        try:
+            _outbox_process(row)
+        except Exception as e:
+            # Напр. database is locked на фінальному UPDATE: задача залишається in_progress і
+            # повернеться в чергу після OUTBOX_LEASE_SECONDS, а воркер працює далі
+            logger.error("❌ Outbox: помилка обробки %s %s: %s", row["tool"], row["id"][:8], e)
+            _outbox_stop.wait(1.0)
+
+
+def start_outbox_workers():
+    """Запустити пул воркерів outbox"""
+    if not OUTBOX_ENABLED or _outbox_threads:
+        return
+    _outbox_stop.clear()
+    for i in range(OUTBOX_WORKERS):
+        worker = threading.Thread(target=_outbox_worker, name=f"outbox-{i}", daemon=True)
+        worker.start()
+        _outbox_threads.append(worker)
+    logger.info("📬 Outbox: запущено %d воркерів (%s)", OUTBOX_WORKERS, OUTBOX_DB_PATH)
+
+
+def stop_outbox_workers():
+    """Зупинити воркери outbox (поточні задачі завершуються)"""
+    _outbox_stop.set()
+    _outbox_wakeup.set()
+    for worker in _outbox_threads:
+        worker.join(timeout=5)
+    _outbox_threads.clear()
+
+
+def get_outbox_status(outbox_id: str) -> Optional[dict]:
+    """Статус доставки задачі outbox"""
+    row = _outbox_db().execute("SELECT * FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+    return outbox_record(row) if row else None
+
+
+def outbox_pending_count() -> int:
+    """Кількість задач outbox, що ще чекають доставки"""
+    return _outbox_db().execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+
+OUTBOX_PENDING = Gauge("outbox_pending_tasks", "Задачі outbox, що чекають доставки")
+if OUTBOX_ENABLED:
+    OUTBOX_PENDING.set_function(outbox_pending_count)
+
+
+def execute_tool(func_name: str, args: dict, thread_id: Optional[str] = None) -> str:
+    """Викликати тул з аргументами від LLM (side-effect тули - через outbox)"""
+    started = time.perf_counter()
+    status = "error"
+    try:
+        if OUTBOX_ENABLED and func_name in OUTBOX_TOOLS:
+            result = enqueue_outbox(func_name, args, thread_id)
+            status = "queued"
+        else:
+            result = _dispatch_tool(func_name, args)
+            status = "ok"
+        return result
+    finally:
+        TOOL_LATENCY.labels(func_name, status).observe(time.perf_counter() - started)
+
+
+def _dispatch_tool(func_name: str, args: dict) -> str:
+    """Виклик функції тулу з аргументами зі схеми"""
+    func = available_functions[func_name]
+    if func_name == "get_item_price":
+        return func(args.get("item_name", ""))
+    elif func_name == "calculate_shipping":
+        return func(args.get("destination", ""), args.get("price", 0))
+    elif func_name == "quote_basket":
+        return func(args.get("items", []), args.get("destination", ""))
+    elif func_name == "book_meeting":
+        return func(
+            args.get("topic", ""),
+            args.get("datetime_str", ""),
+            args.get("participants", "")
+        )
+    elif func_name == "send_email":
+        return func(
+            args.get("recipient", ""),
+            args.get("subject", ""),
+            args.get("body", "")
+        )
+    return func(**args)
+
+
 # ==================== MODEL SELECTION LOGIC ====================
 def normalize_messages(messages: List[dict], system_prompt: str) -> List[dict]:
     """Нормалізувати messages для OpenAI API"""
@@ -625,6 +2189,9 @@ def normalize_messages(messages: List[dict], system_prompt: str) -> List[dict]:
                 if len(content_str) > MAX_MESSAGE_LENGTH:
                     content_str = content_str[:MAX_MESSAGE_LENGTH] + "... [обрізано]"
                 normalized.append({"role": "assistant", "content": content_str})
+        elif role == "system":
+            # Додаткові system повідомлення (зведення історії, RAG контекст) - як є
+            normalized.append({"role": "system", "content": content if isinstance(content, str) else str(content or "")})
         elif role == "tool":
             # Tool message - обрізати результат якщо занадто великий
             MAX_MESSAGE_LENGTH = 8000
@@ -649,13 +2216,46 @@ def normalize_messages(messages: List[dict], system_prompt: str) -> List[dict]:
     return normalized
 
 
+# ==================== MODEL ROUTER ====================
+# Який маршрутизатор обслуговує "auto" (learned / heuristic); інший працює в тіні для звіту
+ROUTER_MODE = os.getenv("ROUTER_MODE", "learned")
+ROUTER_WEIGHTS_PATH = os.getenv("ROUTER_WEIGHTS_PATH", "./router_weights.json")
+ROUTER_LOG_PATH = os.getenv("ROUTER_LOG_PATH", "./router_log.jsonl")
+# Скільки символів повідомлення пишеться в лог (0 - тільки sha256 і ознаки) та ротація за розміром
+ROUTER_LOG_MESSAGE_CHARS = int(os.getenv("ROUTER_LOG_MESSAGE_CHARS", "200"))
+ROUTER_LOG_MAX_BYTES = int(os.getenv("ROUTER_LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+ROUTER_LOG_BACKUPS = int(os.getenv("ROUTER_LOG_BACKUPS", "3"))
+# Частка запитів, які learned роутер віддає малій моделі всупереч рішенню - дає мітки для навчання
+ROUTER_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", "0"))
+ROUTER_EXPLICIT_MODELS = ["gpt-4o", "gpt-4-turbo", "gpt-4o-mini"]
+
+router_log = RouterLog(ROUTER_LOG_PATH, ROUTER_LOG_MAX_BYTES, ROUTER_LOG_BACKUPS)
+model_router = create_router(ROUTER_MODE, ROUTER_WEIGHTS_PATH)
+shadow_router = create_router(
+    HeuristicRouter.name if ROUTER_MODE == LearnedRouter.name else LearnedRouter.name,
+    ROUTER_WEIGHTS_PATH,
+)
+if isinstance(model_router, LearnedRouter):
+    logger.info("🧭 Model router: learned (%s), shadow: %s",
+                "weights " + model_router.trained_at if model_router.trained_at else "апріорні ваги", shadow_router.name)
+else:
+    logger.info("🧭 Model router: %s, shadow: %s", model_router.name, shadow_router.name)
+
+
+def route_message(message: str) -> dict:
+    """Рішення маршрутизатора для "auto" (з exploration на малу модель)"""
+    model = model_router.select(message)
+    if ROUTER_EXPLORE_RATE and model != SMALL_MODEL and random.random() < ROUTER_EXPLORE_RATE:
+        model = SMALL_MODEL
+    return {"router": model_router.name, "model": model}
+
+
 def select_model(message: str, settings: dict, use_assistants: bool = False) -> str:
     """
-    Автоматичний вибір моделі на основі складності запиту
-    
-    Правила:
-    - gpt-4o-mini: прості запити, короткі відповіді
-    - gpt-4o: складні запити, багатокрокові задачі, аналіз
+    Вибір моделі для запиту
+
+    Явно вказана модель має пріоритет; для "auto" рішення приймає model_router
+    (найдешевша модель, яка, за логом, впорається з таким запитом).
     """
     if USE_LM_STUDIO:
         return "local-model"
@@ -663,67 +2263,70 @@ def select_model(message: str, settings: dict, use_assistants: bool = False) ->
     # Отримати модель з налаштувань
     user_model = settings.get("model", "gpt-4o-mini")
     
-    # Якщо встановлено "auto", визначити автоматично
-    if user_model == "auto":
-        # Продовжити до автоматичного визначення
-        pass
     # Якщо користувач явно вказав модель, використати її
-    elif user_model in ["gpt-4o", "gpt-4-turbo", "gpt-4o-mini"]:
+    if user_model in ROUTER_EXPLICIT_MODELS:
         return user_model
     
-    # Визначити складність запиту
-    message_lower = message.lower()
-    complexity_indicators = [
-        "analyze", "compare", "explain", "why", "how", "what is",
-        "проаналізуй", "порівняй", "поясни", "чому", "як", "що таке",
-        "multiple", "several", "many", "кілька", "декілька",
-        "complex", "detailed", "складний", "детальний",
-        "calculate", "розрахуй", "порахуй",
-        "and", "також", "також", "потім", "then"
-    ]
-    
-    # Перевірити довжину запиту
-    is_long = len(message.split()) > 20
-    
-    # Перевірити наявність індикаторів складності
-    has_complexity = any(indicator in message_lower for indicator in complexity_indicators)
-    
     # Якщо використовуємо Assistants API, завжди використовуємо gpt-4o для кращої якості
     if use_assistants:
         return "gpt-4o"
     
-    # Вибрати модель
-    if has_complexity or is_long:
-        return "gpt-4o"
-    else:
-        return "gpt-4o-mini"
+    return route_message(message)["model"]
 
 
-# ==================== ASSISTANTS API FUNCTIONS ====================
-async def get_or_create_assistant(thread_id: str, settings: dict, vector_store_id: Optional[str] = None) -> Optional[str]:
-    """Створити або отримати Assistant для thread"""
-    if not client or USE_LM_STUDIO:
+def auto_quality(content: Optional[str]) -> Optional[float]:
+    """
+    Автоматичний сигнал якості для shadow-звіту (навчання бере тільки /router/feedback)
+
+    Помилка API / транспорту ("Помилка...") - не відповідь моделі, тому None.
+    Помилки інструментів (напр. товару немає в каталозі) якість не знижують:
+    коректна відповідь "не знайдено" - не провал моделі.
+    """
+    if content and content.startswith("Помилка"):
         return None
-    
-    # Перевірити кеш
-    if thread_id in assistants_cache:
-        return assistants_cache[thread_id].get("assistant_id")
-    
+    if not content or not content.strip():
+        return 0.0
+    return 0.7
+
+
+def log_router_turn(request_id: str, thread_id: str, message: str, settings: dict, model: str,
+                    latency_ms: float, usages: list, content: Optional[str], tools_used: list):
+    """Записати хід чату в лог маршрутизатора (навчання та shadow-звіт)"""
+    if USE_LM_STUDIO:
+        return
+    record = {
+        "request_id": request_id,
+        "ts": datetime.now().isoformat(),
+        "thread_id": thread_id,
+        **message_fields(message, ROUTER_LOG_MESSAGE_CHARS),
+        "model": model,
+        "latency_ms": round(latency_ms, 1),
+        "prompt_tokens": sum(getattr(u, "prompt_tokens", 0) or 0 for u in usages if u),
+        "completion_tokens": sum(getattr(u, "completion_tokens", 0) or 0 for u in usages if u),
+        "tools": [t.get("name") for t in tools_used if t.get("type") == "tool"],
+        "quality": auto_quality(content),
+    }
+    if settings.get("model", "gpt-4o-mini") not in ROUTER_EXPLICIT_MODELS:
+        record.update({
+            "router": model_router.name,
+            "shadow_router": shadow_router.name,
+            "shadow_model": shadow_router.select(message),
+        })
     try:
-        # Отримати увімкнені тули
-        enabled_tools = get_enabled_tools(settings)
-        
-        # Визначити модель
-        model = select_model("", settings, use_assistants=True)
-        
-        # System prompt
-        system_prompt = """You are an AI assistant with access to tools. You MUST use tools when user asks you to perform actions.
+        router_log.write(record)
+    except OSError as e:
+        logger.warning("⚠️  Не вдалося записати router log: %s", e)
+
+
+# ==================== ASSISTANTS API FUNCTIONS ====================
+ASSISTANT_INSTRUCTIONS = """You are an AI assistant with access to tools. You MUST use tools when user asks you to perform actions.
 
 CRITICAL RULES:
 1. If user says "send email", "надішли листа", "відправити email" - IMMEDIATELY call send_email tool
 2. If user says "book meeting", "забронювати", "schedule" - IMMEDIATELY call book_meeting tool
 3. If user asks about price - call get_item_price tool
 4. If user asks about shipping - call calculate_shipping tool
+5. If user asks about prices or shipping for several items - call quote_basket ONCE with all items
 
 DO NOT:
 - Say "I cannot send emails" - you CAN and MUST use send_email tool
@@ -739,168 +2342,304 @@ IMPORTANT: If user says "send that email" or "надішли того листа
 
 Then IMMEDIATELY call send_email tool. Do not ask questions - just do it.
 
+send_email and book_meeting are delivered in the background: a result with status "accepted" means the action was queued successfully. Tell the user it was accepted and will be completed shortly.
+
 If user mentions an email address in the conversation, remember it and use it when they ask to send email."""
-        
-        # Підготувати tools для Assistant
-        tools = []
-        for tool_schema in enabled_tools:
-            tools.append({
-                "type": "function",
-                "function": tool_schema["function"]
-            })
-        
-        # Додати file_search якщо є vector store
-        tool_resources = {}
-        if vector_store_id:
-            tools.append({"type": "file_search"})
-            tool_resources = {
-                "file_search": {
-                    "vector_store_ids": [vector_store_id]
-                }
-            }
-        
-        # Створити Assistant
-        assistant = client.beta.assistants.create(
-            name=f"Enterprise Assistant {thread_id}",
-            instructions=system_prompt,
-            model=model,
-            tools=tools,
-            tool_resources=tool_resources if tool_resources else None,
-            temperature=settings.get("temperature", 0.7),
-        )
-        
-        # Зберегти в кеш
-        assistants_cache[thread_id] = {
-            "assistant_id": assistant.id,
-            "openai_thread_id": None
-        }
-        
-        return assistant.id
+ASSISTANT_TOUCH_INTERVAL = 300.0  # секунд між оновленнями last_used одного assistant
+ASSISTANT_GC_INTERVAL = 3600.0  # секунд між проходами збирача невикористаних assistants
+_assistant_gc_at = 0.0
+_assistant_gc_task = None
+
+
+def assistant_config(settings: dict, file_search: bool = False) -> dict:
+    """Параметри assistants.create для налаштувань запиту (від них залежить відбиток)"""
+    tools = [{"type": "function", "function": tool_schema["function"]} for tool_schema in get_enabled_tools(settings)]
+    if file_search:
+        # Vector Store прив'язується до OpenAI Thread, а не до assistant - інакше assistant був би свій у кожної розмови
+        tools.append({"type": "file_search"})
+    return {
+        "model": select_model("", settings, use_assistants=True),
+        "instructions": ASSISTANT_INSTRUCTIONS,
+        "tools": tools,
+        "temperature": settings.get("temperature", 0.7),
+    }
+
+
+def assistant_fingerprint(config: dict) -> str:
+    """Відбиток конфігурації assistant (нечутливий до порядку ключів)"""
+    payload = json.dumps(config, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+async def create_assistant(fingerprint: str, config: dict) -> str:
+    """Створити Assistant у OpenAI і зареєструвати його в сховищі стану"""
+    assistant = await async_client.beta.assistants.create(
+        name=f"Enterprise Assistant {fingerprint[:12]}",
+        metadata={"fingerprint": fingerprint},
+        **config,
+    )
+    now = time.time()
+    entry = await state_io(state.setdefault, "assistant_configs", fingerprint, {
+        "assistant_id": assistant.id,
+        "model": config["model"],
+        "created_at": now,
+        "last_used": now,
+    })
+    if entry["assistant_id"] != assistant.id:
+        # Інший воркер створив такий самий assistant першим - наш зайвий
+        await delete_assistant(assistant.id)
+    return entry["assistant_id"]
+
+
+async def delete_assistant(assistant_id: str) -> bool:
+    """Видалити Assistant в OpenAI (вже видалений вважається успіхом)"""
+    try:
+        await async_client.beta.assistants.delete(assistant_id)
     except Exception as e:
-        print(f"⚠️  Помилка створення Assistant: {e}")
+        if getattr(e, "status_code", None) != 404:
+            logger.warning("⚠️  Не вдалося видалити Assistant %s: %s", assistant_id, e)
+            return False
+    return True
+
+
+async def collect_unused_assistants(ttl: float = ASSISTANT_TTL) -> int:
+    """Видалити assistants, якими не користувались довше ttl секунд; повертає кількість"""
+    deadline = time.time() - ttl
+    removed = 0
+    try:
+        for fingerprint, entry in (await state_io(state.items, "assistant_configs")).items():
+            if entry.get("last_used", 0) >= deadline:
+                continue
+            if await delete_assistant(entry["assistant_id"]):
+                await state_io(state.delete, "assistant_configs", fingerprint)
+                removed += 1
+    except Exception as e:
+        logger.warning("⚠️  Помилка збирача assistants: %s", e)
+    if removed:
+        logger.info("🧹 Видалено %d невикористаних assistants", removed)
+    return removed
+
+
+def schedule_assistant_gc():
+    """Запустити збирач у фоні, не частіше ніж раз на ASSISTANT_GC_INTERVAL"""
+    global _assistant_gc_at, _assistant_gc_task
+    now = time.monotonic()
+    if not ASSISTANT_TTL or now - _assistant_gc_at < ASSISTANT_GC_INTERVAL:
+        return
+    _assistant_gc_at = now
+    _assistant_gc_task = asyncio.create_task(collect_unused_assistants())
+
+
+async def get_or_create_assistant(settings: dict, file_search: bool = False) -> Optional[str]:
+    """Отримати Assistant з такою ж конфігурацією (спільний для всіх thread) або створити новий"""
+    if not async_client or USE_LM_STUDIO:
+        return None
+    
+    try:
+        config = assistant_config(settings, file_search)
+        fingerprint = assistant_fingerprint(config)
+        schedule_assistant_gc()
+
+        # Перевірити кеш
+        cached = await state_io(state.get, "assistant_configs", fingerprint)
+        if cached is not None:
+            CACHE_REQUESTS.labels("assistant", "hit").inc()
+            if time.time() - cached.get("last_used", 0) > ASSISTANT_TOUCH_INTERVAL:
+                await state_io(state.set, "assistant_configs", fingerprint, {**cached, "last_used": time.time()})
+            return cached["assistant_id"]
+        CACHE_REQUESTS.labels("assistant", "miss").inc()
+
+        # Одночасні нові розмови з однаковими налаштуваннями створюють один assistant
+        return await single_flight.run("assistant_create", fingerprint, lambda: create_assistant(fingerprint, config))
+    except Exception as e:
+        logger.warning("⚠️  Помилка створення Assistant: %s", e)
         return None
 
 
-async def get_or_create_thread(thread_id: str) -> Optional[str]:
-    """Створити або отримати OpenAI Thread"""
-    if not client or USE_LM_STUDIO:
+async def get_or_create_thread(thread_id: str, vector_store_id: Optional[str] = None) -> Optional[str]:
+    """Створити або отримати OpenAI Thread (з Vector Store розмови для file_search)"""
+    if not async_client or USE_LM_STUDIO:
         return None
     
+    tool_resources = {"file_search": {"vector_store_ids": [vector_store_id]}} if vector_store_id else None
+
     # Перевірити кеш
-    if thread_id in assistants_cache and assistants_cache[thread_id].get("openai_thread_id"):
-        return assistants_cache[thread_id]["openai_thread_id"]
+    cached = await state_io(state.get, "assistants", thread_id) or {}
+    openai_thread_id = cached.get("openai_thread_id")
+    if openai_thread_id and cached.get("vector_store_id") == vector_store_id:
+        return openai_thread_id
     
     try:
-        # Створити новий Thread
-        thread = client.beta.threads.create()
+        if openai_thread_id:
+            # Vector Store з'явився після створення Thread - прив'язати його
+            await async_client.beta.threads.update(openai_thread_id, tool_resources=tool_resources)
+        else:
+            # Створити новий Thread
+            thread = await async_client.beta.threads.create(tool_resources=tool_resources)
+            openai_thread_id = thread.id
         
         # Зберегти в кеш
-        if thread_id not in assistants_cache:
-            assistants_cache[thread_id] = {}
-        assistants_cache[thread_id]["openai_thread_id"] = thread.id
+        await state_io(state.set, "assistants", thread_id, {
+            **cached, "openai_thread_id": openai_thread_id, "vector_store_id": vector_store_id,
+        })
         
-        return thread.id
+        return openai_thread_id
     except Exception as e:
-        print(f"⚠️  Помилка створення Thread: {e}")
+        logger.warning("⚠️  Помилка створення Thread: %s", e)
         return None
 
 
-async def handle_assistant_tool_calls(run, openai_thread_id: str, assistant_id: str) -> List[dict]:
-    """Обробити tool calls від Assistant"""
-    tools_used = []
-    
-    if run.required_action and run.required_action.type == "submit_tool_outputs":
-        tool_calls = run.required_action.submit_tool_outputs.tool_calls
-        
-        tool_outputs = []
-        for tool_call in tool_calls:
-            func_name = tool_call.function.name
-            args = json.loads(tool_call.function.arguments)
-            
-            func = available_functions.get(func_name)
-            if func:
-                try:
-                    # Викликати функцію
-                    if func_name == "get_item_price":
-                        result = func(args.get("item_name", ""))
-                    elif func_name == "calculate_shipping":
-                        result = func(args.get("destination", ""), args.get("price", 0))
-                    elif func_name == "book_meeting":
-                        result = func(
-                            args.get("topic", ""),
-                            args.get("datetime_str", ""),
-                            args.get("participants", "")
-                        )
-                    elif func_name == "send_email":
-                        result = func(
-                            args.get("recipient", ""),
-                            args.get("subject", ""),
-                            args.get("body", "")
-                        )
-                    else:
-                        result = func(**args)
-                    
-                    tools_used.append({
-                        "type": "tool",
-                        "name": func_name,
-                        "result": str(result),
-                    })
-                    
-                    tool_outputs.append({
-                        "tool_call_id": tool_call.id,
-                        "output": str(result)
-                    })
-                except Exception as e:
-                    error_result = json.dumps({"error": str(e)})
-                    tools_used.append({
-                        "type": "tool",
-                        "name": func_name,
-                        "result": error_result,
-                    })
-                    tool_outputs.append({
-                        "tool_call_id": tool_call.id,
-                        "output": error_result
-                    })
-        
-        # Відправити результати назад
-        if tool_outputs:
-            client.beta.threads.runs.submit_tool_outputs(
-                thread_id=openai_thread_id,
-                run_id=run.id,
-                tool_outputs=tool_outputs
-            )
-    
-    return tools_used
+async def handle_assistant_tool_calls(run, openai_thread_id: str, assistant_id: str, thread_id: Optional[str] = None) -> tuple:
+    """
+    Обробити tool calls від Assistant: виконати тули паралельно і відправити результати
+
+    Повертає (tools_used, stream продовження run) - run не опитується, події йдуть тим самим стрімом.
+    """
+    tool_calls = run.required_action.submit_tool_outputs.tool_calls
+
+    async def call(tool_call) -> tuple:
+        func_name = tool_call.function.name
+        try:
+            if func_name not in available_functions:
+                raise ValueError(f"Невідомий тул: {func_name}")
+            args = json.loads(tool_call.function.arguments or "{}")
+            # Тули блокуючі (SQLite, Google API) - поза event loop
+            output = str(await run_blocking(execute_tool, func_name, args, thread_id))
+        except Exception as e:
+            output = json.dumps({"error": str(e)})
+        return func_name, tool_call.id, output
+
+    results = await asyncio.gather(*(call(tool_call) for tool_call in tool_calls))
+    tools_used = [{"type": "tool", "name": name, "result": output} for name, _, output in results]
+
+    # Кожен tool call має отримати результат, інакше run чекатиме до expired
+    stream = async_client.beta.threads.runs.submit_tool_outputs_stream(
+        thread_id=openai_thread_id,
+        run_id=run.id,
+        tool_outputs=[{"tool_call_id": call_id, "output": output} for _, call_id, output in results],
+    )
+    return tools_used, stream
+
+
+ASSISTANT_MAX_TOOL_ROUNDS = 5  # Максимум раундів requires_action в одному run
+ASSISTANT_FAILED_EVENTS = ("thread.run.failed", "thread.run.cancelled", "thread.run.expired", "thread.run.incomplete", "error")
+
+
+async def run_assistant(openai_thread_id: str, assistant_id: str, message: str, thread_id: str, tools_used: list) -> str:
+    """
+    Виконати Assistants run зі стрімом подій (без опитування runs.retrieve), повернути текст відповіді
+
+    Повідомлення користувача передається в тому ж запиті (additional_messages).
+    Виконані тули дописуються в tools_used одразу - навіть якщо run потім впаде.
+    """
+    texts = []
+    run_id = None
+    stream = async_client.beta.threads.runs.stream(
+        thread_id=openai_thread_id,
+        assistant_id=assistant_id,
+        additional_messages=[{"role": "user", "content": message}],
+    )
+    try:
+        for _ in range(ASSISTANT_MAX_TOOL_ROUNDS + 1):
+            action_run = None
+            async with stream as events:
+                async for event in events:
+                    if event.event == "thread.run.created":
+                        run_id = event.data.id
+                    elif event.event == "thread.message.completed":
+                        texts.extend(block.text.value for block in event.data.content if block.type == "text")
+                    elif event.event == "thread.run.requires_action":
+                        # Після requires_action сервер закриває стрім - далі submit_tool_outputs_stream
+                        action_run = event.data
+                    elif event.event == "thread.run.completed":
+                        record_usage(event.data.model, event.data.usage)
+                    elif event.event in ASSISTANT_FAILED_EVENTS:
+                        error = getattr(event.data, "last_error", None) or event.data
+                        raise RuntimeError(f"{event.event}: {getattr(error, 'message', error)}")
+            if action_run is None:
+                return "\n\n".join(texts)
+            round_tools, stream = await handle_assistant_tool_calls(action_run, openai_thread_id, assistant_id, thread_id)
+            tools_used.extend(round_tools)
+    except asyncio.CancelledError:
+        # Запит скасовано - зупинити run в OpenAI (інакше він генерує далі і блокує Thread для наступного run)
+        if run_id:
+            try:
+                await async_client.beta.threads.runs.cancel(run_id, thread_id=openai_thread_id)
+            except Exception as e:
+                logger.warning("⚠️  Не вдалося скасувати run %s: %s", run_id, e)
+        raise
+
+    # Модель зациклилась на тулах - не лишати run у requires_action до expired
+    await async_client.beta.threads.runs.cancel(action_run.id, thread_id=openai_thread_id)
+    raise RuntimeError(f"Перевищено {ASSISTANT_MAX_TOOL_ROUNDS} раундів tool calls")
 
 # ==================== IMAGE FUNCTIONS ====================
-# Галерея збережених генерацій
+# Галерея збережених генерацій: список "gallery" у сховищі стану
 GALLERY_FILE = "gallery.json"
+GALLERY_KEY = "gallery"
+
 
 def load_gallery():
-    """Завантажити галерею з файлу"""
-    global image_gallery
-    if os.path.exists(GALLERY_FILE):
-        try:
-            with open(GALLERY_FILE, "r", encoding="utf-8") as f:
-                image_gallery = json.load(f)
-            print(f"✅ Завантажено {len(image_gallery)} зображень з галереї")
-        except Exception as e:
-            print(f"⚠️  Помилка завантаження галереї: {e}")
-            image_gallery = []
-    else:
-        image_gallery = []
+    """Завантажити галерею з gallery.json у сховище стану"""
+    if not os.path.exists(GALLERY_FILE):
+        return
+    # Спільне сховище імпортує файл один раз (перший воркер), далі галерея живе тільки в ньому
+    if state.shared:
+        token = uuid.uuid4().hex
+        if state.setdefault("meta", "gallery_imported", token) != token:
+            return
+    try:
+        with open(GALLERY_FILE, "r", encoding="utf-8") as f:
+            items = json.load(f)
+        state.list_replace(GALLERY_KEY, items)
+        logger.info("✅ Завантажено %d зображень з галереї", len(items))
+    except Exception as e:
+        logger.warning("⚠️  Помилка завантаження галереї: %s", e)
+
+_gallery_lock = threading.Lock()
+
 
 def save_gallery():
-    """Зберегти галерею в файл"""
+    """Зберегти галерею в файл (тільки memory сховище - спільні сховища зберігають її самі)"""
+    if state.shared:
+        return
     try:
-        with open(GALLERY_FILE, "w", encoding="utf-8") as f:
-            json.dump(image_gallery, f, ensure_ascii=False, indent=2)
+        # generate_image виконується в потоках - запис під lock, атомарна заміна
+        with _gallery_lock:
+            tmp_path = f"{GALLERY_FILE}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state.list_range(GALLERY_KEY), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, GALLERY_FILE)
     except Exception as e:
-        print(f"⚠️  Помилка збереження галереї: {e}")
+        logger.warning("⚠️  Помилка збереження галереї: %s", e)
+
+# Галерея завантажується при першому зверненні або в прогріві після старту
+gallery_loaded = Lazy(load_gallery)
+
+
+def ensure_gallery():
+    gallery_loaded.get()
+
+
+# ==================== PAGINATION ====================
+MAX_PAGE_SIZE = 500
 
-# Завантажити галерею при старті
-image_gallery = []
-load_gallery()
+
+def page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def parse_fields(spec: Optional[str]) -> Optional[set]:
+    """"id,prompt" -> {"id", "prompt"}; порожньо - усі поля"""
+    fields = {field.strip() for field in (spec or "").split(",") if field.strip()}
+    return fields or None
+
+
+def project(item: dict, fields: Optional[set]) -> dict:
+    """Лишити в записі тільки потрібні клієнту поля"""
+    if not fields:
+        return item
+    return {name: value for name, value in item.items() if name in fields}
 
 def generate_image(prompt: str, model: str = "dall-e-3", size: str = "1024x1024", quality: str = "standard", style: str = "vivid"):
     """Генерація зображення через DALL-E API"""
@@ -954,13 +2693,14 @@ def generate_image(prompt: str, model: str = "dall-e-3", size: str = "1024x1024"
             "quality": quality if dall_e_model == "dall-e-3" else None,
             "style": style if dall_e_model == "dall-e-3" else None,
         }
-        image_gallery.append(gallery_item)
+        ensure_gallery()
+        state.list_append(GALLERY_KEY, gallery_item)
         save_gallery()  # Зберегти в файл
         
         return image_url, None
     except Exception as e:
         error_msg = f"Помилка генерації зображення: {str(e)}"
-        print(f"⚠️  {error_msg}")
+        logger.warning("⚠️  %s", error_msg)
         return None, error_msg
 
 
@@ -1018,24 +2758,82 @@ Provide a comprehensive answer that includes:
 
 
 # ==================== MAIN CHAT LOGIC ====================
+# Порядок частин запиту до моделі - для кешу префікса (OpenAI кешує префікс від 1024 токенів,
+# LM Studio / llama.cpp - KV cache попереднього запиту): спочатку байт-в-байт незмінне
+# (CHAT_SYSTEM_PROMPT, схеми тулів), далі зведення та історія (лише дописуються),
+# а змінне між запитами (RAG контекст) - в кінці, після повідомлення користувача
+CHAT_SYSTEM_PROMPT = """You are an AI assistant with access to tools and a knowledge base.
+
+PRIORITY ORDER:
+1. FIRST: Check if the user's question can be answered using information from the knowledge base (documents that were uploaded)
+2. SECOND: If the question cannot be answered from documents, use tools for actions (send email, book meeting, etc.)
+3. If user asks about information that should be in documents, ALWAYS check the knowledge base first before using tools
+
+CRITICAL RULES FOR TOOLS:
+- If user says "send email", "надішли листа", "відправити email" - IMMEDIATELY call send_email tool
+- If user says "book meeting", "забронювати", "schedule" - IMMEDIATELY call book_meeting tool
+- If user asks about price of items NOT in documents - call get_item_price tool
+- If user asks about shipping - call calculate_shipping tool
+- If user asks about prices or shipping for several items - call quote_basket ONCE with all items
+
+DO NOT:
+- Use tools for information that should be in the knowledge base documents
+- Say "I cannot send emails" - you CAN and MUST use send_email tool
+- Just write the email text without sending - you MUST call send_email
+- Ask for confirmation - just do it if user clearly asked
+
+When user asks you to send an email, extract:
+- recipient from the current or previous messages
+- subject (create appropriate one if not specified, use context from conversation)
+- body (use the email content from PREVIOUS conversation messages if user said "send that email" or "надішли того листа", otherwise create appropriate body)
+
+IMPORTANT: If user says "send that email" or "надішли того листа", look in the conversation history for the email content that was written earlier. Extract the full email text from previous assistant messages and use it as the body.
+
+Then IMMEDIATELY call send_email tool. Do not ask questions - just do it.
+
+send_email and book_meeting are delivered in the background: a result with status "accepted" means the action was queued successfully. Tell the user it was accepted and will be completed shortly.
+
+If user mentions an email address in the conversation, remember it and use it when they ask to send email."""
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """Головний endpoint для обробки запитів"""
+async def chat(request: ChatRequest, http_request: Request):
+    """Головний endpoint для обробки запитів (робота скасовується, якщо клієнт відключився)"""
+    use_thread_tenant(request.thread_id)
+    try:
+        return await run_cancellable(lambda: process_chat(request), http_request.receive, REQUEST_DEADLINE)
+    except RequestCancelled as e:
+        REQUESTS_CANCELLED.labels("chat", e.reason, e.stage).inc()
+        logger.info("✂️  /chat скасовано (%s) на етапі %s", e.reason, e.stage)
+        # Для disconnect відповідь ніхто не прочитає; для deadline - повідомлення про помилку
+        return ChatResponse(content=f"Помилка: час обробки запиту вичерпано ({REQUEST_DEADLINE:g} с)")
+
+
+async def process_chat(request: ChatRequest) -> ChatResponse:
+    """Обробка запиту /chat: image-gen, image-analyze або чат з RAG та агентом"""
 
     response_content = ""
     tools_used = []
     image_url = None
+    # Дані для логу маршрутизатора моделей (заповнюються тільки для текстового чату)
+    request_id = get_request_id()
+    routed_model = None
+    llm_started = 0.0
+    llm_usages = []
 
     # ===== MODE: IMAGE GENERATION =====
     if request.mode == "image-gen":
         image_settings = request.settings.get("imageSettings", {})
-        image_url, error = generate_image(
-            prompt=request.message,
-            model=image_settings.get("model", "dall-e-3"),
-            size=image_settings.get("size", "1024x1024"),
-            quality=image_settings.get("quality", "standard"),
-            style=image_settings.get("style", "vivid")
-        )
+        with chat_stage("image_generation"):
+            image_url, error = await run_shared(
+                "generate_image",
+                generate_image,
+                request.message,
+                image_settings.get("model", "dall-e-3"),
+                image_settings.get("size", "1024x1024"),
+                image_settings.get("quality", "standard"),
+                image_settings.get("style", "vivid"),
+                coalesce=False,
+            )
         if error:
             response_content = error
         else:
@@ -1047,7 +2845,8 @@ async def chat(request: ChatRequest):
         # Використати повідомлення як питання для VQA
         question = request.message if request.message.strip() else None
         detailed = request.settings.get("detailedAnalysis", True)
-        analysis = analyze_image(request.image_base64, question, detailed)
+        with chat_stage("image_analysis"):
+            analysis = await run_shared("analyze_image", analyze_image, request.image_base64, question, detailed)
         response_content = analysis
         tools_used.append({
             "type": "vision", 
@@ -1060,19 +2859,12 @@ async def chat(request: ChatRequest):
     else:
         thread_id = request.thread_id
         
-        # Використовувати Assistants API якщо доступний OpenAI API (не LM Studio)
-        # ТИМЧАСОВО ВИМКНЕНО через проблеми з Vector Stores API
-        # Використовуємо Chat Completions API (більш стабільний)
-        use_assistants_api = False
-        # if client and not USE_LM_STUDIO and request.settings.get("enableAgent", True):
-        #     try:
-        #         # Перевірити чи підтримується Assistants API
-        #         if hasattr(client, 'beta') and hasattr(client.beta, 'assistants'):
-        #             use_assistants_api = True
-        #         else:
-        #             print("⚠️  Assistants API не доступний, використовується Chat Completions API")
-        #     except Exception as e:
-        #         print(f"⚠️  Помилка перевірки Assistants API: {e}, використовується Chat Completions API")
+        # Assistants API (тільки OpenAI, не LM Studio): USE_ASSISTANTS_API або settings.useAssistants -
+        # так обидва шляхи можна порівняти на одному навантаженні
+        use_assistants_api = bool(
+            async_client and not USE_LM_STUDIO
+            and request.settings.get("useAssistants", USE_ASSISTANTS_API)
+        )
         
         if use_assistants_api:
             # ===== ASSISTANTS API PATH =====
@@ -1083,65 +2875,22 @@ async def chat(request: ChatRequest):
                     vector_store_id = await create_or_get_vector_store(thread_id)
                 
                 # Створити або отримати Assistant
-                assistant_id = await get_or_create_assistant(thread_id, request.settings, vector_store_id)
+                assistant_id = await get_or_create_assistant(request.settings, file_search=vector_store_id is not None)
                 if not assistant_id:
                     raise Exception("Не вдалося створити Assistant")
                 
                 # Створити або отримати Thread
-                openai_thread_id = await get_or_create_thread(thread_id)
+                openai_thread_id = await get_or_create_thread(thread_id, vector_store_id)
                 if not openai_thread_id:
                     raise Exception("Не вдалося створити Thread")
                 
-                # Додати повідомлення користувача до Thread
-                client.beta.threads.messages.create(
-                    thread_id=openai_thread_id,
-                    role="user",
-                    content=request.message
-                )
-                
-                # Створити Run
-                run = client.beta.threads.runs.create(
-                    thread_id=openai_thread_id,
-                    assistant_id=assistant_id
-                )
-                
-                # Чекати завершення Run (з обробкою tool calls)
-                max_iterations = 10
-                iteration = 0
-                while run.status in ["queued", "in_progress", "requires_action"] and iteration < max_iterations:
-                    if run.status == "requires_action":
-                        # Обробити tool calls
-                        tool_results = await handle_assistant_tool_calls(run, openai_thread_id, assistant_id)
-                        tools_used.extend(tool_results)
-                        
-                        # Оновити run
-                        run = client.beta.threads.runs.retrieve(
-                            thread_id=openai_thread_id,
-                            run_id=run.id
-                        )
-                    
-                    if run.status in ["queued", "in_progress"]:
-                        import time
-                        time.sleep(1)
-                        run = client.beta.threads.runs.retrieve(
-                            thread_id=openai_thread_id,
-                            run_id=run.id
-                        )
-                    
-                    iteration += 1
-                
-                # Отримати останні повідомлення
-                messages = client.beta.threads.messages.list(
-                    thread_id=openai_thread_id,
-                    limit=1
-                )
+                # Run зі стрімом подій: tool calls обробляються, щойно приходить requires_action
+                with chat_stage("assistant_run"):
+                    response_content = await run_assistant(
+                        openai_thread_id, assistant_id, request.message, thread_id, tools_used
+                    )
                 
-                if messages.data and messages.data[0].content:
-                    response_content = ""
-                    for content_block in messages.data[0].content:
-                        if content_block.type == "text":
-                            response_content += content_block.text.value
-                    
+                if response_content:
                     # Додати RAG інформацію якщо використовувався file_search
                     if vector_store_id and tools_used:
                         tools_used.append({
@@ -1152,57 +2901,21 @@ async def chat(request: ChatRequest):
                     response_content = "Не вдалося отримати відповідь від Assistant"
                     
             except Exception as e:
-                print(f"⚠️  Помилка Assistants API: {e}")
-                import traceback
-                traceback.print_exc()
-                # Fallback до старого методу
-                use_assistants_api = False
+                logger.warning("⚠️  Помилка Assistants API: %s", e)
+                if tools_used:
+                    # Тули (лист, зустріч) вже виконані - повтор через Chat Completions виконав би їх ще раз
+                    response_content = f"Помилка Assistants API після виконання тулів: {e}"
+                else:
+                    # Fallback до Chat Completions
+                    use_assistants_api = False
         
         if not use_assistants_api:
             # ===== LEGACY PATH (Chat Completions API) =====
-            # Отримати або ініціалізувати історію для цього thread
-            if thread_id not in conversation_history:
-                conversation_history[thread_id] = [
-                    {
-                        "role": "system",
-                        "content": f"You are a smart enterprise assistant. Time: {datetime.now().strftime('%Y-%m-%d %H:%M')}."
-                    }
-                ]
-            
-            # Побудувати історію повідомлень
-            # Базовий system prompt (буде доповнений RAG контекстом якщо потрібно)
-            system_prompt = """You are an AI assistant with access to tools and a knowledge base.
-
-PRIORITY ORDER:
-1. FIRST: Check if the user's question can be answered using information from the knowledge base (documents that were uploaded)
-2. SECOND: If the question cannot be answered from documents, use tools for actions (send email, book meeting, etc.)
-3. If user asks about information that should be in documents, ALWAYS check the knowledge base first before using tools
-
-CRITICAL RULES FOR TOOLS:
-- If user says "send email", "надішли листа", "відправити email" - IMMEDIATELY call send_email tool
-- If user says "book meeting", "забронювати", "schedule" - IMMEDIATELY call book_meeting tool
-- If user asks about price of items NOT in documents - call get_item_price tool
-- If user asks about shipping - call calculate_shipping tool
-
-DO NOT:
-- Use tools for information that should be in the knowledge base documents
-- Say "I cannot send emails" - you CAN and MUST use send_email tool
-- Just write the email text without sending - you MUST call send_email
-- Ask for confirmation - just do it if user clearly asked
-
-When user asks you to send an email, extract:
-- recipient from the current or previous messages
-- subject (create appropriate one if not specified, use context from conversation)
-- body (use the email content from PREVIOUS conversation messages if user said "send that email" or "надішли того листа", otherwise create appropriate body)
-
-IMPORTANT: If user says "send that email" or "надішли того листа", look in the conversation history for the email content that was written earlier. Extract the full email text from previous assistant messages and use it as the body.
-
-Then IMMEDIATELY call send_email tool. Do not ask questions - just do it.
-
-If user mentions an email address in the conversation, remember it and use it when they ask to send email."""
+            # Отримати історію для цього thread (порожня - нова розмова)
+            history = await state_io(load_history, thread_id)
             
-            # Оновити system prompt в історії
-            conversation_history[thread_id][0]["content"] = system_prompt
+            # Статичний префікс (однаковий для всіх запитів - кешується провайдером)
+            system_prompt = CHAT_SYSTEM_PROMPT
             
             # Додати поточне повідомлення користувача до історії
             user_message = {
@@ -1226,37 +2939,32 @@ If user mentions an email address in the conversation, remember it and use it wh
             else:
                 user_message["content"] = request.message
             
-            conversation_history[thread_id].append(user_message)
-            
-            # Обмежити історію до останніх N повідомлень (щоб не перевищити ліміт токенів)
-            MAX_HISTORY_MESSAGES = 30  # Максимум повідомлень в історії
-            history = conversation_history[thread_id].copy()
-            
-            # Якщо історія занадто довга, залишити тільки system prompt + останні N повідомлень
-            if len(history) > MAX_HISTORY_MESSAGES:
-                # Зберегти system prompt (перший елемент)
-                system_msg = history[0] if history and history[0].get("role") == "system" else None
-                # Взяти останні N повідомлень (без system prompt)
-                recent_messages = history[-(MAX_HISTORY_MESSAGES - 1):] if system_msg else history[-MAX_HISTORY_MESSAGES:]
-                # Об'єднати system prompt + останні повідомлення
-                if system_msg:
-                    messages = [system_msg] + recent_messages
-                else:
-                    messages = recent_messages
-                print(f"⚠️  Історія обрізана: {len(history)} -> {len(messages)} повідомлень")
+            # Зберегти повідомлення користувача (нова розмова починається з system prompt)
+            if not history:
+                history = [{"role": "system", "content": system_prompt}]
+                await state_io(append_history, thread_id, history[0], user_message)
             else:
-                messages = history
+                # Оновити system prompt в історії (розмову могли почати через /chat/stream)
+                if history[0].get("role") == "system" and history[0].get("content") != system_prompt:
+                    history[0] = {**history[0], "content": system_prompt}
+                    await state_io(state.list_set, history_key(thread_id), 0, history[0])
+                await state_io(append_history, thread_id, user_message)
+            history.append(user_message)
+            
+            # Старі ходи - у зведенні (стискаються у фоні), модель бачить system prompt + зведення + хвіст
+            messages = await build_context(thread_id, history)
 
             # RAG: Витягнути документи, якщо увімкнено
             enable_rag = request.settings.get("enableRAG", True)
-            print(f"🔍 RAG enabled: {enable_rag}, mode: {request.mode}")
+            logger.debug("🔍 RAG enabled: %s, mode: %s", enable_rag, request.mode)
             
             has_rag_context = False  # Флаг що є RAG контекст
             rag_file_names = []
             
             if enable_rag:
-                docs = retrieve_relevant_docs(request.message, n_results=5)
-                print(f"📚 RAG retrieved {len(docs)} documents")
+                with chat_stage("rag_retrieval"):
+                    docs = await run_shared("rag_retrieval", retrieve_relevant_docs, request.message, 5)
+                logger.debug("📚 RAG retrieved %d documents", len(docs))
                 
                 if docs:
                     has_rag_context = True
@@ -1299,7 +3007,7 @@ Relevant documents from knowledge base:
 
 CRITICAL INSTRUCTIONS:
 1. FIRST PRIORITY: Answer the user's question using ONLY the information from the documents above
-2. DO NOT use tools (get_item_price, calculate_shipping, etc.) if the information is in the documents
+2. DO NOT use tools (get_item_price, calculate_shipping, quote_basket, etc.) if the information is in the documents
 3. If the information is in the documents, cite which document(s) you used (e.g., "According to [filename]...")
 4. Be specific and accurate when referencing information from the documents
 5. If the documents don't contain the information, say so clearly: "I cannot find this information in the uploaded documents"
@@ -1313,15 +3021,8 @@ EXAMPLE:
 
 ═══════════════════════════════════════════════════════════════"""
                     
-                    # Переконатися що system prompt має content як рядок
-                    if isinstance(messages[0].get("content"), str):
-                        messages[0]["content"] += rag_instruction
-                    else:
-                        # Якщо system prompt має інший формат, створити новий
-                        messages[0] = {
-                            "role": "system",
-                            "content": f"{system_prompt}{rag_instruction}"
-                        }
+                    # В кінці: префікс (system prompt + історія) не змінюється
+                    add_request_context(messages, rag_instruction.strip())
                     
                     # Зберегти назви файлів для візуалізації
                     rag_file_names = file_names if file_names else [f"doc_{i}" for i in range(len(docs))]
@@ -1334,9 +3035,9 @@ EXAMPLE:
                         }
                     )
                     
-                    print(f"📄 RAG files used: {rag_file_names}")
+                    logger.info("📄 RAG files used: %s", rag_file_names)
                 else:
-                    print("⚠️  RAG enabled but no documents found in knowledge base")
+                    logger.debug("⚠️  RAG enabled but no documents found in knowledge base")
 
             # Нормалізувати messages перед відправкою до API
             messages = normalize_messages(messages, system_prompt)
@@ -1367,22 +3068,20 @@ EXAMPLE:
                     if tool["function"]["name"] in action_tools
                 ]
                 if enabled_tools:
-                    print(f"🔧 RAG context found - only action tools enabled: {[t['function']['name'] for t in enabled_tools]}")
+                    logger.debug("🔧 RAG context found - only action tools enabled: %s", [t["function"]["name"] for t in enabled_tools])
                 else:
-                    print(f"🔧 RAG context found - all tools disabled for information queries")
+                    logger.debug("🔧 RAG context found - all tools disabled for information queries")
                     enabled_tools = None
             
             # Визначити модель залежно від складності запиту
             default_model = select_model(request.message, request.settings, use_assistants=False)
+            routed_model = default_model
             
-            # Логування для дебагу
-            print(f"🔧 Enabled tools: {[t['function']['name'] for t in enabled_tools] if enabled_tools else 'None'}")
-            print(f"📝 User message: {request.message[:100]}...")
-            print(f"📊 Історія перед запитом: {len(messages)} повідомлень")
-            if len(messages) > 0:
-                print(f"   System prompt type: {type(messages[0].get('content'))}")
-            if len(messages) > 1:
-                print(f"   Останні 3 повідомлення:")
+            # Логування для дебагу (дамп історії будується тільки якщо DEBUG увімкнено)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("🔧 Enabled tools: %s", [t["function"]["name"] for t in enabled_tools] if enabled_tools else None)
+                logger.debug("📝 User message: %s...", request.message[:100])
+                logger.debug("📊 Історія перед запитом: %d повідомлень, model=%s", len(messages), default_model)
                 for m in messages[-3:]:
                     role = m.get("role", "unknown")
                     content = m.get("content", "")
@@ -1391,38 +3090,42 @@ EXAMPLE:
                     else:
                         content_preview = str(content)[:50] if content else ""
                     tool_calls = m.get("tool_calls", [])
-                    print(f"     - {role}: {content_preview}... {'[tool_calls]' if tool_calls else ''}")
+                    logger.debug("     - %s: %s... %s", role, content_preview, "[tool_calls]" if tool_calls else "")
             
+            llm_started = time.perf_counter()
             try:
-                response = client.chat.completions.create(
-                    model=default_model,
-                    messages=messages,
-                    tools=enabled_tools if enabled_tools else None,
-                    temperature=request.settings.get("temperature", 0.7),
-                )
+                with chat_stage("completion"):
+                    response = await async_client.chat.completions.create(
+                        model=default_model,
+                        messages=messages,
+                        tools=enabled_tools if enabled_tools else None,
+                        temperature=request.settings.get("temperature", 0.7),
+                    )
             except Exception as e:
                 error_str = str(e)
-                # Обробка помилки 429 (Rate Limit / Too Many Tokens)
+                # 429 уже повторено планувальником (rate_limiter.py); сюди доходить запит,
+                # більший за TPM ліміт, або ліміт, що не відновився за RATE_LIMIT_MAX_WAIT
                 if "429" in error_str or "rate_limit" in error_str.lower() or "too many requests" in error_str.lower() or "tokens per min" in error_str.lower():
                     # Спробувати зменшити історію та повторити
-                    print(f"⚠️  Rate limit / Token limit error, спроба зменшити історію...")
+                    logger.warning("⚠️  Rate limit / Token limit error, спроба зменшити історію...")
                     # Обрізати історію до останніх 10 повідомлень
                     if len(messages) > 10:
                         system_msg = messages[0] if messages[0].get("role") == "system" else None
                         recent = messages[-(10 - (1 if system_msg else 0)):]
                         messages = [system_msg] + recent if system_msg else recent
-                        print(f"   Зменшено до {len(messages)} повідомлень, повторна спроба...")
+                        logger.info("   Зменшено до %d повідомлень, повторна спроба...", len(messages))
                         try:
-                            response = client.chat.completions.create(
-                                model=default_model,
-                                messages=messages,
-                                tools=enabled_tools if enabled_tools else None,
-                                temperature=request.settings.get("temperature", 0.7),
-                            )
+                            with chat_stage("completion"):
+                                response = await async_client.chat.completions.create(
+                                    model=default_model,
+                                    messages=messages,
+                                    tools=enabled_tools if enabled_tools else None,
+                                    temperature=request.settings.get("temperature", 0.7),
+                                )
                         except Exception as e2:
                             # Якщо все одно не працює, повернути помилку
                             error_msg = f"Помилка API: Запит занадто великий або перевищено ліміт запитів. Спробуйте скоротити повідомлення або зачекати."
-                            print(f"❌ {error_msg}")
+                            logger.error("❌ %s", error_msg)
                             return ChatResponse(
                                 content=error_msg,
                                 tools=[],
@@ -1431,7 +3134,7 @@ EXAMPLE:
                 else:
                     # Інші помилки
                     error_msg = f"Помилка OpenAI API: {error_str}"
-                    print(f"❌ {error_msg}")
+                    logger.error("❌ %s", error_msg)
                     return ChatResponse(
                         content=error_msg,
                         tools=[],
@@ -1439,13 +3142,17 @@ EXAMPLE:
                     )
 
             msg = response.choices[0].message
+            llm_usages.append(response.usage)
+            record_usage(default_model, response.usage)
             
             # Логування відповіді
-            print(f"📊 Історія thread {thread_id}: {len(conversation_history.get(thread_id, []))} повідомлень")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📊 Історія thread %s: %d повідомлень", thread_id,
+                             await state_io(state.list_length, history_key(thread_id)))
             if msg.tool_calls:
-                print(f"✅ AI викликає тули: {[tc.function.name for tc in msg.tool_calls]}")
+                logger.info("✅ AI викликає тули: %s", [tc.function.name for tc in msg.tool_calls])
             else:
-                print(f"⚠️  AI не викликав тули. Відповідь: {msg.content[:100] if msg.content else 'None'}...")
+                logger.debug("AI не викликав тули. Відповідь: %s...", msg.content[:100] if msg.content else None)
 
             # Якщо LLM хоче викликати інструмент
             if msg.tool_calls:
@@ -1466,125 +3173,116 @@ EXAMPLE:
                 }
                 messages.append(assistant_msg_dict)
                 
-                # Додати assistant message до conversation_history тільки один раз
-                conversation_history[thread_id].append(assistant_msg_dict)
+                # Додати assistant message до історії тільки один раз
+                await state_io(append_history, thread_id, assistant_msg_dict)
                 
                 # Виконати всі тули
-                for tool_call in msg.tool_calls:
-                    func_name = tool_call.function.name
-                    args = json.loads(tool_call.function.arguments)
-
-                    func = available_functions.get(func_name)
-                    if func:
-                        # Викликати функцію з правильними аргументами
-                        try:
-                            if func_name == "get_item_price":
-                                result = func(args.get("item_name", ""))
-                            elif func_name == "calculate_shipping":
-                                result = func(args.get("destination", ""), args.get("price", 0))
-                            elif func_name == "book_meeting":
-                                result = func(
-                                    args.get("topic", ""),
-                                    args.get("datetime_str", ""),
-                                    args.get("participants", "")
+                tools_started = time.perf_counter()
+                mark_stage("tools")
+                try:
+                    for tool_call in msg.tool_calls:
+                        func_name = tool_call.function.name
+                        args = json.loads(tool_call.function.arguments)
+
+                        func = available_functions.get(func_name)
+                        if func:
+                            # Викликати функцію з правильними аргументами
+                            try:
+                                result = await run_blocking(execute_tool, func_name, args, thread_id)
+                            
+                                tools_used.append(
+                                    {
+                                        "type": "tool",
+                                        "name": func_name,
+                                        "result": str(result),
+                                    }
                                 )
-                            elif func_name == "send_email":
-                                result = func(
-                                    args.get("recipient", ""),
-                                    args.get("subject", ""),
-                                    args.get("body", "")
+                            except Exception as e:
+                                result = json.dumps({"error": str(e)})
+                                tools_used.append(
+                                    {
+                                        "type": "tool",
+                                        "name": func_name,
+                                        "result": result,
+                                    }
                                 )
-                            else:
-                                result = func(**args)
-                            
-                            tools_used.append(
-                                {
-                                    "type": "tool",
-                                    "name": func_name,
-                                    "result": str(result),
-                                }
-                            )
-                        except Exception as e:
-                            result = json.dumps({"error": str(e)})
-                            tools_used.append(
-                                {
-                                    "type": "tool",
-                                    "name": func_name,
-                                    "result": result,
-                                }
-                            )
 
-                        # Створити tool response
-                        tool_response = {
-                            "tool_call_id": tool_call.id,
-                            "role": "tool",
-                            "name": func_name,
-                            "content": str(result),  # Вже JSON string
-                        }
-                        # Додати tool response до messages
-                        messages.append(tool_response)
+                            # Створити tool response
+                            tool_response = {
+                                "tool_call_id": tool_call.id,
+                                "role": "tool",
+                                "name": func_name,
+                                "content": str(result),  # Вже JSON string
+                            }
+                            # Додати tool response до messages
+                            messages.append(tool_response)
                         
-                        # Додати tool response до conversation_history
-                        conversation_history[thread_id].append(tool_response)
+                            # Додати tool response до історії
+                            await state_io(append_history, thread_id, tool_response)
+                except asyncio.CancelledError:
+                    # Запит скасовано посеред тулів: кожен tool_call в історії має отримати відповідь,
+                    # інакше наступний запит цієї розмови OpenAI відхилить
+                    answered = {m.get("tool_call_id") for m in messages if m.get("role") == "tool"}
+                    await state_io(append_history, thread_id, *(
+                        {"tool_call_id": tc.id, "role": "tool", "name": tc.function.name,
+                         "content": json.dumps({"error": "cancelled"})}
+                        for tc in msg.tool_calls if tc.id not in answered
+                    ))
+                    raise
+                STAGE_LATENCY.labels("tools").observe(time.perf_counter() - tools_started)
 
                 # Фінальна відповідь після виконання інструментів
-                final_model = select_model(request.message, request.settings, use_assistants=False)
+                final_model = default_model
                 
-                final_response = client.chat.completions.create(
-                    model=final_model,
-                    messages=messages,
-                )
+                with chat_stage("final_completion"):
+                    final_response = await async_client.chat.completions.create(
+                        model=final_model,
+                        messages=messages,
+                    )
+                llm_usages.append(final_response.usage)
+                record_usage(final_model, final_response.usage)
                 response_content = final_response.choices[0].message.content
                 
                 # Додати фінальну відповідь до історії
-                conversation_history[thread_id].append({
+                await state_io(append_history, thread_id, {
                     "role": "assistant",
                     "content": response_content
                 })
             else:
                 response_content = msg.content
                 # Додати відповідь до історії
-                conversation_history[thread_id].append({
-                    "role": "assistant",
-                    "content": response_content
-                })
-        else:
-            # Без агента - проста LLM відповідь
-            # Визначити system_prompt для цього блоку
-            simple_system_prompt = f"You are a smart enterprise assistant. Time: {datetime.now().strftime('%Y-%m-%d %H:%M')}."
-            
-            if not client:
-                error_msg = "Помилка: OpenAI клієнт не ініціалізовано. "
-                if USE_LM_STUDIO:
-                    error_msg += "Переконайтеся, що LM Studio запущено на http://localhost:1234"
-                else:
-                    error_msg += "Переконайтеся, що OPENAI_API_KEY встановлено в .env файлі"
-                response_content = error_msg
-            else:
-                model = select_model(request.message, request.settings, use_assistants=False)
-                
-                # Нормалізувати messages перед відправкою до API
-                messages = normalize_messages(messages, simple_system_prompt)
-                
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=request.settings.get("temperature", 0.7),
-                )
-                response_content = response.choices[0].message.content
-                
-                # Додати відповідь до історії
-                conversation_history[thread_id].append({
+                await state_io(append_history, thread_id, {
                     "role": "assistant",
                     "content": response_content
                 })
 
+    if routed_model and llm_started:
+        log_router_turn(
+            request_id, request.thread_id, request.message, request.settings, routed_model,
+            (time.perf_counter() - llm_started) * 1000, llm_usages, response_content, tools_used,
+        )
+        return ChatResponse(
+            content=response_content, tools=tools_used, image_url=image_url, request_id=request_id
+        )
+
     return ChatResponse(
         content=response_content, tools=tools_used, image_url=image_url
     )
 
 
 # ==================== STREAMING ENDPOINT ====================
+PARTIAL_REPLY_MARKER = "\n\n[відповідь перервано]"
+
+
+def commit_partial_reply(thread_id: str, content: str):
+    """Зберегти в історію частину відповіді, яку встиг отримати клієнт (з позначкою, що її перервано)"""
+    if content:
+        # У пулі потоків без очікування: finally генератора вже скасовано - await тут не дочекається
+        asyncio.get_running_loop().run_in_executor(
+            None, append_history, thread_id, {"role": "assistant", "content": content + PARTIAL_REPLY_MARKER},
+        )
+
+
 @app.post("/chat/stream")
 async def chat_stream(request: ChatRequest):
     """Streaming endpoint для chat (тільки для Chat Completions API, не Assistants API)"""
@@ -1593,27 +3291,26 @@ async def chat_stream(request: ChatRequest):
         # Streaming не підтримується для image modes або без agent
         return {"error": "Streaming доступний тільки для chat mode з agent"}
     
-    if not client or USE_LM_STUDIO:
+    if not async_client or USE_LM_STUDIO:
         return {"error": "Streaming доступний тільки з OpenAI API"}
     
     thread_id = request.thread_id
+    use_thread_tenant(thread_id)
     
-    # Ініціалізувати історію якщо потрібно
-    if thread_id not in conversation_history:
-        conversation_history[thread_id] = [
-            {
-                "role": "system",
-                "content": "You are an AI assistant with access to tools."
-            }
-        ]
-    
-    # Додати повідомлення користувача
-    conversation_history[thread_id].append({
+    # Додати повідомлення користувача (нова розмова починається з system prompt)
+    messages = await state_io(load_history, thread_id)
+    user_message = {
         "role": "user",
         "content": request.message
-    })
-    
-    messages = conversation_history[thread_id].copy()
+    }
+    if not messages:
+        # Той самий system prompt, що й у /chat - спільний кешований префікс
+        messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+        await state_io(append_history, thread_id, messages[0], user_message)
+    else:
+        await state_io(append_history, thread_id, user_message)
+    messages.append(user_message)
+    messages = await build_context(thread_id, messages)
     
     # Отримати увімкнені тули
     enabled_tools = get_enabled_tools(request.settings)
@@ -1622,93 +3319,124 @@ async def chat_stream(request: ChatRequest):
     model = select_model(request.message, request.settings, use_assistants=False)
     
     async def generate():
-        """Async generator для streaming з правильним flush"""
-        try:
-            # Створити streaming request
-            stream = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                tools=enabled_tools if enabled_tools else None,
-                temperature=request.settings.get("temperature", 0.7),
-                stream=True,
-            )
-            
-            full_content = ""
-            has_content = False
+        """Async generator: кадри з об'єднаних дельт, upstream читає окрема задача"""
+        stream_started = time.perf_counter()
+        stream_result = "disconnected"  # генератор закрито до кінця стріму
+        buffer = FrameBuffer(SSE_COALESCE_MS / 1000, SSE_MAX_PENDING)
+        delivered = []  # відправлений клієнту текст - часткова відповідь, якщо стрім перервано
+        outcome = {"content": "", "tool_calls": []}
+        SSE_ACTIVE.inc()
+
+        async def produce():
+            """Читати стрім моделі: текст - у буфер, tool calls і повний текст - в outcome"""
+            first_token = True
+            content_parts = []
             tool_calls_accumulated = []
-            
-            for chunk in stream:
-                if not chunk.choices or len(chunk.choices) == 0:
-                    continue
-                    
-                delta = chunk.choices[0].delta
-                if not delta:
-                    continue
-                
-                # Обробка текстового контенту
-                if delta.content:
-                    content = delta.content
-                    full_content += content
-                    has_content = True
-                    # Відправити chunk одразу
-                    data = json.dumps({'content': content, 'done': False})
-                    yield f"data: {data}\n\n"
-                    # Дати можливість event loop обробити інші завдання
-                    await asyncio.sleep(0)
-                
-                # Обробка tool calls (якщо є)
-                if delta.tool_calls:
-                    for tool_call_delta in delta.tool_calls:
-                        idx = tool_call_delta.index
-                        
-                        # Ініціалізувати tool call якщо потрібно
-                        while len(tool_calls_accumulated) <= idx:
-                            tool_calls_accumulated.append({
-                                "id": "",
-                                "type": "function",
-                                "function": {"name": "", "arguments": ""}
-                            })
-                        
-                        # Оновити tool call
-                        if tool_call_delta.id:
-                            tool_calls_accumulated[idx]["id"] = tool_call_delta.id
-                        if tool_call_delta.function:
-                            if tool_call_delta.function.name:
-                                tool_calls_accumulated[idx]["function"]["name"] = tool_call_delta.function.name
-                            if tool_call_delta.function.arguments:
-                                tool_calls_accumulated[idx]["function"]["arguments"] += tool_call_delta.function.arguments
+            try:
+                # Створити streaming request
+                stream = await async_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    tools=enabled_tools if enabled_tools else None,
+                    temperature=request.settings.get("temperature", 0.7),
+                    stream=True,
+                    stream_options={"include_usage": True},  # останній chunk містить usage
+                )
+                async with stream:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            record_usage(model, chunk.usage)
+                        if not chunk.choices:
+                            continue
+                        if first_token:
+                            first_token = False
+                            STAGE_LATENCY.labels("stream_first_token").observe(time.perf_counter() - stream_started)
+
+                        delta = chunk.choices[0].delta
+                        if not delta:
+                            continue
+
+                        # Обробка текстового контенту (чекає, якщо клієнт не встигає)
+                        if delta.content:
+                            content_parts.append(delta.content)
+                            await buffer.put(delta.content)
+
+                        # Обробка tool calls (якщо є)
+                        for tool_call_delta in delta.tool_calls or []:
+                            idx = tool_call_delta.index
+
+                            # Ініціалізувати tool call якщо потрібно
+                            while len(tool_calls_accumulated) <= idx:
+                                tool_calls_accumulated.append({
+                                    "id": "",
+                                    "type": "function",
+                                    "function": {"name": "", "arguments": ""}
+                                })
+
+                            # Оновити tool call
+                            if tool_call_delta.id:
+                                tool_calls_accumulated[idx]["id"] = tool_call_delta.id
+                            if tool_call_delta.function:
+                                if tool_call_delta.function.name:
+                                    tool_calls_accumulated[idx]["function"]["name"] = tool_call_delta.function.name
+                                if tool_call_delta.function.arguments:
+                                    tool_calls_accumulated[idx]["function"]["arguments"] += tool_call_delta.function.arguments
+                outcome["content"] = "".join(content_parts)
+                outcome["tool_calls"] = tool_calls_accumulated
+            finally:
+                buffer.close()
+
+        producer = asyncio.create_task(asyncio.wait_for(produce(), REQUEST_DEADLINE or None))
+        try:
+            # Один кадр на все, що накопичилось; yield чекає, поки сервер віддасть попередній кадр клієнту
+            async for text in buffer.chunks():
+                yield sse_frame({'content': text, 'done': False})
+                delivered.append(text)
+            await producer  # помилка upstream - сюди
+            full_content = outcome["content"]
             
             # Якщо є tool calls, завершити streaming та повернутися до non-streaming
-            if tool_calls_accumulated and any(tc.get("function", {}).get("name") for tc in tool_calls_accumulated):
+            if any(tc.get("function", {}).get("name") for tc in outcome["tool_calls"]):
                 # Streaming не підтримує tool calls добре, тому завершуємо streaming
-                data = json.dumps({
+                yield sse_frame({
                     'content': '', 
                     'done': True, 
                     'full_content': full_content, 
                     'has_tools': True, 
                     'message': 'Tool calls detected, switching to non-streaming mode'
                 })
-                yield f"data: {data}\n\n"
+                stream_result = "tools"
                 return
             
             # Зберегти повну відповідь в історію
-            if has_content and full_content:
-                conversation_history[thread_id].append({
+            if full_content:
+                await state_io(append_history, thread_id, {
                     "role": "assistant",
                     "content": full_content
                 })
             
             # Відправити фінальний сигнал
-            data = json.dumps({'content': '', 'done': True, 'full_content': full_content})
-            yield f"data: {data}\n\n"
+            yield sse_frame({'content': '', 'done': True, 'full_content': full_content})
+            stream_result = "ok"
             
+        except asyncio.TimeoutError:
+            stream_result = "deadline"
+            logger.warning("⚠️  Streaming перервано: дедлайн %g с", REQUEST_DEADLINE)
+            yield sse_frame({'error': f"Час обробки запиту вичерпано ({REQUEST_DEADLINE:g} с)", 'done': True})
         except Exception as e:
             error_msg = str(e)
-            print(f"⚠️  Streaming error: {error_msg}")
-            import traceback
-            traceback.print_exc()
-            data = json.dumps({'error': error_msg, 'done': True})
-            yield f"data: {data}\n\n"
+            stream_result = "error"
+            logger.exception("⚠️  Streaming error: %s", error_msg)
+            yield sse_frame({'error': error_msg, 'done': True})
+        finally:
+            # Клієнт відключився - зупинити читання моделі
+            producer.cancel()
+            if stream_result in ("disconnected", "deadline"):
+                REQUESTS_CANCELLED.labels("chat_stream", stream_result.replace("disconnected", "disconnect"), "stream").inc()
+                commit_partial_reply(thread_id, "".join(delivered))
+            SSE_ACTIVE.dec()
+            SSE_STREAMS.labels(stream_result).inc()
+            STAGE_LATENCY.labels("stream_total").observe(time.perf_counter() - stream_started)
     
     return StreamingResponse(
         generate(), 
@@ -1729,7 +3457,7 @@ async def upload_documents(
     thread_id: Optional[str] = Form(None)
 ):
     """Завантажити документи у RAG базу (OpenAI File Search API або ChromaDB)"""
-    print(f"📤 Завантаження {len(files)} файлів, thread_id: {thread_id}")
+    logger.info("📤 Завантаження %d файлів, thread_id: %s", len(files), thread_id)
     uploaded_files = []
     file_ids = []
     file_contents = {}  # Зберігати контент для fallback (визначено тут для використання в fallback)
@@ -1760,7 +3488,7 @@ async def upload_documents(
                     except Exception as e:
                         error_msg = f"{file.filename}: {str(e)}"
                         errors.append(error_msg)
-                        print(f"⚠️  Помилка завантаження файлу {file.filename}: {e}")
+                        logger.warning("⚠️  Помилка завантаження файлу %s: %s", file.filename, e)
                 
                 if file_ids:
                     result = {
@@ -1774,9 +3502,9 @@ async def upload_documents(
                     return result
                 else:
                     # Якщо жоден файл не завантажився, продовжити до ChromaDB fallback
-                    print(f"⚠️  Не вдалося завантажити файли в OpenAI: {errors}")
+                    logger.warning("⚠️  Не вдалося завантажити файли в OpenAI: %s", errors)
         except Exception as e:
-            print(f"⚠️  Помилка завантаження в OpenAI File Search: {e}")
+            logger.warning("⚠️  Помилка завантаження в OpenAI File Search: %s", e)
             import traceback
             traceback.print_exc()
     
@@ -1797,7 +3525,7 @@ async def upload_documents(
                     content = await file.read()
                 except Exception as seek_error:
                     # Якщо seek не працює, спробувати прочитати безпосередньо
-                    print(f"⚠️  Не вдалося seek для {file.filename}: {seek_error}")
+                    logger.warning("⚠️  Не вдалося seek для %s: %s", file.filename, seek_error)
                     # Для FastAPI UploadFile, якщо вже прочитано, потрібно використати збережений контент
                     content = b""  # Порожній контент, файл буде пропущено
             
@@ -1830,7 +3558,7 @@ async def upload_documents(
     
     if docs:
         try:
-            add_documents_to_rag(docs)
+            await run_shared("rag_upload", add_documents_to_rag, docs)
             result = {
                 "status": "success",
                 "count": len(docs),
@@ -1854,15 +3582,17 @@ async def upload_documents(
     elif USE_LM_STUDIO:
         error_message += ". OpenAI File Search недоступний при використанні LM Studio"
     
-    print(f"❌ Помилка завантаження: {error_message}")
-    print(f"   Деталі: errors={errors}, CHROMADB_AVAILABLE={CHROMADB_AVAILABLE}, client={client is not None}, USE_LM_STUDIO={USE_LM_STUDIO}")
+    logger.error(
+        "❌ Помилка завантаження: %s (errors=%s, CHROMADB_AVAILABLE=%s, client=%s, USE_LM_STUDIO=%s)",
+        error_message, errors, CHROMADB_AVAILABLE, client is not None, USE_LM_STUDIO,
+    )
     return {"status": "error", "message": error_message, "errors": errors}
 
 
 @app.get("/search_documents")
 async def search_documents(query: str):
     """Пошук у RAG базі"""
-    results = retrieve_relevant_docs(query)
+    results = await run_shared("rag_retrieval", retrieve_relevant_docs, query, 3)
     return {"results": results}
 
 
@@ -1870,35 +3600,162 @@ async def search_documents(query: str):
 @app.post("/upload_catalog")
 async def upload_catalog(file: UploadFile = File(...)):
     """Завантажити CSV каталог товарів"""
-    global PRODUCT_CATALOG
     try:
-        content = await file.read()
-        # Зберегти тимчасово для pandas
-        import tempfile
-        with tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix='.csv') as tmp:
-            tmp.write(content)
-            tmp_path = tmp.name
-        
-        df = pd.read_csv(tmp_path)
-        new_catalog = {}
-        for _, row in df.iterrows():
-            item_name = str(row.get('item_name', '')).strip().lower()
-            price = int(row.get('price', 0))
-            if item_name and price:
-                new_catalog[item_name] = price
-        
-        PRODUCT_CATALOG = new_catalog
-        os.unlink(tmp_path)  # Видалити тимчасовий файл
-        
-        return {"status": "success", "count": len(new_catalog), "message": f"Завантажено {len(new_catalog)} товарів"}
+        # pandas читає прямо з буфера завантаження; розбір і запис - поза event loop
+        new_catalog, skipped = await run_blocking(parse_catalog_csv, file.file)
+        if not new_catalog:
+            return {"status": "error", "message": "CSV не містить жодного валідного товару"}
+
+        version = await run_blocking(save_catalog_version, new_catalog, file.filename or "")
+        await run_blocking(activate_catalog, version, new_catalog)
+        await run_blocking(publish_catalog, version, new_catalog)
+
+        result = {
+            "status": "success",
+            "count": len(new_catalog),
+            "version": version,
+            "message": f"Завантажено {len(new_catalog)} товарів",
+        }
+        if skipped:
+            result["skipped"] = skipped
+        return result
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 
+@app.post("/quote")
+async def quote(request: QuoteRequest):
+    """Порахувати ціни та доставку для кошика товарів одним запитом"""
+    items = [item.model_dump() for item in request.items]
+    # Каталог може перечитуватись з SQLite (і перебудовуватись індекс) - не на event loop
+    return await run_blocking(build_quote, items, request.destination or "")
+
+
 @app.get("/catalog")
 async def get_catalog():
     """Отримати поточний каталог"""
-    return {"catalog": PRODUCT_CATALOG, "count": len(PRODUCT_CATALOG)}
+    await run_blocking(refresh_catalog_if_changed)
+    version, catalog = CATALOG_VERSION, PRODUCT_CATALOG
+    return {"catalog": catalog, "count": len(catalog), "version": version}
+
+
+# ==================== OUTBOX ENDPOINTS ====================
+@app.get("/outbox/{outbox_id}")
+async def outbox_status(outbox_id: str):
+    """Статус доставки side-effect тулу (send_email / book_meeting)"""
+    record = await run_blocking(get_outbox_status, outbox_id)
+    if record is None:
+        return {"status": "not_found", "outbox_id": outbox_id}
+    return record
+
+
+# ==================== METRICS ENDPOINT ====================
+@app.get("/metrics")
+async def metrics():
+    """Метрики у форматі Prometheus"""
+    body = await run_blocking(REGISTRY.render)
+    return Response(content=body, media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get("/local_endpoints")
+async def get_local_endpoints():
+    """Стан пулу LM Studio endpoint-ів: завантаження, помилки, виключені"""
+    return {"enabled": lm_studio_pool is not None, "endpoints": lm_studio_pool.snapshot() if lm_studio_pool else []}
+
+
+@app.get("/admission")
+async def get_admission():
+    """Стан контролю допуску: ліміти, активні запити, глибина черги, відхилені по endpoint"""
+    return {path: gate.snapshot() for path, gate in admission_gates.items()}
+
+
+@app.get("/rate_limits")
+async def get_rate_limits():
+    """Стан планувальника викликів моделей: ліміти, доступні запити/токени, черги та tenant-и"""
+    return {
+        "enabled": RATE_LIMIT_ENABLED,
+        "models": rate_limiter.snapshot(),
+        "tenants": rate_limiter.tenant_snapshot(),
+    }
+
+
+# ==================== MODEL ROUTER ENDPOINTS ====================
+@app.post("/router/feedback")
+async def router_feedback(feedback: RouterFeedback):
+    """Оцінка відповіді користувачем - єдина мітка для навчання маршрутизатора"""
+    quality = min(max(feedback.quality, 0.0), 1.0)
+    await run_blocking(router_log.write, {
+        "type": "feedback",
+        "request_id": feedback.request_id,
+        "quality": quality,
+        "ts": datetime.now().isoformat(),
+    })
+    return {"status": "ok", "request_id": feedback.request_id, "quality": quality}
+
+
+@app.get("/router/report")
+async def router_report():
+    """Shadow-звіт: обслуговуючий маршрутизатор vs тіньовий (вартість, латентність, якість)"""
+    records = await run_blocking(read_log, ROUTER_LOG_PATH)
+    return {"mode": model_router.name, "shadow": shadow_router.name, **shadow_report(records)}
+
+
+# ==================== WARM-UP / READINESS ====================
+# Підсистеми ініціалізуються ліниво (warmup.py); після старту фоновий прогрів створює їх
+# заздалегідь, а /readyz повертає 503, поки обов'язкові (required) ще не готові
+readiness = Readiness()
+readiness.register("state")
+readiness.register("openai", enabled=client is not None)
+readiness.register("catalog")
+readiness.register("gallery")
+readiness.register("rag", required=False, enabled=CHROMADB_AVAILABLE)
+readiness.register("google", required=False, enabled=GOOGLE_AVAILABLE)
+readiness.register("pandas", required=False)
+
+
+def log_warm_up(snapshot: dict):
+    timings = ", ".join(
+        f"{name}={entry['seconds']}s" if entry["status"] == "ready" else f"{name}={entry['status']}"
+        for name, entry in snapshot["subsystems"].items()
+    )
+    logger.info("🔥 Прогрів завершено за %.2f с: %s", snapshot["uptime"], timings)
+
+
+def start_warm_up():
+    """Ініціалізувати підсистеми у фоні (сервер вже приймає з'єднання)"""
+    warm_up(readiness, [
+        ("state", state.ping),
+        ("openai", lambda: client.get()),
+        ("catalog", refresh_catalog_if_changed),
+        ("gallery", ensure_gallery),
+        ("rag", rag_collection.get),
+        ("google", google_lib.get),
+        ("pandas", lambda: importlib.import_module("pandas")),
+    ], on_done=log_warm_up)
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: процес живий і обробляє запити (без перевірки підсистем)"""
+    return {"status": "ok", "uptime": round(time.monotonic() - readiness.started, 3)}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200, коли обов'язкові підсистеми готові, інакше 503 (стан кожної підсистеми)"""
+    snapshot = readiness.snapshot()
+    return JSONResponse(snapshot, status_code=200 if snapshot["ready"] else 503)
+
+
+async def on_startup():
+    """Запустити фонові воркери і прогрів підсистем"""
+    start_outbox_workers()
+    start_warm_up()
+
+
+async def on_shutdown():
+    """Зупинити фонові воркери"""
+    stop_outbox_workers()
 
 
 # ==================== GOOGLE AUTH ENDPOINTS ====================
@@ -1912,7 +3769,7 @@ async def google_auth():
         return {"error": f"Файл credentials.json не знайдено за адресою: {CREDENTIALS_PATH}"}
     
     try:
-        flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+        flow = google_lib.get().InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
         # Для веб-додатку потрібно повернути URL для авторизації
         # Але для простоти повертаємо інструкції
         return {
@@ -1933,7 +3790,9 @@ async def generate_image_endpoint(
     style: str = "vivid"
 ):
     """Ендпоінт для генерації зображень через DALL-E API"""
-    image_url, error = generate_image(prompt, model, size, quality, style)
+    image_url, error = await run_shared(
+        "generate_image", generate_image, prompt, model, size, quality, style, coalesce=False,
+    )
     if error:
         return {"error": error, "image_url": None}
     return {
@@ -1953,54 +3812,131 @@ async def analyze_image_endpoint(
     """Ендпоінт для аналізу зображень (VQA)"""
     content = await file.read()
     image_base64 = base64.b64encode(content).decode("utf-8")
-    analysis = analyze_image(image_base64, question, detailed)
+    analysis = await run_shared("analyze_image", analyze_image, image_base64, question, detailed)
     return {"analysis": analysis, "question": question}
 
 
 @app.get("/gallery")
-async def get_gallery(limit: int = 50):
-    """Отримати галерею згенерованих зображень"""
-    return {
-        "gallery": image_gallery[-limit:][::-1],  # Останні N, від новіших до старіших
-        "total": len(image_gallery)
-    }
+async def get_gallery(limit: int = 50, cursor: Optional[str] = None, fields: Optional[str] = None):
+    """Сторінка галереї від новіших до старіших; next_cursor - для наступної сторінки"""
+    await state_io(ensure_gallery)
+    total = await state_io(state.list_length, GALLERY_KEY)
+    # Курсор "позиція:id" найстаршого показаного зображення; видалення зсувають позиції вліво,
+    # тому вікно фільтрується за id - без повторів і пропусків, сторінка лише може бути коротшою
+    end, before_id = total, None
+    if cursor:
+        try:
+            position, _, item_id = cursor.partition(":")
+            end, before_id = min(int(position), total), int(item_id)
+        except ValueError:
+            return FastJSONResponse({"error": f"Невірний cursor: {cursor}"}, status_code=400)
+    start = max(0, end - page_size(limit))
+    window = await state_io(state.list_range, GALLERY_KEY, start, end - 1) if end > start else []
+    page = [item for item in reversed(window) if before_id is None or item["id"] < before_id]
+    oldest_id = page[-1]["id"] if page else before_id
+    selected = parse_fields(fields)
+    return FastJSONResponse({
+        "gallery": [project(item, selected) for item in page],
+        "total": total,
+        "next_cursor": f"{start}:{oldest_id}" if start > 0 and oldest_id is not None else None,
+    })
+
+
+def remove_from_gallery(image_id: int) -> int:
+    """Видалити зображення з галереї, повернути кількість решти"""
+    ensure_gallery()
+    for img in state.list_range(GALLERY_KEY):
+        if img["id"] == image_id:
+            state.list_remove(GALLERY_KEY, img)
+    save_gallery()  # Зберегти зміни
+    return state.list_length(GALLERY_KEY)
+
+
+def empty_gallery() -> int:
+    """Очистити галерею, повернути кількість видалених"""
+    ensure_gallery()
+    count = state.list_length(GALLERY_KEY)
+    state.list_replace(GALLERY_KEY, [])
+    save_gallery()  # Зберегти зміни
+    return count
 
 
 @app.delete("/gallery/{image_id}")
 async def delete_from_gallery(image_id: int):
     """Видалити зображення з галереї"""
-    global image_gallery
-    image_gallery = [img for img in image_gallery if img["id"] != image_id]
-    save_gallery()  # Зберегти зміни
-    return {"status": "deleted", "remaining": len(image_gallery)}
+    return {"status": "deleted", "remaining": await state_io(remove_from_gallery, image_id)}
 
 
 @app.delete("/gallery")
 async def clear_gallery():
     """Очистити всю галерею"""
-    global image_gallery
-    count = len(image_gallery)
-    image_gallery = []
-    save_gallery()  # Зберегти зміни
-    return {"status": "cleared", "deleted_count": count}
+    return {"status": "cleared", "deleted_count": await state_io(empty_gallery)}
 
 
 # ==================== HISTORY ENDPOINTS ====================
+def without_inline_images(message: dict) -> dict:
+    """Замінити вбудовані base64 зображення (data: URL) у повідомленні на їх розмір"""
+    content = message.get("content")
+    if not isinstance(content, list):
+        return message
+    parts = []
+    for part in content:
+        url = (part.get("image_url", {}).get("url") or "") if isinstance(part, dict) else ""
+        if url.startswith("data:"):
+            part = {"type": "image_url", "image_url": {"url": None}, "omitted_bytes": len(url)}
+        parts.append(part)
+    return {**message, "content": parts}
+
+
 @app.get("/history/{thread_id}")
-async def get_history(thread_id: str):
-    """Отримати історію розмови для thread"""
-    if thread_id in conversation_history:
-        return {"history": conversation_history[thread_id], "count": len(conversation_history[thread_id])}
-    return {"history": [], "count": 0}
+async def get_history(
+    thread_id: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    roles: Optional[str] = None,
+    include_images: bool = False,
+):
+    """Сторінка історії розмови: limit повідомлень перед cursor (від старих до нових)"""
+    key = history_key(thread_id)
+    total = await state_io(state.list_length, key)
+    # Історія тільки дописується - позиція повідомлення є стабільним курсором
+    end = total
+    if cursor:
+        if not cursor.isdigit():
+            return FastJSONResponse({"error": f"Невірний cursor: {cursor}"}, status_code=400)
+        end = min(int(cursor), total)
+    start = max(0, end - page_size(limit))
+    messages = await state_io(state.list_range, key, start, end - 1) if end > start else []
+    allowed_roles = parse_fields(roles)
+    selected = parse_fields(fields)
+    page = []
+    for message in messages:
+        if allowed_roles and message.get("role") not in allowed_roles:
+            continue
+        if not include_images:
+            message = without_inline_images(message)
+        page.append(project(message, selected))
+    return FastJSONResponse({
+        "history": page,
+        "count": total,
+        "next_cursor": str(start) if start > 0 else None,
+    })
+
+
+def reset_history(thread_id: str) -> bool:
+    """Залишити в історії тільки system prompt (перше повідомлення); False - розмови немає"""
+    first = state.list_range(history_key(thread_id), 0, 0)
+    state.delete("summaries", thread_id)
+    if first:
+        state.list_replace(history_key(thread_id), first)
+    return bool(first)
 
 
 @app.delete("/history/{thread_id}")
 async def clear_history(thread_id: str):
     """Очистити історію розмови для thread"""
-    if thread_id in conversation_history:
-        # Залишити тільки system prompt
-        system_msg = conversation_history[thread_id][0] if conversation_history[thread_id] else None
-        conversation_history[thread_id] = [system_msg] if system_msg else []
+    if await state_io(reset_history, thread_id):
         return {"status": "cleared"}
     return {"status": "not_found"}
 
@@ -0,0 +1,555 @@
+"""
+Локальний mock OpenAI-сумісного API для навантажувального тестування без витрат на API
+Запуск:  python mock_openai_server.py --port 8766 --latency lognormal:400,0.5 --token-ms 15
+Backend: OPENAI_API_KEY=mock OPENAI_BASE_URL=http://127.0.0.1:8766/v1 python main.py
+
+Підтримує:
+- POST /v1/chat/completions  - звичайні та stream відповіді, tool_calls (якщо передано tools)
+- POST /v1/images/generations
+- POST /v1/files, POST /v1/vector_stores, POST /v1/vector_stores/{id}/files
+- POST /v1/assistants, DELETE /v1/assistants/{id}, POST /v1/threads[/{id}], POST /v1/threads/{id}/runs і .../runs/{id}/submit_tool_outputs
+  (stream подій Assistants: requires_action на перший тул, далі повідомлення і thread.run.completed)
+- GET  /v1/models
+- GET  /_mock/stats, POST /_mock/reset - лічильники запитів
+
+Затримка відповіді задається розподілом (--latency):
+  fixed:200 | uniform:100,400 | normal:300,80 | lognormal:400,0.5 (медіана мс, sigma)
+
+Кеш префікса емулюється як в OpenAI: usage.prompt_tokens_details.cached_tokens - спільний з
+попередніми запитами префікс (tools + messages) блоками по 128 токенів, якщо він від 1024 токенів.
+
+З --rpm chat completions мають ліміт запитів на модель: відповіді містять x-ratelimit-* заголовки,
+а понад ліміт повертається 429 (як у OpenAI).
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VECTOR_STORE_FILES_RE = re.compile(r"/vector_stores/(?P<vector_store_id>[^/]+)/files/?$")
+ASSISTANT_RE = re.compile(r"/assistants/(?P<assistant_id>[^/]+)/?$")
+THREAD_RE = re.compile(r"/threads(?:/(?P<thread_id>[^/]+))?/?$")
+RUNS_RE = re.compile(r"/threads/(?P<thread_id>[^/]+)/runs(?:/(?P<run_id>[^/]+)/(?P<action>submit_tool_outputs|cancel))?/?$")
+
+# Значення аргументів тулів за назвою параметра (щоб backend отримав валідний виклик)
+SAMPLE_ARGUMENTS = {
+    "item_name": "iphone 15",
+    "destination": "Kyiv",
+    "price": 900,
+    "recipient": "load-test@example.com",
+    "subject": "Load test",
+    "body": "Лист з навантажувального тесту",
+    "topic": "Load test meeting",
+    "datetime_str": "2030-01-01 10:00",
+    "participants": "",
+    "quantity": 1,
+}
+
+REPLY_WORDS = (
+    "Це відповідь mock сервера для навантажувального тесту . Ціна товару становить 900 доларів , "
+    "доставка розраховується окремо . Дякую за запит !"
+).split()
+
+stats_lock = threading.Lock()
+stats = {"requests": 0, "by_path": {}, "streams": 0, "tool_calls": 0, "connections": 0, "rate_limited": 0,
+         "assistant_runs": 0, "prompt_tokens": 0, "cached_tokens": 0}
+# model -> [доступні запити, час оновлення] для --rpm
+rate_buckets = {}
+# Хеші префіксів попередніх запитів (LRU) для емуляції кешу префікса
+prefix_cache = OrderedDict()
+PREFIX_CACHE_SIZE = 100_000
+PREFIX_CACHE_MIN_TOKENS = 1024
+PREFIX_CACHE_BLOCK_TOKENS = 128
+# Створені assistants (id -> тіло запиту) та runs (id -> assistant id) для стріму подій
+assistants = {}
+runs = {}
+
+
+def reset_stats():
+    """Обнулити лічильники"""
+    with stats_lock:
+        stats.update({"requests": 0, "by_path": {}, "streams": 0, "tool_calls": 0, "connections": 0, "rate_limited": 0,
+                      "assistant_runs": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        rate_buckets.clear()
+        prefix_cache.clear()
+        assistants.clear()
+        runs.clear()
+
+
+class LatencyModel:
+    """Розподіл затримки відповіді в секундах"""
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, _, params = spec.partition(":")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p] or [0.0]
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Невідомий розподіл затримки: {spec}")
+
+    def sample(self) -> float:
+        p = self.params
+        if self.kind == "fixed":
+            ms = p[0]
+        elif self.kind == "uniform":
+            ms = random.uniform(p[0], p[1] if len(p) > 1 else p[0])
+        elif self.kind == "normal":
+            ms = random.gauss(p[0], p[1] if len(p) > 1 else 0.0)
+        else:
+            ms = random.lognormvariate(math.log(max(p[0], 1e-3)), p[1] if len(p) > 1 else 0.5)
+        return max(ms, 0.0) / 1000.0
+
+
+def estimate_tokens(value) -> int:
+    """Груба оцінка кількості токенів (~4 символи на токен)"""
+    return max(1, len(json.dumps(value, ensure_ascii=False)) // 4)
+
+
+def cached_prefix_tokens(request: dict) -> int:
+    """Токени префікса, спільного з попередніми запитами (блоками, від PREFIX_CACHE_MIN_TOKENS)"""
+    text = json.dumps(request.get("tools") or [], ensure_ascii=False) + "".join(
+        json.dumps(message, ensure_ascii=False) for message in request.get("messages") or []
+    )
+    block = PREFIX_CACHE_BLOCK_TOKENS * 4
+    digest = hashlib.sha256()
+    blocks = []
+    for end in range(block, len(text) + 1, block):
+        # Хеш ланцюжком: блок збігається, тільки якщо збігається весь префікс до нього
+        digest.update(text[end - block:end].encode())
+        blocks.append(digest.copy().digest())
+    cached = 0
+    with stats_lock:
+        for index, key in enumerate(blocks):
+            if key in prefix_cache:
+                cached = (index + 1) * PREFIX_CACHE_BLOCK_TOKENS
+                prefix_cache.move_to_end(key)
+            else:
+                prefix_cache[key] = None
+        while len(prefix_cache) > PREFIX_CACHE_SIZE:
+            prefix_cache.popitem(last=False)
+    return cached if cached >= PREFIX_CACHE_MIN_TOKENS else 0
+
+
+def sample_arguments(schema: dict) -> dict:
+    """Аргументи для tool call за JSON схемою параметрів тулу"""
+    arguments = {}
+    for name, prop in (schema.get("properties") or {}).items():
+        if name in SAMPLE_ARGUMENTS:
+            arguments[name] = SAMPLE_ARGUMENTS[name]
+        elif prop.get("type") == "array":
+            items = prop.get("items") or {}
+            arguments[name] = [sample_arguments(items)] if items.get("type") == "object" else []
+        elif prop.get("type") == "object":
+            arguments[name] = sample_arguments(prop)
+        elif prop.get("type") in ("integer", "number"):
+            arguments[name] = 1
+        elif prop.get("type") == "boolean":
+            arguments[name] = False
+        else:
+            arguments[name] = "test"
+    return arguments
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = LatencyModel()
+    token_delay = 0.0
+    reply_tokens = 24
+    tool_rate = 1.0
+    rpm = 0
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with stats_lock:
+            stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, status: int, payload, headers: dict = None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _count(self, path: str):
+        with stats_lock:
+            stats["requests"] += 1
+            stats["by_path"][path] = stats["by_path"].get(path, 0) + 1
+
+    # ----- chat completions -----
+    def _completion_message(self, request: dict) -> dict:
+        """Відповідь моделі: tool call на перший тул, або текст (після результату тулу)"""
+        messages = request.get("messages") or []
+        tools = request.get("tools") or []
+        # Додатковий контекст у system повідомленні після запиту користувача не рахується
+        roles = [message.get("role") for message in messages if message.get("role") != "system"]
+        last_role = roles[-1] if roles else "user"
+        if tools and last_role == "user" and random.random() < self.tool_rate:
+            function = tools[0].get("function", {})
+            with stats_lock:
+                stats["tool_calls"] += 1
+            return {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {
+                        "name": function.get("name", "unknown"),
+                        "arguments": json.dumps(sample_arguments(function.get("parameters") or {}), ensure_ascii=False),
+                    },
+                }],
+            }
+        words = [REPLY_WORDS[i % len(REPLY_WORDS)] for i in range(self.reply_tokens)]
+        return {"role": "assistant", "content": " ".join(words)}
+
+    def _take_request(self, model: str) -> tuple:
+        """(дозволено, x-ratelimit-* заголовки) для --rpm ліміту моделі"""
+        if not self.rpm:
+            return True, {}
+        now = time.monotonic()
+        rate = self.rpm / 60.0
+        with stats_lock:
+            bucket = rate_buckets.setdefault(model, [float(self.rpm), now])
+            bucket[0] = min(float(self.rpm), bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            allowed = bucket[0] >= 1
+            if allowed:
+                bucket[0] -= 1
+            else:
+                stats["rate_limited"] += 1
+            available = bucket[0]
+        reset = (self.rpm - available) / rate if allowed else (1 - available) / rate
+        return allowed, {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(int(available)),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+
+    def _chat_completions(self, request: dict):
+        model = request.get("model", "gpt-4o-mini")
+        allowed, limit_headers = self._take_request(model)
+        if not allowed:
+            return self._reply(429, {"error": {
+                "message": f"Rate limit reached for {model} on requests per min (RPM): Limit {self.rpm}.",
+                "type": "requests", "code": "rate_limit_exceeded",
+            }}, limit_headers)
+        time.sleep(self.latency.sample())
+        message = self._completion_message(request)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        usage = {
+            "prompt_tokens": estimate_tokens(request.get("messages") or []) + estimate_tokens(request.get("tools") or []),
+            "completion_tokens": self.reply_tokens if message.get("content") else 20,
+            "prompt_tokens_details": {"cached_tokens": cached_prefix_tokens(request)},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        with stats_lock:
+            stats["prompt_tokens"] += usage["prompt_tokens"]
+            stats["cached_tokens"] += usage["prompt_tokens_details"]["cached_tokens"]
+        finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+
+        if not request.get("stream"):
+            return self._reply(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            }, limit_headers)
+
+        self._start_event_stream(limit_headers)
+
+        def chunk(delta: dict, finish=None, with_usage=False):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [] if with_usage else [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            if with_usage:
+                payload["usage"] = usage
+            self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+
+        chunk({"role": "assistant", "content": ""})
+        if message.get("tool_calls"):
+            call = message["tool_calls"][0]
+            chunk({"tool_calls": [{"index": 0, "id": call["id"], "type": "function",
+                                   "function": {"name": call["function"]["name"], "arguments": ""}}]})
+            chunk({"tool_calls": [{"index": 0, "function": {"arguments": call["function"]["arguments"]}}]})
+        else:
+            for i, word in enumerate(message["content"].split(" ")):
+                if self.token_delay:
+                    time.sleep(self.token_delay)
+                chunk({"content": word if i == 0 else " " + word})
+        chunk({}, finish=finish_reason)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunk({}, with_usage=True)
+        self._write_chunk("data: [DONE]\n\n")
+        self._write_chunk("")
+
+    def _start_event_stream(self, headers: dict = None):
+        with stats_lock:
+            stats["streams"] += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    # ----- assistants -----
+    def _run_object(self, run_id: str, thread_id: str, status: str, required_action=None, usage=None) -> dict:
+        assistant_id = runs.get(run_id, "")
+        return {
+            "id": run_id,
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": assistant_id,
+            "status": status,
+            "model": assistants.get(assistant_id, {}).get("model", "gpt-4o"),
+            "instructions": "",
+            "tools": [],
+            "required_action": required_action,
+            "last_error": None,
+            "usage": usage,
+            "metadata": {},
+        }
+
+    def _run_events(self, thread_id: str, request: dict, run_id: str = None):
+        """Стрім подій run: новий run - requires_action (якщо є тули), після submit_tool_outputs - відповідь"""
+        def event(name: str, data: dict):
+            self._write_chunk(f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n")
+
+        self._start_event_stream()
+        if run_id is None:
+            run_id = f"run_{uuid.uuid4().hex[:24]}"
+            with stats_lock:
+                runs[run_id] = request.get("assistant_id", "")
+                stats["assistant_runs"] += 1
+            event("thread.run.created", self._run_object(run_id, thread_id, "queued"))
+            event("thread.run.in_progress", self._run_object(run_id, thread_id, "in_progress"))
+            time.sleep(self.latency.sample())
+            functions = [tool.get("function", {}) for tool in assistants.get(runs[run_id], {}).get("tools") or []
+                         if tool.get("type") == "function"]
+            if functions and random.random() < self.tool_rate:
+                with stats_lock:
+                    stats["tool_calls"] += 1
+                event("thread.run.requires_action", self._run_object(run_id, thread_id, "requires_action", {
+                    "type": "submit_tool_outputs",
+                    "submit_tool_outputs": {"tool_calls": [{
+                        "id": f"call_{uuid.uuid4().hex[:24]}",
+                        "type": "function",
+                        "function": {
+                            "name": functions[0].get("name", "unknown"),
+                            "arguments": json.dumps(sample_arguments(functions[0].get("parameters") or {}), ensure_ascii=False),
+                        },
+                    }]},
+                }))
+                self._write_chunk("event: done\ndata: [DONE]\n\n")
+                return self._write_chunk("")
+        else:
+            event("thread.run.queued", self._run_object(run_id, thread_id, "queued"))
+            time.sleep(self.latency.sample())
+
+        message_id = f"msg_{uuid.uuid4().hex[:24]}"
+        message = {
+            "id": message_id, "object": "thread.message", "created_at": int(time.time()), "thread_id": thread_id,
+            "run_id": run_id, "assistant_id": runs.get(run_id, ""), "role": "assistant", "status": "in_progress",
+            "content": [], "attachments": [], "metadata": {},
+        }
+        event("thread.message.created", message)
+        words = [REPLY_WORDS[i % len(REPLY_WORDS)] for i in range(self.reply_tokens)]
+        for i, word in enumerate(words):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            event("thread.message.delta", {"id": message_id, "object": "thread.message.delta", "delta": {
+                "content": [{"index": 0, "type": "text", "text": {"value": word if i == 0 else " " + word, "annotations": []}}],
+            }})
+        message.update(status="completed", content=[{"type": "text", "text": {"value": " ".join(words), "annotations": []}}])
+        event("thread.message.completed", message)
+        usage = {"prompt_tokens": estimate_tokens(request), "completion_tokens": self.reply_tokens}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        event("thread.run.completed", self._run_object(run_id, thread_id, "completed", usage=usage))
+        self._write_chunk("event: done\ndata: [DONE]\n\n")
+        self._write_chunk("")
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    # ----- routing -----
+    def _route(self, method: str):
+        path = self.path.split("?", 1)[0]
+        self._count(path)
+        body = self._body() if method == "POST" else b""
+
+        if path == "/_mock/stats":
+            with stats_lock:
+                return self._reply(200, stats)
+        if path == "/_mock/reset":
+            reset_stats()
+            return self._reply(200, {"status": "reset"})
+        if path.endswith("/models"):
+            return self._reply(200, {"object": "list", "data": [
+                {"id": name, "object": "model", "owned_by": "mock"} for name in ("gpt-4o-mini", "gpt-4o", "dall-e-3")
+            ]})
+
+        if method == "POST" and path.endswith("/chat/completions"):
+            return self._chat_completions(json.loads(body or b"{}"))
+
+        if method == "POST" and path.endswith("/images/generations"):
+            time.sleep(self.latency.sample())
+            request = json.loads(body or b"{}")
+            return self._reply(200, {"created": int(time.time()), "data": [{
+                "url": f"https://mock.local/images/{uuid.uuid4().hex}.png",
+                "revised_prompt": request.get("prompt", ""),
+            }]})
+
+        if method == "POST" and path.endswith("/files"):
+            match = re.search(rb'filename="([^"]*)"', body)
+            return self._reply(200, {
+                "id": f"file-{uuid.uuid4().hex[:24]}",
+                "object": "file",
+                "bytes": len(body),
+                "created_at": int(time.time()),
+                "filename": match.group(1).decode("utf-8", errors="replace") if match else "upload",
+                "purpose": "assistants",
+                "status": "processed",
+            })
+
+        match = VECTOR_STORE_FILES_RE.search(path)
+        if method == "POST" and match:
+            request = json.loads(body or b"{}")
+            return self._reply(200, {
+                "id": request.get("file_id", f"file-{uuid.uuid4().hex[:24]}"),
+                "object": "vector_store.file",
+                "created_at": int(time.time()),
+                "vector_store_id": match.group("vector_store_id"),
+                "status": "completed",
+                "usage_bytes": 0,
+                "last_error": None,
+            })
+
+        match = ASSISTANT_RE.search(path)
+        if method == "DELETE" and match:
+            with stats_lock:
+                deleted = assistants.pop(match.group("assistant_id"), None) is not None
+            if not deleted:
+                return self._reply(404, {"error": {"message": "No assistant found", "type": "invalid_request_error"}})
+            return self._reply(200, {"id": match.group("assistant_id"), "object": "assistant.deleted", "deleted": True})
+
+        if method == "POST" and path.endswith("/assistants"):
+            request = json.loads(body or b"{}")
+            assistant_id = f"asst_{uuid.uuid4().hex[:24]}"
+            with stats_lock:
+                assistants[assistant_id] = request
+            return self._reply(200, {
+                "id": assistant_id, "object": "assistant", "created_at": int(time.time()),
+                "name": request.get("name"), "model": request.get("model", "gpt-4o"),
+                "instructions": request.get("instructions"), "tools": request.get("tools") or [], "metadata": {},
+            })
+
+        match = THREAD_RE.search(path)
+        if method == "POST" and match:
+            request = json.loads(body or b"{}")
+            return self._reply(200, {
+                "id": match.group("thread_id") or f"thread_{uuid.uuid4().hex[:24]}", "object": "thread",
+                "created_at": int(time.time()), "metadata": {}, "tool_resources": request.get("tool_resources"),
+            })
+
+        match = RUNS_RE.search(path)
+        if method == "POST" and match:
+            request = json.loads(body or b"{}")
+            if match.group("action") == "cancel":
+                return self._reply(200, self._run_object(match.group("run_id"), match.group("thread_id"), "cancelled"))
+            return self._run_events(match.group("thread_id"), request, match.group("run_id"))
+
+        if method == "POST" and path.endswith("/vector_stores"):
+            request = json.loads(body or b"{}")
+            return self._reply(200, {
+                "id": f"vs_{uuid.uuid4().hex[:24]}",
+                "object": "vector_store",
+                "created_at": int(time.time()),
+                "name": request.get("name", ""),
+                "status": "completed",
+                "usage_bytes": 0,
+                "file_counts": {"in_progress": 0, "completed": 0, "failed": 0, "cancelled": 0, "total": 0},
+                "metadata": {},
+            })
+
+        self._reply(404, {"error": {"message": f"Not found: {method} {path}", "type": "invalid_request_error"}})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+
+def configure(latency: str = "fixed:0", token_ms: float = 0.0, reply_tokens: int = 24, tool_rate: float = 1.0,
+              rpm: int = 0):
+    """Налаштувати поведінку mock сервера"""
+    MockOpenAIHandler.latency = LatencyModel(latency)
+    MockOpenAIHandler.token_delay = token_ms / 1000.0
+    MockOpenAIHandler.reply_tokens = reply_tokens
+    MockOpenAIHandler.tool_rate = tool_rate
+    MockOpenAIHandler.rpm = rpm
+
+
+def run_server(host: str = "127.0.0.1", port: int = 8766, **options) -> ThreadingHTTPServer:
+    """Запустити mock сервер у фоновому потоці (зручно для скриптів)"""
+    configure(**options)
+    server = ThreadingHTTPServer((host, port), MockOpenAIHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI-сумісного API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", default="fixed:0", help="Розподіл затримки: fixed:200 | uniform:100,400 | normal:300,80 | lognormal:400,0.5")
+    parser.add_argument("--token-ms", type=float, default=0.0, help="Затримка між stream chunks")
+    parser.add_argument("--reply-tokens", type=int, default=24, help="Кількість слів у текстовій відповіді")
+    parser.add_argument("--tool-rate", type=float, default=1.0, help="Ймовірність tool call, якщо передано tools")
+    parser.add_argument("--rpm", type=int, default=0, help="Ліміт chat запитів на хвилину для кожної моделі (0 - без ліміту)")
+    args = parser.parse_args()
+
+    configure(args.latency, args.token_ms, args.reply_tokens, args.tool_rate, args.rpm)
+    server = ThreadingHTTPServer((args.host, args.port), MockOpenAIHandler)
+    server.daemon_threads = True
+    print(f"🧪 Mock OpenAI API: http://{args.host}:{args.port}/v1 (latency {args.latency}, token {args.token_ms} мс)")
+    print(f"   Backend: OPENAI_API_KEY=mock OPENAI_BASE_URL=http://{args.host}:{args.port}/v1 python main.py")
+    print(f"   Статистика: GET http://{args.host}:{args.port}/_mock/stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
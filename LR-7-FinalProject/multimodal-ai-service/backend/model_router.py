@@ -0,0 +1,449 @@
+"""
+Маршрутизатор моделей для чату
+Вибирає найдешевшу адекватну модель для кожного повідомлення.
+
+- HeuristicRouter - старе правило з ключовими словами (для порівняння в shadow режимі)
+- LearnedRouter   - логістична регресія по словах повідомлення, навчена з логу запитів
+                    (латентність, токени, оцінки /router/feedback); рішення - кілька мікросекунд
+
+Навчання і звіт:
+    python model_router.py train  --log router_log.jsonl --out router_weights.json
+    python model_router.py report --log router_log.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+
+SMALL_MODEL = "gpt-4o-mini"
+LARGE_MODEL = "gpt-4o"
+
+# Ціна за 1M токенів (input, output) - для оцінки вартості в звіті та порогу рішення
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+}
+
+# Скільки "коштує" секунда очікування користувача в доларах (для порогу в train)
+LATENCY_COST_PER_SECOND = float(os.getenv("ROUTER_LATENCY_COST", "0.0005"))
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(message: str) -> list:
+    """Слова повідомлення в нижньому регістрі"""
+    return _WORD_RE.findall(message.lower())
+
+
+def dense_features(message: str, words: list) -> dict:
+    """Числові ознаки повідомлення (довжина, структура)"""
+    return {
+        "__len__": math.log1p(len(words)) / 5.0,
+        "__lines__": min(message.count("\n"), 10) / 10.0,
+        "__code__": 1.0 if "```" in message else 0.0,
+        "__questions__": min(message.count("?"), 5) / 5.0,
+    }
+
+
+class ModelRouter:
+    """Базовий інтерфейс маршрутизатора: повертає назву моделі для повідомлення"""
+
+    name = "base"
+
+    def select(self, message: str) -> str:
+        raise NotImplementedError
+
+
+class HeuristicRouter(ModelRouter):
+    """Попереднє правило: будь-який індикатор складності або довге повідомлення -> gpt-4o"""
+
+    name = "heuristic"
+    complexity_indicators = [
+        "analyze", "compare", "explain", "why", "how", "what is",
+        "проаналізуй", "порівняй", "поясни", "чому", "як", "що таке",
+        "multiple", "several", "many", "кілька", "декілька",
+        "complex", "detailed", "складний", "детальний",
+        "calculate", "розрахуй", "порахуй",
+        "and", "також", "також", "потім", "then"
+    ]
+
+    def select(self, message: str) -> str:
+        message_lower = message.lower()
+        is_long = len(message.split()) > 20
+        has_complexity = any(indicator in message_lower for indicator in self.complexity_indicators)
+        return LARGE_MODEL if has_complexity or is_long else SMALL_MODEL
+
+
+# Апріорні ваги, поки немає навченої моделі: тільки цілі слова, що справді
+# означають складну задачу (не "and"/"how"/"як"), плюс довжина повідомлення.
+DEFAULT_WEIGHTS = {
+    "bias": -2.0,
+    "threshold": 0.5,
+    "small_model": SMALL_MODEL,
+    "large_model": LARGE_MODEL,
+    "dense": {"__len__": 2.0, "__lines__": 1.0, "__code__": 1.5, "__questions__": 0.3},
+    "vocab": {
+        word: 1.6 for word in (
+            "analyze", "analyse", "compare", "explain", "detailed", "complex", "prove", "derive",
+            "refactor", "debug", "optimize", "architecture", "strategy", "essay", "review",
+            "проаналізуй", "порівняй", "поясни", "детально", "детальний", "складний", "доведи",
+            "оптимізуй", "архітектура", "стратегія", "есе", "рецензія",
+        )
+    },
+}
+
+
+class LearnedRouter(ModelRouter):
+    """Логістична регресія: P(мала модель не впорається | повідомлення)"""
+
+    name = "learned"
+
+    def __init__(self, weights: Optional[dict] = None):
+        weights = weights or DEFAULT_WEIGHTS
+        self.bias = float(weights.get("bias", 0.0))
+        self.threshold = float(weights.get("threshold", 0.5))
+        self.small_model = weights.get("small_model", SMALL_MODEL)
+        self.large_model = weights.get("large_model", LARGE_MODEL)
+        self.vocab = dict(weights.get("vocab", {}))
+        self.dense = dict(weights.get("dense", {}))
+        self.trained_at = weights.get("trained_at")
+        # Dense ваги як атрибути - без словника ознак на кожен запит
+        self._w_len = self.dense.get("__len__", 0.0)
+        self._w_lines = self.dense.get("__lines__", 0.0)
+        self._w_code = self.dense.get("__code__", 0.0)
+        self._w_questions = self.dense.get("__questions__", 0.0)
+        # Поріг у просторі логітів: порівнюємо без виклику exp на гарячому шляху
+        self.logit_threshold = math.log(self.threshold / (1.0 - self.threshold))
+
+    @classmethod
+    def from_file(cls, path: str) -> "LearnedRouter":
+        """Завантажити ваги з JSON; якщо файлу немає - апріорні ваги"""
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(json.load(f))
+        return cls()
+
+    def score(self, message: str) -> float:
+        """Логіт P(потрібна велика модель)"""
+        words = _WORD_RE.findall(message.lower())
+        get = self.vocab.get
+        total = self.bias + sum(get(word, 0.0) for word in set(words))
+        # Те саме, що dense_features(), але без проміжного словника
+        total += self._w_len * math.log1p(len(words)) / 5.0
+        if "\n" in message:
+            total += self._w_lines * min(message.count("\n"), 10) / 10.0
+        if "```" in message:
+            total += self._w_code
+        if "?" in message:
+            total += self._w_questions * min(message.count("?"), 5) / 5.0
+        return total
+
+    def probability(self, message: str) -> float:
+        return 1.0 / (1.0 + math.exp(-self.score(message)))
+
+    def select(self, message: str) -> str:
+        return self.large_model if self.score(message) >= self.logit_threshold else self.small_model
+
+
+ROUTERS = {
+    HeuristicRouter.name: HeuristicRouter,
+    LearnedRouter.name: LearnedRouter,
+}
+
+
+def create_router(name: str, weights_path: Optional[str] = None) -> ModelRouter:
+    """Створити маршрутизатор за назвою (heuristic / learned)"""
+    if name == LearnedRouter.name:
+        return LearnedRouter.from_file(weights_path)
+    return ROUTERS.get(name, HeuristicRouter)()
+
+
+# ==================== LOG ====================
+def message_fields(message: str, max_chars: int) -> dict:
+    """
+    Повідомлення для логу: sha256, обрізаний текст і dense ознаки повного тексту
+
+    Повний текст користувача в лог не потрапляє: для навчання достатньо слів початку
+    повідомлення (перші max_chars символів) і ознак, порахованих до обрізання.
+    max_chars=0 - тільки хеш і ознаки.
+    """
+    return {
+        "message_sha256": hashlib.sha256(message.encode("utf-8")).hexdigest(),
+        "message": message[:max_chars] if max_chars > 0 else "",
+        "features": dense_features(message, tokenize(message)),
+    }
+
+
+class RouterLog:
+    """Append-only JSONL лог рішень маршрутизатора з ротацією за розміром (path.1 ... path.N)"""
+
+    def __init__(self, path: str, max_bytes: int = 0, backups: int = 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def log_files(path: str) -> list:
+    """Файли логу від найстарішого (path.N) до поточного"""
+    rotated = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        rotated.append(f"{path}.{index}")
+        index += 1
+    return list(reversed(rotated)) + ([path] if os.path.exists(path) else [])
+
+
+def read_log(path: str) -> list:
+    """Прочитати лог (разом з ротованими файлами) і застосувати явний feedback (type=feedback -> quality і feedback)"""
+    requests, feedback = [], {}
+    for file_path in log_files(path):
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("type") == "feedback":
+                    feedback[record.get("request_id")] = record.get("quality")
+                else:
+                    requests.append(record)
+    for record in requests:
+        if record.get("request_id") in feedback:
+            record["quality"] = record["feedback"] = feedback[record["request_id"]]
+    return requests
+
+
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Вартість запиту в доларах за прайсом MODEL_PRICES"""
+    price_in, price_out = MODEL_PRICES.get(model, MODEL_PRICES[LARGE_MODEL])
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+
+# ==================== TRAINING ====================
+def training_examples(records: list, small_model: str = SMALL_MODEL) -> list:
+    """
+    Приклади (message, label, features) для моделі "мала модель не впорається"
+
+    Мітку дають тільки запити, які реально обслуговувала мала модель (в т.ч.
+    через exploration), з явною оцінкою користувача (/router/feedback): < 0.5 -> 1,
+    інакше 0. Автоматичний сигнал якості не міряє правильність відповіді (коректне
+    "товару немає в каталозі" виглядає як помилка інструмента), тому не є міткою.
+    Запити на великій моделі не кажуть, чи впоралась би мала, тому не використовуються.
+    features - dense ознаки повного повідомлення з логу (None у старих записах).
+    """
+    examples = []
+    for record in records:
+        if record.get("model") != small_model or record.get("feedback") is None:
+            continue
+        message = record.get("message") or ""
+        if not message:
+            continue
+        examples.append((message, 1.0 if float(record["feedback"]) < 0.5 else 0.0, record.get("features")))
+    return examples
+
+
+def decision_threshold(records: list, small_model: str, large_model: str) -> float:
+    """
+    Поріг P(провал малої моделі), нижче якого мала модель вигідніша
+
+    Мала: cost_s + p * (cost_l + штраф за латентність повтору); велика: cost_l.
+    Середні токени та латентність беруться з логу, інакше з розумних значень.
+    """
+    stats = defaultdict(lambda: {"cost": 0.0, "latency": 0.0, "n": 0})
+    for record in records:
+        model = record.get("model")
+        if model not in (small_model, large_model):
+            continue
+        item = stats[model]
+        item["cost"] += request_cost(model, record.get("prompt_tokens") or 0, record.get("completion_tokens") or 0)
+        item["latency"] += (record.get("latency_ms") or 0) / 1000.0
+        item["n"] += 1
+
+    def average(model, field, default):
+        item = stats.get(model)
+        return item[field] / item["n"] if item and item["n"] else default
+
+    cost_small = average(small_model, "cost", request_cost(small_model, 1500, 300))
+    cost_large = average(large_model, "cost", request_cost(large_model, 1500, 300))
+    latency_small = average(small_model, "latency", 2.0)
+    latency_large = average(large_model, "latency", 4.0)
+    penalty = cost_large + (latency_small + latency_large) * LATENCY_COST_PER_SECOND
+    savings = (cost_large + latency_large * LATENCY_COST_PER_SECOND) - (cost_small + latency_small * LATENCY_COST_PER_SECOND)
+    if penalty <= 0:
+        return 0.5
+    return min(max(savings / penalty, 0.05), 0.95)
+
+
+def train(records: list, epochs: int = 30, learning_rate: float = 0.1, l2: float = 1e-4, min_count: int = 2) -> dict:
+    """Навчити ваги LearnedRouter (SGD логістичної регресії по розріджених ознаках)"""
+    small_model, large_model = SMALL_MODEL, LARGE_MODEL
+    examples = training_examples(records, small_model)
+    if not examples:
+        raise ValueError("У лозі немає запитів малої моделі з оцінкою /router/feedback - нема на чому вчитися")
+
+    counts = defaultdict(int)
+    tokenized = []
+    for message, label, features in examples:
+        words = set(tokenize(message))
+        for word in words:
+            counts[word] += 1
+        tokenized.append((words, features or dense_features(message, tokenize(message)), label))
+
+    vocab = {word: 0.0 for word, count in counts.items() if count >= min_count}
+    dense = {name: 0.0 for name in DEFAULT_WEIGHTS["dense"]}
+    positives = sum(label for _, _, label in tokenized)
+    rate = min(max(positives / len(tokenized), 0.01), 0.99)
+    bias = math.log(rate / (1 - rate))
+
+    for epoch in range(epochs):
+        step = learning_rate / (1 + epoch * 0.1)
+        for words, features, label in tokenized:
+            logit = bias + sum(vocab[w] for w in words if w in vocab) + sum(dense[n] * v for n, v in features.items())
+            logit = min(max(logit, -30.0), 30.0)
+            error = 1.0 / (1.0 + math.exp(-logit)) - label
+            bias -= step * error
+            for word in words:
+                if word in vocab:
+                    vocab[word] -= step * (error + l2 * vocab[word])
+            for name, value in features.items():
+                dense[name] -= step * (error * value + l2 * dense[name])
+
+    return {
+        "bias": bias,
+        "threshold": decision_threshold(records, small_model, large_model),
+        "small_model": small_model,
+        "large_model": large_model,
+        "dense": dense,
+        "vocab": {word: round(weight, 5) for word, weight in vocab.items() if abs(weight) > 1e-3},
+        "trained_at": datetime.now().isoformat(),
+        "samples": len(tokenized),
+        "positives": int(positives),
+    }
+
+
+# ==================== SHADOW REPORT ====================
+def shadow_report(records: list) -> dict:
+    """
+    Порівняння обслуговуючого маршрутизатора з тіньовим
+
+    Для кожного запиту в лозі є model (що реально викликали) та shadow_model
+    (що обрав би інший маршрутизатор). Вартість і латентність моделей оцінюються
+    за фактичними середніми з цього ж логу.
+    """
+    routed = [r for r in records if r.get("router") and r.get("shadow_model")]
+    per_model = defaultdict(lambda: {"requests": 0, "cost": 0.0, "latency_ms": 0.0, "quality": 0.0, "rated": 0})
+    for record in records:
+        model = record.get("model")
+        if not model:
+            continue
+        item = per_model[model]
+        item["requests"] += 1
+        item["cost"] += request_cost(model, record.get("prompt_tokens") or 0, record.get("completion_tokens") or 0)
+        item["latency_ms"] += record.get("latency_ms") or 0
+        if record.get("quality") is not None:
+            item["quality"] += float(record["quality"])
+            item["rated"] += 1
+
+    models = {}
+    for model, item in per_model.items():
+        models[model] = {
+            "requests": item["requests"],
+            "avg_cost_usd": item["cost"] / item["requests"],
+            "avg_latency_ms": item["latency_ms"] / item["requests"],
+            "avg_quality": item["quality"] / item["rated"] if item["rated"] else None,
+        }
+
+    def estimate(model, field):
+        if model in models:
+            return models[model][field]
+        if field == "avg_cost_usd":
+            return request_cost(model, 1500, 300)
+        return 0.0
+
+    by_router = defaultdict(lambda: {"decisions": defaultdict(int), "est_cost_usd": 0.0, "est_latency_ms": 0.0})
+    agree = 0
+    for record in routed:
+        served, shadow = record["model"], record["shadow_model"]
+        agree += served == shadow
+        for router, model in ((record["router"], served), (record.get("shadow_router", "shadow"), shadow)):
+            item = by_router[router]
+            item["decisions"][model] += 1
+            item["est_cost_usd"] += estimate(model, "avg_cost_usd")
+            item["est_latency_ms"] += estimate(model, "avg_latency_ms")
+
+    return {
+        "requests": len(records),
+        "compared": len(routed),
+        "agreement": agree / len(routed) if routed else None,
+        "models": models,
+        "routers": {
+            name: {
+                "decisions": dict(item["decisions"]),
+                "est_cost_usd": round(item["est_cost_usd"], 6),
+                "est_avg_latency_ms": round(item["est_latency_ms"] / len(routed), 1) if routed else None,
+            }
+            for name, item in by_router.items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Навчання та звіт маршрутизатора моделей")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train_parser = sub.add_parser("train", help="Навчити ваги з логу")
+    train_parser.add_argument("--log", default=os.getenv("ROUTER_LOG_PATH", "./router_log.jsonl"))
+    train_parser.add_argument("--out", default=os.getenv("ROUTER_WEIGHTS_PATH", "./router_weights.json"))
+    train_parser.add_argument("--epochs", type=int, default=30)
+    report_parser = sub.add_parser("report", help="Shadow-звіт: learned vs heuristic")
+    report_parser.add_argument("--log", default=os.getenv("ROUTER_LOG_PATH", "./router_log.jsonl"))
+    bench_parser = sub.add_parser("bench", help="Час одного рішення")
+    bench_parser.add_argument("--weights", default=os.getenv("ROUTER_WEIGHTS_PATH", "./router_weights.json"))
+    args = parser.parse_args()
+
+    if args.command == "train":
+        weights = train(read_log(args.log), epochs=args.epochs)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(weights, f, ensure_ascii=False, indent=2)
+        print(f"✅ Навчено на {weights['samples']} прикладах ({weights['positives']} провалів малої моделі)")
+        print(f"   Поріг рішення: {weights['threshold']:.3f}, словник: {len(weights['vocab'])} слів -> {args.out}")
+    elif args.command == "report":
+        print(json.dumps(shadow_report(read_log(args.log)), ensure_ascii=False, indent=2))
+    else:
+        router = LearnedRouter.from_file(args.weights)
+        message = "Порівняй ціни на iphone 15 та macbook pro і надішли результат на email"
+        n = 100_000
+        start = time.perf_counter()
+        for _ in range(n):
+            router.select(message)
+        print(f"⏱️  {(time.perf_counter() - start) / n * 1e6:.2f} µs на рішення -> {router.select(message)}")
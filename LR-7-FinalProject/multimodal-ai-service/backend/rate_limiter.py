@@ -0,0 +1,504 @@
+"""
+Адаптивний планувальник викликів моделей (token bucket на RPM і TPM для кожної моделі)
+
+Перед кожним запитом до API резервується 1 запит і оцінка токенів (розмір тіла / 4 + max_tokens)
+з двох відер моделі. Зображення в messages (base64 data URL) рахуються фіксовано - IMAGE_TOKENS
+з history_compaction.py, а не за розміром: інакше одне фото "коштує" >100k токенів. Якщо відро в мінусі - запит чекає, поки воно наповниться: сплеск запитів
+перетворюється на трохи більшу латентність замість помилки 429.
+
+Ліміти не треба налаштовувати: вони беруться з заголовків відповіді
+x-ratelimit-limit-*/x-ratelimit-remaining-*/x-ratelimit-reset-*. До першої відповіді
+використовуються RATE_LIMIT_RPM / RATE_LIMIT_TPM (якщо не задано - без обмежень).
+
+Якщо 429 все ж прийшла, відро моделі обнуляється, а запит знову стає в чергу відра і
+повторюється не раніше retry-after / reset (з jitter) - повтори не б'ють у ліміт одночасно.
+Після останньої спроби 429 повертається з x-should-retry: false - SDK не повторює її ще раз
+поверх планувальника.
+
+Коли відро моделі в мінусі, запити чекають у зваженій справедливій черзі між tenant-ами
+(fair_queue.py) замість черги в порядку надходження. Очікування обмежене max_wait
+(RATE_LIMIT_MAX_WAIT): довше - запит не відправляється, транспорт повертає 429.
+
+Працює як httpx транспорт (RateLimitTransport / AsyncRateLimitTransport) для http_client OpenAI.
+"""
+
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+import httpx
+
+from fair_queue import MAX_TRACKED_TENANTS, FairQueue, TenantPolicy, current_tenant
+from history_compaction import IMAGE_TOKENS
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+# Статуси, які повторюються планувальником
+RETRY_STATUSES = {429, 503}
+# Частини повідомлень із зображенням (Chat Completions / Responses API)
+IMAGE_PART_TYPES = {"image_url", "input_image"}
+
+
+class RateLimitWaitExceeded(RuntimeError):
+    """Черга до квоти довша за max_wait - запит не відправляється"""
+
+    def __init__(self, model: str, wait: float):
+        super().__init__(f"Rate limit queue for {model} exceeds {wait:.1f}s")
+        self.model = model
+        self.wait = wait
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """"6m0s", "1.5s", "20ms" або "2" (секунди) -> секунди"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+class TokenBucket:
+    """Відро з поповненням capacity за хвилину; резервування може йти в мінус (черга)"""
+
+    def __init__(self, capacity: Optional[float] = None):
+        self.capacity = capacity
+        self.tokens = capacity or 0.0
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def _refill(self, now: float):
+        if self.capacity:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Зарезервувати amount, повернути скільки секунд чекати до відправки"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        # Запит більший за все відро - пропустити, коли відро повне, а не чекати вічно
+        amount = min(amount, self.capacity)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def debt(self, now: float) -> float:
+        """Скільки секунд до виходу з мінуса (0 - можна відправляти)"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def observe(self, limit: Optional[float], remaining: Optional[float], now: float):
+        """Уточнити стан з заголовків відповіді (сервер знає краще за локальну оцінку)"""
+        if limit:
+            if not self.capacity:
+                self.tokens = limit
+            self.capacity = limit
+        self._refill(now)
+        if remaining is not None and self.capacity:
+            self.tokens = min(self.tokens, remaining)
+
+    def drain(self, now: float):
+        """Після 429: локальна оцінка була завищена - відро порожнє"""
+        if self.capacity:
+            self._refill(now)
+            self.tokens = min(self.tokens, 0.0)
+
+
+class RateLimitScheduler:
+    """Відра RPM/TPM по моделях + політика повторів"""
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        max_retries: int = 4,
+        max_wait: float = 30.0,
+        backoff: float = 0.5,
+        completion_tokens: int = 256,
+        observer: Optional[Callable[[str, str, float], None]] = None,
+        policy: Optional[TenantPolicy] = None,
+    ):
+        self.default_rpm = rpm
+        self.default_tpm = tpm
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self.completion_tokens = completion_tokens
+        self.observer = observer
+        self.policy = policy or TenantPolicy()
+        self._buckets = {}  # model -> (requests, tokens)
+        self._queues = {}  # model -> FairQueue
+        self._tenant_buckets = {}  # tenant -> TokenBucket (TENANT_TPM)
+        self._usage = {}  # tenant -> відправлені токени (оцінка)
+        self._lock = threading.Lock()
+
+    def _model_buckets(self, model: str) -> tuple:
+        buckets = self._buckets.get(model)
+        if buckets is None:
+            buckets = self._buckets[model] = (TokenBucket(self.default_rpm), TokenBucket(self.default_tpm))
+        return buckets
+
+    def _notify(self, event: str, model: str, value: float = 1.0):
+        if self.observer is not None:
+            self.observer(event, model, value)
+
+    def estimate(self, request: httpx.Request) -> tuple:
+        """(модель, оцінка токенів) з JSON тіла запиту"""
+        body = request.content
+        try:
+            payload = json.loads(body) if body and request.headers.get("content-type", "").startswith("application/json") else {}
+        except ValueError:
+            payload = {}
+        model = payload.get("model") if isinstance(payload, dict) else None
+        if not model:
+            return request.url.path, 0
+        completion = payload.get("max_completion_tokens") or payload.get("max_tokens") or self.completion_tokens
+        images, image_chars = _image_parts(payload.get("messages") or payload.get("input"))
+        return model, (len(body) - image_chars) // 4 + IMAGE_TOKENS * images + int(completion)
+
+    def acquire(self, model: str, tokens: int) -> float:
+        """Зарезервувати місце для запиту, повернути затримку перед відправкою"""
+        now = time.monotonic()
+        with self._lock:
+            requests_bucket, tokens_bucket = self._model_buckets(model)
+            wait = max(requests_bucket.reserve(1, now), tokens_bucket.reserve(tokens, now))
+        if wait > 0:
+            self._notify("wait", model, wait)
+        return wait
+
+    # ----- справедлива черга між tenant-ами -----
+    def _tenant_budget_wait(self, tenant: str, tokens: int) -> float:
+        """Зарезервувати токени з бюджету tenant-а, повернути затримку (перевищення чекає тільки він)
+
+        Затримка більша за max_wait - резерв повертається і RateLimitWaitExceeded."""
+        budget = self.policy.budget(tenant)
+        if not budget:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._tenant_buckets.get(tenant)
+            if bucket is None or bucket.capacity != budget:
+                if len(self._tenant_buckets) > MAX_TRACKED_TENANTS:
+                    # Повне відро нічим не відрізняється від нового
+                    for name, old in list(self._tenant_buckets.items()):
+                        old._refill(now)
+                        if old.tokens >= old.capacity:
+                            del self._tenant_buckets[name]
+                bucket = self._tenant_buckets[tenant] = TokenBucket(budget)
+            wait = bucket.reserve(tokens, now)
+            if wait > self.max_wait:
+                bucket.tokens += min(tokens, bucket.capacity)
+        if wait > self.max_wait:
+            raise RateLimitWaitExceeded(tenant, wait)
+        if wait > 0:
+            self._notify("budget", tenant, wait)
+        return wait
+
+    def _model_debt(self, model: str, now: float) -> float:
+        return max(bucket.debt(now) for bucket in self._model_buckets(model))
+
+    def _dispatch(self, model: str, tenant: str, tokens: int, now: float):
+        requests_bucket, tokens_bucket = self._model_buckets(model)
+        requests_bucket.reserve(1, now)
+        tokens_bucket.reserve(tokens, now)
+        if tenant not in self._usage and len(self._usage) >= MAX_TRACKED_TENANTS:
+            self._usage.clear()
+        self._usage[tenant] = self._usage.get(tenant, 0) + tokens
+
+    def _enter(self, model: str, tenant: str, tokens: int, loop=None):
+        """Відправити одразу, якщо черги немає і квоти вистачає (None), інакше стати в чергу (Ticket)"""
+        now = time.monotonic()
+        with self._lock:
+            queue = self._queues.setdefault(model, FairQueue())
+            if not len(queue) and self._model_debt(model, now) <= 0:
+                self._dispatch(model, tenant, tokens, now)
+                return None
+            return queue.push(tenant, tokens, self.policy.weight(tenant), loop)
+
+    def _try_dispatch(self, model: str, ticket) -> Optional[float]:
+        """0 - відправлено; >0 - перший у черзі, чекати стільки на квоту; None - чекати своєї черги"""
+        now = time.monotonic()
+        with self._lock:
+            queue = self._queues[model]
+            if queue.head() is not ticket:
+                return None
+            wait = self._model_debt(model, now)
+            if wait > 0:
+                return wait
+            queue.pop()
+            self._dispatch(model, ticket.tenant, ticket.cost, now)
+            following = queue.head()
+        if following is not None:
+            following.wake()
+        return 0.0
+
+    def _leave(self, model: str, ticket):
+        """Запит скасовано в черзі - прибрати і розбудити наступного"""
+        with self._lock:
+            ticket.cancelled = True
+            following = self._queues[model].head()
+        if following is not None:
+            following.wake()
+
+    def wait_turn(self, model: str, tokens: int) -> float:
+        """Дочекатися своєї черги (бюджет tenant-а, WFQ, квота моделі); повертає час очікування
+
+        Довше за max_wait - RateLimitWaitExceeded (запит прибирається з черги)."""
+        started = time.monotonic()
+        tenant = current_tenant()
+        budget_wait = self._tenant_budget_wait(tenant, tokens)
+        if budget_wait:
+            time.sleep(budget_wait)
+        ticket = self._enter(model, tenant, tokens)
+        dispatched = ticket is None
+        try:
+            while not dispatched:
+                wait = self._try_dispatch(model, ticket)
+                if wait == 0:
+                    dispatched = True
+                    break
+                timeout = self._queue_timeout(model, wait, started)
+                # Не-перший чекає на wake(); таймаут - страховка від пропущеного сигналу
+                ticket.event.wait(timeout)
+                ticket.event.clear()
+        finally:
+            if not dispatched:
+                self._leave(model, ticket)
+        return self._waited(model, started)
+
+    async def await_turn(self, model: str, tokens: int) -> float:
+        """Async варіант wait_turn (очікування не блокує event loop, скасування прибирає з черги)"""
+        started = time.monotonic()
+        tenant = current_tenant()
+        budget_wait = self._tenant_budget_wait(tenant, tokens)
+        if budget_wait:
+            await asyncio.sleep(budget_wait)
+        ticket = self._enter(model, tenant, tokens, asyncio.get_running_loop())
+        dispatched = ticket is None
+        try:
+            while not dispatched:
+                wait = self._try_dispatch(model, ticket)
+                if wait == 0:
+                    dispatched = True
+                    break
+                timeout = self._queue_timeout(model, wait, started)
+                try:
+                    await asyncio.wait_for(ticket.event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                ticket.event.clear()
+        finally:
+            if not dispatched:
+                self._leave(model, ticket)
+        return self._waited(model, started)
+
+    def _queue_timeout(self, model: str, wait: Optional[float], started: float) -> float:
+        """Скільки чекати наступної спроби; квота не встигне за max_wait - RateLimitWaitExceeded"""
+        now = time.monotonic()
+        expected = now - started + (wait or 0.0)
+        if now - started >= self.max_wait or expected > self.max_wait:
+            self._notify("rejected", model)
+            raise RateLimitWaitExceeded(model, expected)
+        return min(wait or 1.0, started + self.max_wait - now)
+
+    def _waited(self, model: str, started: float) -> float:
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self._notify("wait", model, waited)
+        return waited
+
+    def queued(self) -> int:
+        """Запити в чергах усіх моделей"""
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def observe(self, model: str, headers: httpx.Headers):
+        """Оновити ліміти моделі з x-ratelimit-* заголовків"""
+        if "x-ratelimit-limit-requests" not in headers and "x-ratelimit-limit-tokens" not in headers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            requests_bucket, tokens_bucket = self._model_buckets(model)
+            requests_bucket.observe(_number(headers.get("x-ratelimit-limit-requests")),
+                                    _number(headers.get("x-ratelimit-remaining-requests")), now)
+            tokens_bucket.observe(_number(headers.get("x-ratelimit-limit-tokens")),
+                                  _number(headers.get("x-ratelimit-remaining-tokens")), now)
+
+    def retry_delay(self, model: str, response: httpx.Response, attempt: int) -> Optional[float]:
+        """Затримка перед повтором (None - не повторювати)"""
+        if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+            return None
+        if _request_too_large(response):
+            # TPM ліміт менший за сам запит - очікування не допоможе
+            return None
+        headers = response.headers
+        retry_after_ms = _number(headers.get("retry-after-ms"))
+        delay = retry_after_ms / 1000 if retry_after_ms is not None else parse_duration(headers.get("retry-after"))
+        if delay is None:
+            resets = [parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+            resets = [value for value in resets if value]
+            delay = min(resets) if resets else self.backoff * (2 ** attempt)
+        if delay > self.max_wait:
+            return None
+        # Jitter: запити, що отримали 429 одночасно, не повертаються одночасно
+        delay *= random.uniform(1.0, 1.5)
+        with self._lock:
+            for bucket in self._model_buckets(model):
+                bucket.drain(time.monotonic())
+        self._notify("retry", model)
+        return delay
+
+    def snapshot(self) -> dict:
+        """Поточний стан відер по моделях"""
+        now = time.monotonic()
+        with self._lock:
+            state = {}
+            for model, buckets in self._buckets.items():
+                for bucket in buckets:
+                    bucket._refill(now)
+                requests_bucket, tokens_bucket = buckets
+                state[model] = {
+                    "rpm": requests_bucket.capacity,
+                    "requests_available": round(requests_bucket.tokens, 1) if requests_bucket.capacity else None,
+                    "tpm": tokens_bucket.capacity,
+                    "tokens_available": round(tokens_bucket.tokens) if tokens_bucket.capacity else None,
+                    "queued": len(self._queues.get(model) or ()),
+                }
+            return state
+
+    def tenant_snapshot(self, top: int = 10) -> dict:
+        """Ваги, бюджети і tenant-и з найбільшою кількістю відправлених токенів"""
+        with self._lock:
+            usage = sorted(self._usage.items(), key=lambda item: item[1], reverse=True)[:top]
+        return {
+            "weights": self.policy.weights,
+            "tpm": self.policy.tpm,
+            "top_usage": [{"tenant": tenant, "tokens": tokens} for tenant, tokens in usage],
+        }
+
+
+def _number(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _image_parts(messages) -> tuple:
+    """(кількість зображень, символи їхніх URL у тілі) в messages / input"""
+    images = chars = 0
+    for message in messages if isinstance(messages, list) else ():
+        content = message.get("content") if isinstance(message, dict) else None
+        for part in content if isinstance(content, list) else ():
+            if not isinstance(part, dict) or part.get("type") not in IMAGE_PART_TYPES:
+                continue
+            url = part.get("image_url")
+            if isinstance(url, dict):
+                url = url.get("url")
+            images += 1
+            chars += len(url) if isinstance(url, str) else 0
+    return images, chars
+
+
+def _request_too_large(response: httpx.Response) -> bool:
+    try:
+        return b"Request too large" in response.read()
+    except httpx.HTTPError:
+        return False
+
+
+def _final_response(response: httpx.Response) -> httpx.Response:
+    if response.status_code in RETRY_STATUSES:
+        response.headers["x-should-retry"] = "false"
+    return response
+
+
+def _queue_rejected(request: httpx.Request, error: RateLimitWaitExceeded) -> httpx.Response:
+    """Локальна 429 у форматі OpenAI - SDK піднімає RateLimitError, як на відповідь API"""
+    return httpx.Response(
+        429,
+        headers={"x-should-retry": "false", "retry-after": str(max(1, round(error.wait)))},
+        json={"error": {"message": f"Rate limit reached: {error}", "type": "rate_limit_exceeded", "code": "rate_limit_exceeded"}},
+        request=request,
+    )
+
+
+class RateLimitTransport(httpx.BaseTransport):
+    """httpx транспорт: чекає на відро моделі, вчиться з заголовків, повторює 429 з jitter"""
+
+    def __init__(self, scheduler: RateLimitScheduler, inner: Optional[httpx.BaseTransport] = None):
+        self.scheduler = scheduler
+        self.inner = inner or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        model, tokens = self.scheduler.estimate(request)
+        try:
+            self.scheduler.wait_turn(model, tokens)
+        except RateLimitWaitExceeded as e:
+            return _queue_rejected(request, e)
+        attempt = 0
+        while True:
+            response = self.inner.handle_request(request)
+            self.scheduler.observe(model, response.headers)
+            delay = self.scheduler.retry_delay(model, response, attempt)
+            if delay is None:
+                return _final_response(response)
+            delay = max(delay, self.scheduler.acquire(model, tokens))
+            if delay > self.scheduler.max_wait:
+                return _final_response(response)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.inner.close()
+
+
+class AsyncRateLimitTransport(httpx.AsyncBaseTransport):
+    """Async варіант RateLimitTransport (очікування не блокує event loop)"""
+
+    def __init__(self, scheduler: RateLimitScheduler, inner: Optional[httpx.AsyncBaseTransport] = None):
+        self.scheduler = scheduler
+        self.inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        model, tokens = self.scheduler.estimate(request)
+        try:
+            await self.scheduler.await_turn(model, tokens)
+        except RateLimitWaitExceeded as e:
+            return _queue_rejected(request, e)
+        attempt = 0
+        while True:
+            response = await self.inner.handle_async_request(request)
+            self.scheduler.observe(model, response.headers)
+            if response.status_code in RETRY_STATUSES:
+                await response.aread()
+            delay = self.scheduler.retry_delay(model, response, attempt)
+            if delay is None:
+                return _final_response(response)
+            delay = max(delay, self.scheduler.acquire(model, tokens))
+            if delay > self.scheduler.max_wait:
+                return _final_response(response)
+            await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        await self.inner.aclose()
@@ -0,0 +1,72 @@
+"""
+Single-flight: однакові операції, що виконуються одночасно, ділять один результат
+
+Ключ операції - хеш вмісту її аргументів (запит RAG, байти зображення, prompt...).
+Перший виклик (leader) запускає роботу, інші з тим самим ключем поки вона триває
+(coalesced) чекають на той самий future замість власного виклику API.
+Результат не кешується: після завершення наступний виклик знову виконує роботу.
+
+Робота запускається окремою задачею - якщо клієнт leader відключився, інші все одно
+отримають результат. Неідемпотентні операції (generate_image) викликаються з coalesce=False,
+решту можна вимкнути через SINGLE_FLIGHT_DISABLE=analyze_image,... (див. main.py).
+"""
+
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Iterable, Optional
+
+
+def content_key(*parts) -> str:
+    """Хеш вмісту аргументів операції (str / bytes - напряму, інше - через repr)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            tag, data = b"b", part
+        elif isinstance(part, str):
+            tag, data = b"s", part.encode("utf-8", "surrogatepass")
+        else:
+            tag, data = b"r", repr(part).encode("utf-8")
+        digest.update(tag + len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """Реєстр операцій у процесі виконання: (operation, key) -> asyncio.Future"""
+
+    def __init__(self, disabled: Iterable[str] = (), observer: Optional[Callable[[str, str], None]] = None):
+        self.disabled = set(disabled)
+        self.observer = observer
+        self._in_flight = {}
+
+    def _notify(self, operation: str, result: str):
+        if self.observer is not None:
+            self.observer(operation, result)
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def _finish(self, flight_key: tuple, task: asyncio.Future):
+        if self._in_flight.get(flight_key) is task:
+            del self._in_flight[flight_key]
+        # Помилку отримують очікувачі; якщо всі вони скасовані - не шуміти в лог asyncio
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, operation: str, key: str, work: Callable[[], Awaitable], coalesce: bool = True):
+        """Виконати work() або приєднатися до такої ж операції, що вже виконується"""
+        if not coalesce or operation in self.disabled:
+            self._notify(operation, "bypass")
+            return await work()
+
+        flight_key = (operation, key)
+        task = self._in_flight.get(flight_key)
+        if task is not None:
+            self._notify(operation, "coalesced")
+        else:
+            self._notify(operation, "leader")
+            task = asyncio.ensure_future(work())
+            self._in_flight[flight_key] = task
+            task.add_done_callback(lambda done: self._finish(flight_key, done))
+        # shield: скасування одного очікувача не скасовує спільну роботу
+        return await asyncio.shield(task)
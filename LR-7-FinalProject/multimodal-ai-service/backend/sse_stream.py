@@ -0,0 +1,75 @@
+"""
+Об'єднання дельт стріму моделі в SSE кадри зі зворотним тиском (backpressure)
+
+Upstream (async стрім OpenAI) читає окрема задача-продюсер і складає текст у буфер,
+відправник забирає з буфера все накопичене одним кадром: перша дельта йде одразу
+(time-to-first-token не страждає), наступні - не частіше ніж раз на window секунд.
+Замість кадру і json.dumps на кожен токен - кілька кадрів на секунду на стрім.
+
+Повільний клієнт не розганяє пам'ять: відправник чекає, поки сервер (uvicorn) віддасть
+попередній кадр у сокет, а продюсер зупиняє читання upstream, коли в буфері більше
+max_pending символів, - тиск доходить до TCP з'єднання з OpenAI.
+"""
+
+import asyncio
+import json
+from typing import AsyncIterator
+
+
+def sse_frame(payload: dict) -> str:
+    """Один SSE кадр data: {...}"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+class FrameBuffer:
+    """Буфер тексту між продюсером (upstream) і відправником (клієнт)"""
+
+    def __init__(self, window: float = 0.04, max_pending: int = 256 * 1024):
+        self.window = window
+        self.max_pending = max_pending
+        self._parts = []
+        self._size = 0
+        self._closed = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    @property
+    def pending(self) -> int:
+        return self._size
+
+    async def put(self, text: str):
+        """Додати дельту; чекає, якщо клієнт не встигає забирати (буфер переповнено)"""
+        self._parts.append(text)
+        self._size += len(text)
+        self._readable.set()
+        if self._size >= self.max_pending:
+            self._writable.clear()
+            await self._writable.wait()
+
+    def close(self):
+        """Upstream закінчився (або впав) - відправник забере залишок і завершиться"""
+        self._closed = True
+        self._readable.set()
+
+    def _drain(self) -> str:
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._readable.clear()
+        self._writable.set()
+        return text
+
+    async def chunks(self) -> AsyncIterator[str]:
+        """Накопичений текст: перший шматок одразу, далі не частіше ніж раз на window"""
+        first = True
+        while True:
+            await self._readable.wait()
+            if not first and not self._closed and self.window:
+                # Зібрати дельти, що прийдуть протягом вікна, в один кадр
+                await asyncio.sleep(self.window)
+            first = False
+            if self._parts:
+                yield self._drain()
+            if self._closed and not self._parts:
+                return
@@ -0,0 +1,391 @@
+"""
+Сховище стану сервісу: історія розмов, галерея, кеші Assistants/Vector Stores, каталог
+
+STATE_BACKEND:
+- memory - словники в процесі (за замовчуванням, один воркер)
+- sqlite - файл SQLite у WAL режимі (STATE_DB_PATH): кілька воркерів на одному хості
+- redis  - Redis або сумісний сервер (STATE_REDIS_URL): кілька хостів за балансувальником
+
+Інтерфейс навмисно повторює примітиви Redis: key-value в просторах імен (hash) та списки
+(RPUSH / LRANGE / LSET / LREM), тож кожна операція атомарна на будь-якому бекенді -
+два воркери можуть дописувати в одну розмову без sticky sessions.
+Значення - JSON-сумісні об'єкти; memory бекенд зберігає їх без серіалізації.
+"""
+
+import importlib.util
+import json
+import sqlite3
+import threading
+from typing import Any, Iterable
+
+# redis-py імпортується тільки для STATE_BACKEND=redis (~80 мс на старті воркера)
+REDIS_AVAILABLE = importlib.util.find_spec("redis") is not None
+
+
+def _dumps(value) -> str:
+    # Детермінована серіалізація: list_remove порівнює значення за текстом
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def _slice_bounds(length: int, start: int, stop: int) -> tuple:
+    """Індекси як у LRANGE (stop включно, від'ємні - з кінця) -> межі Python зрізу"""
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop = length + stop
+    return start, min(stop + 1, length)
+
+
+class StateStore:
+    """Інтерфейс сховища стану"""
+
+    name = "base"
+    shared = False  # стан видно іншим процесам
+    networked = False  # стан видно іншим хостам
+
+    # ----- key-value -----
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: Any):
+        raise NotImplementedError
+
+    def setdefault(self, namespace: str, key: str, value: Any) -> Any:
+        """Записати значення, якщо ключа ще немає; повернути те, що збережено"""
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def items(self, namespace: str) -> dict:
+        """Усі ключі простору імен (знімок)"""
+        raise NotImplementedError
+
+    # ----- списки -----
+    def list_append(self, key: str, *values) -> int:
+        """Дописати в кінець списку, повернути нову довжину"""
+        raise NotImplementedError
+
+    def list_range(self, key: str, start: int = 0, stop: int = -1) -> list:
+        """Елементи з start по stop включно (від'ємні індекси - з кінця)"""
+        raise NotImplementedError
+
+    def list_length(self, key: str) -> int:
+        raise NotImplementedError
+
+    def list_set(self, key: str, index: int, value: Any):
+        raise NotImplementedError
+
+    def list_remove(self, key: str, value: Any) -> int:
+        """Видалити всі елементи, що дорівнюють value; повернути кількість"""
+        raise NotImplementedError
+
+    def list_replace(self, key: str, values: Iterable):
+        """Атомарно замінити весь список"""
+        raise NotImplementedError
+
+    def ping(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """Стан у словниках процесу (поведінка до появи сховища)"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._hashes = {}
+        self._lists = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key, default=None):
+        return self._hashes.get(namespace, {}).get(key, default)
+
+    def set(self, namespace, key, value):
+        with self._lock:
+            self._hashes.setdefault(namespace, {})[key] = value
+
+    def setdefault(self, namespace, key, value):
+        with self._lock:
+            return self._hashes.setdefault(namespace, {}).setdefault(key, value)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._hashes.get(namespace, {}).pop(key, None)
+
+    def items(self, namespace):
+        with self._lock:
+            return dict(self._hashes.get(namespace, {}))
+
+    def list_append(self, key, *values):
+        with self._lock:
+            items = self._lists.setdefault(key, [])
+            items.extend(values)
+            return len(items)
+
+    def list_range(self, key, start=0, stop=-1):
+        items = self._lists.get(key)
+        if not items:
+            return []
+        begin, end = _slice_bounds(len(items), start, stop)
+        return items[begin:end]
+
+    def list_length(self, key):
+        return len(self._lists.get(key, ()))
+
+    def list_set(self, key, index, value):
+        with self._lock:
+            self._lists[key][index] = value
+
+    def list_remove(self, key, value):
+        with self._lock:
+            items = self._lists.get(key, [])
+            kept = [item for item in items if item != value]
+            self._lists[key] = kept
+            return len(items) - len(kept)
+
+    def list_replace(self, key, values):
+        with self._lock:
+            self._lists[key] = list(values)
+
+
+class SQLiteStateStore(StateStore):
+    """Стан у SQLite (WAL): спільний для воркерів одного хоста"""
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS state_kv (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS state_lists (
+                list_key TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (list_key, seq)
+            ) WITHOUT ROWID;
+        """)
+        self._lock = threading.Lock()
+
+    def _write(self, func):
+        """Виконати func(conn) в IMMEDIATE транзакції (один записувач серед процесів)"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM state_kv WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state_kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, _dumps(value)),
+            )
+
+    def setdefault(self, namespace, key, value):
+        def write(conn):
+            conn.execute(
+                "INSERT OR IGNORE INTO state_kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, _dumps(value)),
+            )
+            return conn.execute(
+                "SELECT value FROM state_kv WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()[0]
+        return json.loads(self._write(write))
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM state_kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM state_kv WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def list_append(self, key, *values):
+        def write(conn):
+            last = conn.execute("SELECT MAX(seq) FROM state_lists WHERE list_key = ?", (key,)).fetchone()[0]
+            start = -1 if last is None else last
+            conn.executemany(
+                "INSERT INTO state_lists (list_key, seq, value) VALUES (?, ?, ?)",
+                ((key, start + offset, _dumps(value)) for offset, value in enumerate(values, 1)),
+            )
+            return conn.execute("SELECT COUNT(*) FROM state_lists WHERE list_key = ?", (key,)).fetchone()[0]
+        return self._write(write)
+
+    def list_range(self, key, start=0, stop=-1):
+        with self._lock:
+            if start == 0 and stop == -1:
+                rows = self._conn.execute(
+                    "SELECT value FROM state_lists WHERE list_key = ? ORDER BY seq", (key,)
+                ).fetchall()
+            else:
+                # Одна read-транзакція: довжина і зріз з одного знімку
+                self._conn.execute("BEGIN")
+                try:
+                    length = self._conn.execute(
+                        "SELECT COUNT(*) FROM state_lists WHERE list_key = ?", (key,)
+                    ).fetchone()[0]
+                    begin, end = _slice_bounds(length, start, stop)
+                    rows = self._conn.execute(
+                        "SELECT value FROM state_lists WHERE list_key = ? ORDER BY seq LIMIT ? OFFSET ?",
+                        (key, max(end - begin, 0), begin),
+                    ).fetchall()
+                finally:
+                    self._conn.execute("COMMIT")
+        return [json.loads(row[0]) for row in rows]
+
+    def list_length(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM state_lists WHERE list_key = ?", (key,)).fetchone()[0]
+
+    def list_set(self, key, index, value):
+        def write(conn):
+            order = "DESC" if index < 0 else "ASC"
+            row = conn.execute(
+                f"SELECT seq FROM state_lists WHERE list_key = ? ORDER BY seq {order} LIMIT 1 OFFSET ?",
+                (key, -index - 1 if index < 0 else index),
+            ).fetchone()
+            if row is None:
+                raise IndexError(f"{key}: індекс {index} поза списком")
+            conn.execute(
+                "UPDATE state_lists SET value = ? WHERE list_key = ? AND seq = ?", (_dumps(value), key, row[0])
+            )
+        self._write(write)
+
+    def list_remove(self, key, value):
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM state_lists WHERE list_key = ? AND value = ?", (key, _dumps(value))
+            ).rowcount
+
+    def list_replace(self, key, values):
+        def write(conn):
+            conn.execute("DELETE FROM state_lists WHERE list_key = ?", (key,))
+            conn.executemany(
+                "INSERT INTO state_lists (list_key, seq, value) VALUES (?, ?, ?)",
+                ((key, seq, _dumps(value)) for seq, value in enumerate(values)),
+            )
+        self._write(write)
+
+    def ping(self):
+        with self._lock:
+            self._conn.execute("SELECT 1").fetchone()
+        return True
+
+    def close(self):
+        self._conn.close()
+
+
+class RedisStateStore(StateStore):
+    """Стан у Redis (або сумісному сервері): спільний для хостів"""
+
+    name = "redis"
+    shared = True
+    networked = True
+
+    def __init__(self, url: str, prefix: str = "multimodal:", timeout: float = 2.0):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("Для STATE_BACKEND=redis встановіть: pip install redis")
+        import redis  # type: ignore
+        self.prefix = prefix
+        # Без таймаутів завислий Redis блокує потік назавжди (і з ним пул виконавця)
+        self._redis = redis.Redis.from_url(
+            url, decode_responses=True, health_check_interval=30,
+            socket_timeout=timeout, socket_connect_timeout=timeout,
+        )
+
+    def _hash(self, namespace: str) -> str:
+        return f"{self.prefix}{namespace}"
+
+    def _list(self, key: str) -> str:
+        return f"{self.prefix}list:{key}"
+
+    def get(self, namespace, key, default=None):
+        value = self._redis.hget(self._hash(namespace), key)
+        return json.loads(value) if value is not None else default
+
+    def set(self, namespace, key, value):
+        self._redis.hset(self._hash(namespace), key, _dumps(value))
+
+    def setdefault(self, namespace, key, value):
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hsetnx(self._hash(namespace), key, _dumps(value))
+        pipe.hget(self._hash(namespace), key)
+        return json.loads(pipe.execute()[1])
+
+    def delete(self, namespace, key):
+        self._redis.hdel(self._hash(namespace), key)
+
+    def items(self, namespace):
+        return {key: json.loads(value) for key, value in self._redis.hgetall(self._hash(namespace)).items()}
+
+    def list_append(self, key, *values):
+        if not values:
+            return self.list_length(key)
+        return self._redis.rpush(self._list(key), *(_dumps(value) for value in values))
+
+    def list_range(self, key, start=0, stop=-1):
+        return [json.loads(value) for value in self._redis.lrange(self._list(key), start, stop)]
+
+    def list_length(self, key):
+        return self._redis.llen(self._list(key))
+
+    def list_set(self, key, index, value):
+        self._redis.lset(self._list(key), index, _dumps(value))
+
+    def list_remove(self, key, value):
+        return self._redis.lrem(self._list(key), 0, _dumps(value))
+
+    def list_replace(self, key, values):
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.delete(self._list(key))
+        serialized = [_dumps(value) for value in values]
+        if serialized:
+            pipe.rpush(self._list(key), *serialized)
+        pipe.execute()
+
+    def ping(self):
+        return bool(self._redis.ping())
+
+    def close(self):
+        self._redis.close()
+
+
+def create_state_store(backend: str = "memory", db_path: str = "./state.db",
+                       redis_url: str = "redis://localhost:6379/0", prefix: str = "multimodal:",
+                       redis_timeout: float = 2.0) -> StateStore:
+    """Створити сховище за назвою бекенду"""
+    backend = (backend or "memory").lower()
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "sqlite":
+        return SQLiteStateStore(db_path)
+    if backend == "redis":
+        return RedisStateStore(redis_url, prefix, redis_timeout)
+    raise ValueError(f"Невідомий STATE_BACKEND: {backend} (memory | sqlite | redis)")
@@ -0,0 +1,110 @@
+"""
+Лінива ініціалізація підсистем і їх готовність для /healthz та /readyz
+
+Важкі залежності (openai, pandas, chromadb, Google API) не імпортуються разом з main.py:
+кожна підсистема створюється при першому використанні (Lazy) або у фоновому прогріві
+одразу після старту (warm_up). Воркер починає приймати з'єднання за долі секунди, а
+/readyz повертає 503, поки обов'язкові підсистеми ще прогріваються, - балансувальник
+не відправляє на нього трафік раніше часу.
+
+Стан підсистеми: pending -> ready | error, або disabled (не налаштована / не встановлена).
+"""
+
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+
+class Lazy:
+    """Значення, що створюється один раз при першому get() (потокобезпечно)"""
+
+    def __init__(self, factory: Callable):
+        self._factory = factory
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    # Помилка фабрики передається викликачу, наступний get() спробує знову
+                    self._value = self._factory()
+                    self._loaded = True
+        return self._value
+
+
+class LazyProxy(Lazy):
+    """Lazy, що делегує атрибути створеному об'єкту (client.chat... створює клієнт)"""
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class Readiness:
+    """Стан підсистем: статус, чи обов'язкова для /readyz, час ініціалізації"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._subsystems = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, required: bool = True, enabled: bool = True):
+        with self._lock:
+            self._subsystems[name] = {
+                "status": "pending" if enabled else "disabled",
+                "required": required,
+                "seconds": None,
+                "error": None,
+            }
+
+    def _update(self, name: str, **fields):
+        with self._lock:
+            self._subsystems[name].update(fields)
+
+    def run(self, name: str, init: Callable) -> bool:
+        """Виконати init() підсистеми і записати результат (помилка не кидається далі)"""
+        if self._subsystems[name]["status"] == "disabled":
+            return False
+        started = time.perf_counter()
+        try:
+            init()
+        except Exception as e:
+            self._update(name, status="error", error=str(e), seconds=round(time.perf_counter() - started, 3))
+            return False
+        self._update(name, status="ready", error=None, seconds=round(time.perf_counter() - started, 3))
+        return True
+
+    def is_ready(self) -> bool:
+        with self._lock:
+            return all(
+                entry["status"] in ("ready", "disabled")
+                for entry in self._subsystems.values() if entry["required"]
+            )
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            subsystems = {name: dict(entry) for name, entry in self._subsystems.items()}
+        return {
+            "ready": self.is_ready(),
+            "uptime": round(time.monotonic() - self.started, 3),
+            "subsystems": subsystems,
+        }
+
+
+def warm_up(readiness: Readiness, steps: Iterable[tuple], on_done: Optional[Callable[[dict], None]] = None) -> threading.Thread:
+    """Ініціалізувати підсистеми [(name, init), ...] по черзі у фоновому потоці"""
+
+    def worker():
+        for name, init in steps:
+            readiness.run(name, init)
+        if on_done is not None:
+            on_done(readiness.snapshot())
+
+    thread = threading.Thread(target=worker, name="warm-up", daemon=True)
+    thread.start()
+    return thread
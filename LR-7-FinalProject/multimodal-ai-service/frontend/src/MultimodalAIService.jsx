@@ -51,6 +51,7 @@ const MultimodalAIService = () => {
     enabledTools: {
       get_item_price: true,
       calculate_shipping: true,
+      quote_basket: true,
       book_meeting: true,
       send_email: true,
     },
@@ -2121,6 +2122,24 @@ const MultimodalAIService = () => {
                     <span className="text-sm">🚚 Calculate Shipping</span>
                   </label>
 
+                  <label className="flex items-center gap-2">
+                    <input
+                      type="checkbox"
+                      checked={settings.enabledTools?.quote_basket ?? true}
+                      onChange={(e) =>
+                        setSettings({
+                          ...settings,
+                          enabledTools: {
+                            ...settings.enabledTools,
+                            quote_basket: e.target.checked,
+                          },
+                        })
+                      }
+                      className="rounded"
+                    />
+                    <span className="text-sm">🧺 Quote Basket</span>
+                  </label>
+
                   <label className="flex items-center gap-2">
                     <input
                       type="checkbox"